@@ -0,0 +1,245 @@
+"""
+Runs several Bonsai simulator sessions concurrently from one process on an asyncio event loop, sharing one HTTP connection pool, with the twins stepped on a thread pool.
+Copyright 2021, Microsoft Corp.
+"""
+
+import asyncio
+import json
+import logging
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import List
+
+from azure.core.exceptions import HttpResponseError
+from microsoft_bonsai_api.simulator.client import BonsaiClientAsync, BonsaiClientConfig
+from microsoft_bonsai_api.simulator.generated.models import (
+    SimulatorInterface,
+    SimulatorState,
+    SimulatorSessionResponse,
+)
+
+from .ConnectorLogging import step_logger
+from .Profiling import profiler
+from .RunSession import (
+    ADVANCE_ERRORS,
+    ADVANCE_SECONDS,
+    EPISODE_FINISH_SECONDS,
+    EPISODE_STEP_SECONDS,
+    EPISODES,
+    HALTS,
+    STEPS,
+    SessionRecovery,
+)
+from .StartupTimeline import startup
+from .TwinBuilderSimulator import TwinBuilderSimulator
+
+logger = logging.getLogger(__name__)
+
+
+def timed_call(histogram, function, *args):
+    with histogram.time():
+        return function(*args)
+
+
+async def CreateSessionAsync(
+    client: BonsaiClientAsync, registration_info: SimulatorInterface, config_client: BonsaiClientConfig
+):
+    """Creates a new Simulator Session and returns new session, sequenceId
+    """
+    try:
+        registered_session: SimulatorSessionResponse = await client.session.create(
+            workspace_name=config_client.workspace, body=registration_info
+        )
+        logger.info("Registered simulator. %s", registered_session.session_id)
+
+        return registered_session, 1
+    except HttpResponseError as ex:
+        logger.error(
+            "HttpResponseError in Registering session: StatusCode: %s, Error: %s, Exception: %s",
+            ex.status_code, ex.error.message if ex.error else ex.message, ex
+        )
+        raise ex
+
+
+async def reconnect_async(recovery: SessionRecovery, create_session, failed_at: float):
+    """ SessionRecovery.reconnect for a coroutine function, waiting between attempts without blocking """
+    attempt = 0
+    while True:
+        try:
+            result = await create_session()
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            await asyncio.sleep(recovery.failed_attempt(attempt, err))
+            attempt += 1
+            continue
+        recovery.reconnected(failed_at)
+        return result
+
+
+async def DeleteSessionAsync(client: BonsaiClientAsync, registered_session: SimulatorSessionResponse,
+                             config_client: BonsaiClientConfig):
+    """Deletes the session if the platform still knows it, errors are ignored
+    """
+    try:
+        await client.session.delete(
+            workspace_name=config_client.workspace,
+            session_id=registered_session.session_id,
+        )
+    except Exception as ex:
+        logger.warning("Could not delete session %s: %s", registered_session.session_id, ex)
+
+
+async def run_simulator_session(session_index, client: BonsaiClientAsync, config_client: BonsaiClientConfig,
+                                registration_info: SimulatorInterface, sim, executor: Executor,
+                                episode_callback=None, recovery: SessionRecovery = None):
+    """
+    Event loop of one simulator session. Every simulator call runs on the executor, so that the event loop keeps
+    serving the other sessions while this one's twin steps, and Idle events wait without blocking.
+    """
+    loop = asyncio.get_running_loop()
+    recovery = recovery or SessionRecovery()
+    with startup.phase('session_create'):
+        registered_session, sequence_id = await CreateSessionAsync(client, registration_info, config_client)
+
+    def create_session():
+        return CreateSessionAsync(client, registration_info, config_client)
+
+    episode = 0
+    episode_started = time.perf_counter()
+    iteration = 0
+    stop = False
+    track = 'session {}'.format(session_index)
+
+    try:
+        while not stop:
+            sim_state = SimulatorState(
+                sequence_id=sequence_id, state=sim.get_state(), halted=sim.halted(),
+            )
+            advance_started = time.perf_counter()
+            try:
+                with profiler.span('advance', 'bonsai', track):
+                    event = await client.session.advance(
+                        workspace_name=config_client.workspace,
+                        session_id=registered_session.session_id,
+                        body=sim_state,
+                    )
+                ADVANCE_SECONDS.observe(time.perf_counter() - advance_started)
+                startup.finish()
+                sequence_id = event.sequence_id
+                step_logger.debug("Session %d Last Event: %s", session_index, event.type,
+                                  extra={'session': session_index, 'event': event.type, 'episode': episode})
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                ADVANCE_ERRORS.inc()
+                logger.error("Error in Advance of session %d: %s", session_index, ex)
+                # Register a new session and carry on with the same simulator, as RunSession does
+                await DeleteSessionAsync(client, registered_session, config_client)
+                registered_session, sequence_id = await reconnect_async(recovery, create_session, advance_started)
+                continue
+
+            with profiler.span(event.type, 'event', track):
+                if event.type == "Idle":
+                    await asyncio.sleep(event.idle.callback_time)
+                elif event.type == "EpisodeStart":
+                    await loop.run_in_executor(executor, sim.episode_start, event.episode_start.config)
+                    episode += 1
+                    episode_started = time.perf_counter()
+                    EPISODES.inc()
+                elif event.type == "EpisodeStep":
+                    step_logger.debug("Session %d stepping iteration %d with action %s", session_index, iteration,
+                                      event.episode_step.action,
+                                      extra={'session': session_index, 'episode': episode, 'step': iteration})
+                    iteration += 1
+                    # Timed on the executor thread, so that waiting for a free thread is not counted
+                    await loop.run_in_executor(executor, timed_call, EPISODE_STEP_SECONDS, sim.episode_step,
+                                               event.episode_step.action)
+                    STEPS.inc()
+                elif event.type == "EpisodeFinish":
+                    halted = sim.halted()
+                    if halted:
+                        HALTS.inc()
+                    await loop.run_in_executor(executor, timed_call, EPISODE_FINISH_SECONDS, sim.episode_finish)
+                    seconds = time.perf_counter() - episode_started
+                    logger.info("Session %d episode %d finished%s: %d steps in %.2fs", session_index, episode,
+                                " (halted)" if halted else "", iteration, seconds,
+                                extra={'session': session_index, 'episode': episode, 'steps': iteration,
+                                       'seconds': seconds})
+                    if episode_callback is not None:
+                        stop = episode_callback(session_index, episode, iteration)
+                    iteration = 0
+                elif event.type == "Unregister":
+                    logger.warning("Simulator Session %d unregistered by platform, Registering again!", session_index)
+                    registered_session, sequence_id = await reconnect_async(recovery, create_session, time.perf_counter())
+    finally:
+        # Unregister on errors, on cancellation (Ctrl+C) and when the episode callback ends the session
+        await DeleteSessionAsync(client, registered_session, config_client)
+        logger.info("Unregistered simulator session %d.", session_index)
+
+
+async def run_sessions(twin_model_file,
+                       state_variable_names: List,
+                       action_variable_names: List,
+                       number_of_warm_up_steps, warm_up_action_variable_values: List,
+                       number_of_sessions: int = 4, executor: Executor = None,
+                       simulator_class=TwinBuilderSimulator, episode_callback=None, **simulator_options):
+    """
+    Runs number_of_sessions sessions concurrently, all sharing one Bonsai client (and so one connection pool).
+    Twins are created and stepped on the executor, by default a thread pool with one thread per session; twin
+    runtime calls release the GIL, so several twins step in parallel.
+    """
+    config_client = BonsaiClientConfig()
+
+    with open("interface.json") as file:
+        interface = json.load(file)
+
+    registration_info = SimulatorInterface(
+        name="cabin_pressure",
+        timeout=60,
+        simulator_context=config_client.simulator_context,
+        description=interface["description"],
+    )
+
+    owns_executor = executor is None
+    if owns_executor:
+        executor = ThreadPoolExecutor(max_workers=number_of_sessions, thread_name_prefix="TwinStep")
+
+    loop = asyncio.get_running_loop()
+    sims = []
+    try:
+        def create_simulator():
+            return simulator_class(twin_model_file, state_variable_names, action_variable_names,
+                                   number_of_warm_up_steps, warm_up_action_variable_values, **simulator_options)
+        sims = await asyncio.gather(*[loop.run_in_executor(executor, create_simulator)
+                                      for _ in range(number_of_sessions)])
+
+        async with BonsaiClientAsync(config_client) as client:
+            results = await asyncio.gather(
+                *[run_simulator_session(index, client, config_client, registration_info, sim, executor,
+                                        episode_callback)
+                  for index, sim in enumerate(sims)],
+                return_exceptions=True)
+        for index, result in enumerate(results):
+            if isinstance(result, Exception):
+                logger.error("Simulator session %d ended with: %s", index, result)
+    finally:
+        # Let the running simulator calls complete before closing the twins
+        if owns_executor:
+            executor.shutdown(wait=True)
+        for sim in sims:
+            sim.close()
+
+
+def AsyncRunSession(twin_model_file,
+                    state_variable_names: List,
+                    action_variable_names: List,
+                    number_of_warm_up_steps, warm_up_action_variable_values: List,
+                    number_of_sessions: int = 4, **options):
+    """ Runs number_of_sessions concurrent simulator sessions until interrupted, see run_sessions """
+    try:
+        asyncio.run(run_sessions(twin_model_file, state_variable_names, action_variable_names,
+                                 number_of_warm_up_steps, warm_up_action_variable_values,
+                                 number_of_sessions, **options))
+    except KeyboardInterrupt:
+        logger.info("Stopped the simulator sessions.")
@@ -0,0 +1,151 @@
+"""
+Non-blocking logging for the connector: records are handed to a bounded queue and formatted and written by a background thread, with per-step records sampled and rate limited.
+Copyright 2021, Microsoft Corp.
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+# Loggers of the connector modules are children of this one
+CONNECTOR_LOGGER = 'TwinBuilderConnector'
+# Per-step records (events, actions, states) go to this logger, which is off unless step logging is enabled
+STEP_LOGGER = CONNECTOR_LOGGER + '.steps'
+
+# Extra record attributes written by the JSON formatter when present
+STRUCTURED_FIELDS = ('session', 'episode', 'step', 'event', 'steps', 'seconds')
+
+step_logger = logging.getLogger(STEP_LOGGER)
+step_logger.setLevel(logging.WARNING)
+
+_listener = None
+_handler = None
+
+
+class StepSampler(logging.Filter):
+    """ Lets one record in every through, and at most max_per_second records per second (None for no limit) """
+    def __init__(self, every: int = 1, max_per_second: float = None):
+        super().__init__()
+        self.every = max(int(every), 1)
+        self.max_per_second = max_per_second
+        self.seen = 0
+        self.window_start = time.monotonic()
+        self.window_count = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        with self.lock:
+            self.seen += 1
+            if (self.seen - 1) % self.every:
+                return False
+            if self.max_per_second is not None:
+                now = time.monotonic()
+                if now - self.window_start >= 1.0:
+                    self.window_start = now
+                    self.window_count = 0
+                if self.window_count >= self.max_per_second:
+                    self.dropped += 1
+                    return False
+                self.window_count += 1
+            return True
+
+
+class BackgroundQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that leaves the formatting to the listener thread, and drops records (counting them) instead of
+    blocking when the queue is full.
+    """
+    def __init__(self, record_queue):
+        super().__init__(record_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Exceptions are rendered now, while the traceback is still meaningful
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """ One JSON object per line with the time, level, logger, message and the structured fields of the record """
+    def format(self, record):
+        entry = {'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'), 'level': record.levelname,
+                 'logger': record.name, 'message': record.getMessage()}
+        for field in STRUCTURED_FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level=logging.INFO, step_every: int = 0, steps_per_second: float = None,
+                      json_format: bool = False, stream=None, queue_size: int = 10000):
+    """
+    Routes the connector logs through a bounded queue to a background thread writing to stream (stdout by default).
+    Per-step records are logged at DEBUG on the steps logger, one in every step_every of them and at most
+    steps_per_second per second; step_every=0 (the default) leaves them off, so that only episode summaries and
+    session events are logged.
+    """
+    global _listener, _handler
+    stop_logging()
+
+    target = logging.StreamHandler(stream or sys.stdout)
+    if json_format:
+        target.setFormatter(JsonFormatter())
+    else:
+        target.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s', '%H:%M:%S'))
+
+    _handler = BackgroundQueueHandler(queue.Queue(queue_size))
+    _listener = logging.handlers.QueueListener(_handler.queue, target)
+
+    connector_logger = logging.getLogger(CONNECTOR_LOGGER)
+    connector_logger.setLevel(level)
+    connector_logger.handlers = [_handler]
+    connector_logger.propagate = False
+
+    step_logger.filters = []
+    if step_every > 0:
+        step_logger.setLevel(logging.DEBUG)
+        step_logger.addFilter(StepSampler(step_every, steps_per_second))
+    else:
+        step_logger.setLevel(logging.WARNING)
+
+    _listener.start()
+    return _listener
+
+
+def stop_logging():
+    """ Writes the queued records and stops the background thread """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def _restart_after_fork():
+    # The listener thread does not exist in a forked child, and the queue's lock may have been held while forking
+    global _listener
+    if _listener is not None:
+        _handler.queue = queue.Queue(_handler.queue.maxsize)
+        _listener = logging.handlers.QueueListener(_handler.queue, *_listener.handlers)
+        _listener.start()
+
+
+atexit.register(stop_logging)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_after_fork)
@@ -0,0 +1,234 @@
+"""
+Low-overhead counters and fixed-bucket latency histograms for the connector hot paths, exported in the Prometheus text format over HTTP or to a periodically rewritten file.
+Copyright 2021, Microsoft Corp.
+"""
+
+import logging
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+
+# Upper bounds in seconds, from sub-millisecond ctypes calls to twin loads taking seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0, 30.0)
+
+logger = logging.getLogger(__name__)
+
+def format_labels(labels: Dict, extra: Dict = None) -> str:
+    items = list(labels.items()) + list((extra or {}).items())
+    if not items:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in items) + '}'
+
+
+def format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter():
+    """ Monotonic count, incremented from any thread """
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, self.labels, self.value)]
+
+
+class Histogram():
+    """ Counts of observed values per fixed bucket, with their sum, as a Prometheus histogram """
+    def __init__(self, name, labels, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        # One count per bucket, the last one for values above every bound
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        """ Context manager observing the time spent in its block """
+        return HistogramTimer(self)
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            samples.append((self.name + '_bucket', dict(self.labels, le=format_value(bound)), cumulative))
+        samples.append((self.name + '_sum', self.labels, total))
+        samples.append((self.name + '_count', self.labels, cumulative))
+        return samples
+
+
+class HistogramTimer():
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class MetricsRegistry():
+    """
+    Metrics of one process, keyed by name and labels. Metrics are created once (typically at import) and then
+    updated without any lookup. constant_labels, such as the worker index, are added to every exported sample.
+    """
+    def __init__(self, namespace: str = 'twin_connector'):
+        self.namespace = namespace
+        self.constant_labels = {}
+        self.metrics = {}
+        self.help = {}
+        self.types = {}
+        self.lock = threading.Lock()
+        if hasattr(os, 'register_at_fork'):
+            # A lock held by another thread while forking would stay locked in the child
+            os.register_at_fork(after_in_child=self.reset_locks)
+
+    def counter(self, name: str, help_text: str, labels: Dict = None) -> Counter:
+        return self.get_or_create(name, help_text, 'counter', labels, lambda full_name, labels: Counter(full_name, labels))
+
+    def histogram(self, name: str, help_text: str, labels: Dict = None, buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.get_or_create(name, help_text, 'histogram', labels,
+                                  lambda full_name, labels: Histogram(full_name, labels, buckets))
+
+    def get_or_create(self, name, help_text, metric_type, labels, create):
+        full_name = '{}_{}'.format(self.namespace, name) if self.namespace else name
+        labels = dict(labels or {})
+        key = (full_name, tuple(sorted(labels.items())))
+        with self.lock:
+            metric = self.metrics.get(key)
+            if metric is None:
+                metric = self.metrics[key] = create(full_name, labels)
+                self.help.setdefault(full_name, help_text)
+                self.types.setdefault(full_name, metric_type)
+        return metric
+
+    def reset_locks(self):
+        self.lock = threading.Lock()
+        for metric in self.metrics.values():
+            metric.lock = threading.Lock()
+
+    def render(self) -> str:
+        """ All the metrics in the Prometheus text exposition format """
+        with self.lock:
+            metrics = sorted(self.metrics.items(), key=lambda item: item[0])
+        lines = []
+        last_name = None
+        for (full_name, _), metric in metrics:
+            if full_name != last_name:
+                lines.append('# HELP {} {}'.format(full_name, self.help[full_name]))
+                lines.append('# TYPE {} {}'.format(full_name, self.types[full_name]))
+                last_name = full_name
+            for sample_name, labels, value in metric.samples():
+                lines.append('{}{} {}'.format(sample_name, format_labels(self.constant_labels, labels),
+                                              format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsExporter():
+    """
+    Serves the registry at http://host:port/metrics when port is given, and rewrites path (atomically) every
+    interval seconds when path is given.
+    """
+    def __init__(self, registry: MetricsRegistry, port: int = None, path: str = None, interval: float = 15.0,
+                 host: str = '0.0.0.0'):
+        self.registry = registry
+        # Resolved once, the exporter thread must not follow the working directory while a twin loads
+        self.path = os.path.abspath(path) if path is not None else None
+        self.interval = interval
+        self.server = None
+        self.threads = []
+        self.stopping = threading.Event()
+
+        if port is not None:
+            class Handler(BaseHTTPRequestHandler):
+                def log_message(self, format, *args):
+                    pass
+
+                def do_GET(self):
+                    if self.path.split('?')[0] not in ('/', '/metrics'):
+                        self.send_error(404)
+                        return
+                    data = registry.render().encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                    self.send_header('Content-Length', str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+
+            self.server = ThreadingHTTPServer((host, port), Handler)
+            self.server.daemon_threads = True
+
+    def start(self):
+        if self.server is not None:
+            self.threads.append(threading.Thread(target=self.server.serve_forever, name="MetricsServer",
+                                                 daemon=True))
+        if self.path is not None:
+            self.threads.append(threading.Thread(target=self.write_periodically, name="MetricsWriter", daemon=True))
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def write_periodically(self):
+        while not self.stopping.wait(self.interval):
+            self.write()
+
+    def write(self):
+        directory = os.path.dirname(self.path)
+        try:
+            file_descriptor, temp_path = tempfile.mkstemp(dir=directory, suffix='.prom.tmp')
+            with os.fdopen(file_descriptor, 'w') as temp_file:
+                temp_file.write(self.registry.render())
+            os.replace(temp_path, self.path)
+        except OSError as err:
+            logger.warning("Could not write the metrics file %s: %s", self.path, err)
+
+    def stop(self):
+        self.stopping.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        if self.path is not None:
+            self.write()
+
+
+# Metrics of this process
+metrics = MetricsRegistry()
+
+def start_metrics_exporter(port: int = None, path: str = None, interval: float = 15.0, **constant_labels):
+    """ Exports the process metrics, returns None when neither a port nor a path is given """
+    metrics.constant_labels.update(constant_labels)
+    if port is None and path is None:
+        return None
+    return MetricsExporter(metrics, port, path, interval).start()
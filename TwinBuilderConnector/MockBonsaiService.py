@@ -0,0 +1,195 @@
+"""
+Local stand-in for the Bonsai simulator session endpoints (create, advance, delete), handing out scripted episodes with configurable latency, so that RunSession can be load tested without the platform.
+Copyright 2021, Microsoft Corp.
+"""
+
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+
+class MockServiceServer(ThreadingHTTPServer):
+    """ HTTP server of the stand-in, quiet about clients that disconnect, as stopped simulator sessions do """
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            return
+        super().handle_error(request, client_address)
+
+
+class MockSession():
+    """ Script and timings of one registered simulator session """
+    def __init__(self, session_id, seed):
+        self.session_id = session_id
+        self.random = random.Random(seed)
+        self.sequence_id = 1
+        self.episode_steps = None  # None between episodes
+        self.episodes = 0
+        self.last_event = None
+        self.last_event_sent_at = None
+
+
+class MockBonsaiService():
+    """
+    Serves /v2/workspaces/{workspace}/simulatorSessions like the Bonsai platform does for a training simulator.
+    Each session runs episodes of steps_per_episode EpisodeStep events, with actions drawn uniformly from
+    action_ranges, framed by EpisodeStart (with config) and EpisodeFinish events. An Idle event is sent every
+    idle_every events, and an Unregister event after every unregister_every episodes. Once total_episodes
+    episodes have been started over all sessions, sessions only get Idle events; all_episodes_finished is set when
+    they have all finished (or were abandoned by deleting their session).
+    Every response is delayed by latency plus a uniform jitter, both in seconds. The time the simulator takes to
+    come back after each event (its turnaround, covering the client, Python and the solver) is recorded per event
+    type in turnarounds.
+    """
+    def __init__(self, total_episodes: int = 10, steps_per_episode: int = 50, config: Dict = None,
+                 action_ranges: Dict = None, latency: float = 0.0, jitter: float = 0.0, idle_every: int = 0,
+                 idle_time: float = 0.1, unregister_every: int = 0, host: str = '127.0.0.1', port: int = 0,
+                 seed: int = 0):
+        self.total_episodes = total_episodes
+        self.steps_per_episode = steps_per_episode
+        self.config = dict(config or {})
+        self.action_ranges = dict(action_ranges or {})
+        self.latency = latency
+        self.jitter = jitter
+        self.idle_every = idle_every
+        self.idle_time = idle_time
+        self.unregister_every = unregister_every
+        self.seed = seed
+
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.events_sent = 0
+        self.episodes_started = 0
+        self.episodes_finished = 0
+        self.requests = {'create': 0, 'advance': 0, 'delete': 0, 'not_found': 0}
+        self.turnarounds = {'EpisodeStart': [], 'EpisodeStep': [], 'EpisodeFinish': [], 'Idle': [], 'Unregister': []}
+        self.all_episodes_finished = threading.Event()
+
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                service.handle(self, 'POST')
+
+            def do_DELETE(self):
+                service.handle(self, 'DELETE')
+
+        self.server = MockServiceServer((host, port), Handler)
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="MockBonsaiService", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, request, method):
+        length = int(request.headers.get('Content-Length') or 0)
+        body = json.loads(request.rfile.read(length) or b'{}')
+        parts = request.path.split('?')[0].strip('/').split('/')
+        received_at = time.perf_counter()
+
+        delay = max(self.latency + random.uniform(-self.jitter, self.jitter), 0.0)
+        if delay:
+            time.sleep(delay)
+
+        if method == 'POST' and parts[-1] == 'simulatorSessions':
+            self.send(request, 201, self.create_session(body))
+        elif method == 'POST' and parts[-1] == 'advance':
+            event = self.advance(parts[-2], body, received_at)
+            self.send(request, 200 if event else 404, event or {'title': 'Session not found', 'status': 404})
+        elif method == 'DELETE':
+            self.delete_session(parts[-1])
+            self.send(request, 204, None)
+        else:
+            self.send(request, 404, {'title': 'Not found', 'status': 404})
+
+    def send(self, request, status, body):
+        data = json.dumps(body).encode() if body is not None else b''
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def create_session(self, registration):
+        with self.lock:
+            self.requests['create'] += 1
+            session = MockSession(str(uuid.uuid4()), self.seed + len(self.sessions) + self.requests['create'])
+            self.sessions[session.session_id] = session
+        return {'sessionId': session.session_id, 'sessionStatus': 'Attached'}
+
+    def delete_session(self, session_id):
+        with self.lock:
+            self.requests['delete'] += 1
+            session = self.sessions.pop(session_id, None)
+            if session is not None and session.episode_steps is not None:
+                # The episode in progress is abandoned
+                self.episode_ended()
+
+    def episode_ended(self):
+        self.episodes_finished += 1
+        if self.episodes_finished >= self.total_episodes:
+            self.all_episodes_finished.set()
+
+    def advance(self, session_id, state, received_at):
+        with self.lock:
+            self.requests['advance'] += 1
+            session = self.sessions.get(session_id)
+            if session is None:
+                self.requests['not_found'] += 1
+                return None
+
+            if session.last_event is not None:
+                self.turnarounds[session.last_event].append(received_at - session.last_event_sent_at)
+            event = self.next_event(session, state)
+            self.events_sent += 1
+            session.sequence_id += 1
+            session.last_event = event['type']
+            session.last_event_sent_at = time.perf_counter()
+
+        event.update(sessionId=session_id, sequenceId=session.sequence_id)
+        return event
+
+    def next_event(self, session: MockSession, state):
+        """ Next scripted event of the session, called with the lock held """
+        if self.idle_every and self.events_sent % self.idle_every == self.idle_every - 1:
+            return {'type': 'Idle', 'idle': {'callbackTime': self.idle_time}}
+
+        if session.episode_steps is None:
+            if self.unregister_every and session.episodes and session.episodes % self.unregister_every == 0 \
+                    and session.last_event != 'Unregister':
+                return {'type': 'Unregister', 'unregister': {'reason': 'Finished', 'details': 'scripted'}}
+            if self.episodes_started >= self.total_episodes:
+                return {'type': 'Idle', 'idle': {'callbackTime': self.idle_time}}
+            self.episodes_started += 1
+            session.episodes += 1
+            session.episode_steps = 0
+            return {'type': 'EpisodeStart', 'episodeStart': {'config': dict(self.config)}}
+
+        if session.episode_steps < self.steps_per_episode and not state.get('halted'):
+            session.episode_steps += 1
+            action = {name: session.random.uniform(low, high) for name, (low, high) in self.action_ranges.items()}
+            return {'type': 'EpisodeStep', 'episodeStep': {'action': action}}
+
+        session.episode_steps = None
+        self.episode_ended()
+        return {'type': 'EpisodeFinish', 'episodeFinish': {'reason': 'Finished'}}
@@ -0,0 +1,153 @@
+"""
+Keeps a small pool of loaded, initialized and warmed-up twins prepared in the background between episodes, so that episode start only swaps one in.
+Copyright 2021, Microsoft Corp.
+"""
+
+import logging
+import queue
+import threading
+import time
+from typing import List
+
+from .TwinBuilderSimulator import (
+    POOL_ERRORS,
+    POOL_HITS,
+    POOL_MISSES,
+    POOL_PREPARE_SECONDS,
+    RESET_SECONDS,
+    TwinBuilderSimulator,
+)
+
+logger = logging.getLogger(__name__)
+
+class TwinInstancePool():
+    """
+    Ready-to-run TwinBuilderSimulator instances keyed by step_size, built by a background thread.
+    The pool holds at most size instances; preparing instances for a new step_size discards the others.
+    Hits, misses, errors and preparation times are exported as metrics and counted in stats.
+    """
+    def __init__(self, build_instance, size: int = 1):
+        self.build_instance = build_instance
+        self.size = size
+        self.ready = {}
+        self.lock = threading.Lock()
+        self.requests = queue.Queue()
+        self.stats = {'hits': 0, 'misses': 0, 'prepared': 0, 'prepare_seconds': 0.0, 'last_prepare_seconds': 0.0,
+                      'errors': 0}
+        self.thread = threading.Thread(target=self.run, name="TwinInstancePool", daemon=True)
+        self.thread.start()
+
+    def acquire(self, step_size):
+        """ Returns a ready instance for step_size, or None if there is none """
+        with self.lock:
+            instances = self.ready.get(step_size)
+            if instances:
+                self.stats['hits'] += 1
+                POOL_HITS.inc()
+                return instances.pop()
+            self.stats['misses'] += 1
+            POOL_MISSES.inc()
+            return None
+
+    def prepare(self, step_size):
+        """ Asks the background thread to fill the pool with instances for step_size """
+        self.requests.put(step_size)
+
+    def run(self):
+        while True:
+            step_size = self.requests.get()
+            if step_size is None:
+                return
+
+            discarded = []
+            with self.lock:
+                for other_step_size in [key for key in self.ready if key != step_size]:
+                    discarded += self.ready.pop(other_step_size)
+                missing = self.size - len(self.ready.get(step_size, []))
+            for instance in discarded:
+                instance.close()
+
+            for _ in range(missing):
+                start = time.perf_counter()
+                try:
+                    instance = self.build_instance(step_size)
+                except Exception as err:
+                    logger.warning("Preparing a twin for step size %s failed: %s", step_size, err)
+                    with self.lock:
+                        self.stats['errors'] += 1
+                    POOL_ERRORS.inc()
+                    break
+                elapsed = time.perf_counter() - start
+                POOL_PREPARE_SECONDS.observe(elapsed)
+                with self.lock:
+                    self.ready.setdefault(step_size, []).append(instance)
+                    self.stats['prepared'] += 1
+                    self.stats['prepare_seconds'] += elapsed
+                    self.stats['last_prepare_seconds'] = elapsed
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+        with self.lock:
+            for instances in self.ready.values():
+                for instance in instances:
+                    instance.close()
+            self.ready = {}
+
+
+class PooledTwinBuilderSimulator(TwinBuilderSimulator):
+    """
+    TwinBuilderSimulator that swaps in a twin prepared in the background at episode start.
+    The pool is refilled as soon as an episode starts, so the next twin is built while the episode runs; when no
+    instance is ready for the requested step_size (config change) the twin is built on the spot as usual.
+    """
+    def __init__(self, twin_model_file, state_variable_names: List,
+                 action_variable_names: List,
+                 number_of_warm_up_steps, warm_up_action_variable_values: List,
+                 pool_size: int = 1, **simulator_options):
+        self.pool = TwinInstancePool(self.build_instance, pool_size)
+        simulator_options['reuse_twin'] = False
+        super().__init__(twin_model_file, state_variable_names, action_variable_names,
+                         number_of_warm_up_steps, warm_up_action_variable_values, **simulator_options)
+
+    def build_instance(self, step_size) -> TwinBuilderSimulator:
+        return TwinBuilderSimulator(self.twin_model_file, self.state_variable_names, self.action_variable_names,
+                                    self.number_of_warm_up_steps, self.warm_up_action_variable_values,
+                                    reuse_twin=False, step_size=step_size, twin_log_level=self.twin_log_level,
+                                    log_router=self.log_router)
+
+    def reset(self, step_size):
+        start = time.perf_counter()
+        # The twin of the constructor is loaded on the spot, before any could be prepared
+        instance = self.pool.acquire(step_size) if self.reset_stats['count'] > 0 else None
+        if instance is None:
+            super().reset(step_size)
+        else:
+            # Take over the prepared twin, the instance itself is dropped
+            self.close_twin()
+            self.done = False
+            self.step_size = step_size
+            self.twin_runtime = instance.twin_runtime
+            self.io_plan = instance.io_plan
+            self.state_values = instance.state_values
+            self.initial_outputs = instance.initial_outputs
+            self.state = instance.state
+            self.time_index = instance.time_index
+
+            elapsed = time.perf_counter() - start
+            RESET_SECONDS['pool'].observe(elapsed)
+            self.reset_stats['count'] += 1
+            self.reset_stats['total_seconds'] += elapsed
+            self.reset_stats['last_seconds'] = elapsed
+            logger.info("Reset (pool) took %.3fs", elapsed)
+        # The replacement is built while this episode runs, after the twin taken on the spot if any
+        self.pool.prepare(step_size)
+
+        stats = self.pool.stats
+        logger.info("Twin pool hits %d, misses %d, prepared %d in %.3fs on average",
+                    stats['hits'], stats['misses'], stats['prepared'], stats['prepare_seconds'] / max(stats['prepared'], 1))
+
+    def close(self):
+        """ Closes the current twin and the pooled ones """
+        super().close()
+        self.pool.close()
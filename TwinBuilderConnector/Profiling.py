@@ -0,0 +1,255 @@
+"""
+On-demand profiling of the stepping loop: spans of the session events and of the simulator and twin runtime calls are kept in a ring buffer and dumped as a Chrome trace (Perfetto) file, with optional stack sampling. Profiling is switched on and off at runtime by signal or from the environment.
+Copyright 2021, Microsoft Corp.
+"""
+
+import atexit
+import functools
+import json
+import logging
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, deque
+
+logger = logging.getLogger(__name__)
+
+# (module, class, methods, category) instrumented while profiling is on. Modules are only instrumented once imported.
+PROFILED_METHODS = [
+    ('twin_runtime.twin_runtime_core', 'TwinRuntime',
+     ['twin_load', 'twin_close', 'twin_instantiate', 'twin_initialize', 'twin_reset', 'twin_simulate',
+      'twin_simulate_batch_mode_array', 'twin_set_inputs', 'twin_get_outputs', 'twin_set_input_by_name',
+      'twin_get_output_by_name'], 'twin_runtime'),
+    ('twin_runtime.twin_runtime_core', 'TwinIOPlan', ['set_inputs_from', 'read_outputs_into'], 'twin_runtime'),
+    (__package__ + '.TwinBuilderSimulator', 'TwinBuilderSimulator',
+     ['reset', 'load_twin', 'rewind_twin', 'warm_up', 'get_state', 'episode_start', 'step_values', 'episode_step',
+      'episode_finish'], 'simulator'),
+    (__package__ + '.ZygoteTwinBuilderSimulator', 'ZygoteTwinBuilderSimulator',
+     ['reset', 'get_zygote', 'step_values', 'episode_step', 'episode_finish'], 'simulator'),
+    (__package__ + '.PooledTwinBuilderSimulator', 'PooledTwinBuilderSimulator',
+     ['reset', 'episode_finish'], 'simulator'),
+    (__package__ + '.SharedMemoryTransport', 'SharedMemoryTwinBuilderSimulator',
+     ['episode_start', 'episode_step', 'episode_finish'], 'simulator'),
+]
+
+
+class NullSpan():
+    """ Span returned while profiling is off, entering and leaving it does nothing """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span():
+    __slots__ = ('profiler', 'name', 'category', 'track', 'start')
+
+    def __init__(self, profiler, name, category, track):
+        self.profiler = profiler
+        self.name = name
+        self.category = category
+        self.track = track
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, self.category, self.start, time.perf_counter_ns(), self.track)
+        return False
+
+
+class Profiler():
+    """
+    Records spans (name, category, start, end, thread) in a ring buffer of the last buffer_size spans while enabled.
+    Enabling instruments the methods of PROFILED_METHODS with timing wrappers, disabling restores the original
+    methods, so that nothing but the few explicit spans of the session loop (one attribute check each) remains on
+    the hot path when profiling is off. With a sample_interval, a background thread also samples the stacks of
+    every thread, dumped as collapsed stacks for flame graphs.
+    """
+    def __init__(self, buffer_size: int = 200000, output_dir: str = None):
+        self.enabled = False
+        self.spans = deque(maxlen=buffer_size)
+        self.output_dir = output_dir or os.environ.get('TWIN_PROFILE_DIR') or tempfile.gettempdir()
+        self.originals = []
+        self.thread_names = {}
+        self.samples = Counter()
+        self.sample_interval = None
+        self.sampler = None
+        self.sampling = threading.Event()
+        self.lock = threading.RLock()
+
+    def span(self, name: str, category: str = 'session', track: str = None):
+        """
+        Context manager recording its block as a span of the current thread, or of track when given: the sessions
+        of one event loop each get their own track, as their spans interleave on the same thread.
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, category, track)
+
+    def record(self, name, category, start_ns, end_ns, track=None):
+        if track is None:
+            track = threading.get_ident()
+            if track not in self.thread_names:
+                # Named now, as executor threads may be gone by the time the profile is written
+                self.thread_names[track] = threading.current_thread().name
+        self.spans.append((name, category, start_ns, end_ns, track))
+
+    def enable(self, sample_interval: float = None):
+        with self.lock:
+            if self.enabled:
+                return
+            self.instrument()
+            self.enabled = True
+            if sample_interval:
+                self.sample_interval = sample_interval
+                self.sampling.set()
+                self.sampler = threading.Thread(target=self.sample_stacks, name="ProfileSampler", daemon=True)
+                self.sampler.start()
+        logger.info("Profiling enabled%s", " with stack sampling every {}s".format(sample_interval)
+                    if sample_interval else "")
+
+    def disable(self):
+        with self.lock:
+            if not self.enabled:
+                return
+            self.enabled = False
+            self.sampling.clear()
+            for owner, name, original in reversed(self.originals):
+                setattr(owner, name, original)
+            self.originals = []
+        if self.sampler is not None:
+            self.sampler.join()
+            self.sampler = None
+        logger.info("Profiling disabled")
+
+    def instrument(self):
+        for module_name, class_name, method_names, category in PROFILED_METHODS:
+            module = sys.modules.get(module_name)
+            owner = getattr(module, class_name, None)
+            if owner is None:
+                continue
+            for method_name in method_names:
+                # Only the methods the class defines itself, inherited ones are wrapped on their own class
+                original = owner.__dict__.get(method_name)
+                if original is None:
+                    continue
+                setattr(owner, method_name, self.timed(original, '{}.{}'.format(class_name, method_name), category))
+                self.originals.append((owner, method_name, original))
+
+    def timed(self, function, name, category):
+        record = self.record
+
+        @functools.wraps(function)
+        def timed_function(*args, **kwargs):
+            start = time.perf_counter_ns()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(name, category, start, time.perf_counter_ns())
+        return timed_function
+
+    def sample_stacks(self):
+        own_thread = threading.get_ident()
+        while self.sampling.is_set():
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename),
+                                                     code.co_firstlineno))
+                    frame = frame.f_back
+                self.samples[';'.join(reversed(stack))] += 1
+            time.sleep(self.sample_interval)
+
+    def chrome_trace(self):
+        """ The buffered spans as a Chrome trace event dictionary, loadable in Perfetto or chrome://tracing """
+        pid = os.getpid()
+        thread_names = dict(self.thread_names)
+        events = []
+        thread_ids = {}
+        for name, category, start_ns, end_ns, track in list(self.spans):
+            thread_id = thread_ids.get(track)
+            if thread_id is None:
+                # Named tracks get small ids of their own, threads keep their ident
+                thread_id = thread_ids[track] = track if isinstance(track, int) else len(thread_ids) + 1
+                thread_names.setdefault(thread_id, track)
+            events.append({'name': name, 'cat': category, 'ph': 'X', 'ts': start_ns / 1000.0,
+                           'dur': (end_ns - start_ns) / 1000.0, 'pid': pid, 'tid': thread_id})
+        for thread_id in thread_ids.values():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': thread_id,
+                           'args': {'name': str(thread_names.get(thread_id, thread_id))}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def dump(self, path: str = None) -> str:
+        """ Writes the Chrome trace, and the collapsed stack samples next to it if any, returns the trace path """
+        if path is None:
+            path = os.path.join(self.output_dir, 'twin_profile-{}-{}.json'.format(
+                os.getpid(), time.strftime("%Y%m%d-%H%M%S")))
+        with open(path, 'w') as trace_file:
+            json.dump(self.chrome_trace(), trace_file)
+        samples = dict(self.samples)
+        if samples:
+            with open(os.path.splitext(path)[0] + '.folded', 'w') as samples_file:
+                for stack, count in sorted(samples.items()):
+                    samples_file.write('{} {}\n'.format(stack, count))
+        logger.info("Profile of %d spans written to %s", len(self.spans), path)
+        return path
+
+    def finish(self):
+        """ Disables profiling and writes the profile, when it is on """
+        if self.enabled:
+            self.disable()
+            self.dump()
+
+    def reset_after_fork(self):
+        # The sampler thread does not exist in a forked child, and the lock may have been held while forking
+        self.lock = threading.RLock()
+        self.sampler = None
+        self.sampling.clear()
+
+    def toggle(self, sample_interval: float = None):
+        """ Enables profiling, or disables it and dumps the profile in the background """
+        if not self.enabled:
+            self.spans.clear()
+            self.thread_names.clear()
+            self.samples.clear()
+            self.enable(sample_interval)
+        else:
+            self.disable()
+            threading.Thread(target=self.dump, name="ProfileDump", daemon=True).start()
+
+
+# Profiler of this process
+profiler = Profiler(int(os.environ.get('TWIN_PROFILE_BUFFER', 200000)))
+
+
+def install_profiling_signal(signal_number=getattr(signal, 'SIGUSR1', None)):
+    """
+    Lets `kill -USR1 <pid>` switch profiling on, and a second one switch it off and write the profile to
+    TWIN_PROFILE_DIR. TWIN_PROFILE=1 enables profiling at once, and TWIN_PROFILE_SAMPLE_MS turns on stack sampling;
+    a profile still on when the process exits is written then. Must be called from the main thread.
+    """
+    sample_ms = float(os.environ.get('TWIN_PROFILE_SAMPLE_MS') or 0)
+    sample_interval = sample_ms / 1000.0 if sample_ms > 0 else None
+    if signal_number is not None:
+        signal.signal(signal_number, lambda signal_number, frame: profiler.toggle(sample_interval))
+    if os.environ.get('TWIN_PROFILE', '') not in ('', '0'):
+        profiler.enable(sample_interval)
+
+
+atexit.register(profiler.finish)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=profiler.reset_after_fork)
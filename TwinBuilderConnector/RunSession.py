@@ -7,67 +7,161 @@ import os
 import sys
 import logging
 import json
-from typing import Dict, List
-
-from azure.core.exceptions import HttpResponseError
-from microsoft_bonsai_api.simulator.client import BonsaiClient, BonsaiClientConfig
-from microsoft_bonsai_api.simulator.generated.models import (
-    SimulatorInterface,
-    SimulatorState,
-    SimulatorSessionResponse,
-)
+import random
+import threading
+from typing import TYPE_CHECKING, Dict, List
+
 import time
-import argparse
-import datetime
 
+from .ConnectorLogging import step_logger
+from .Metrics import metrics
+from .Profiling import profiler
+from .StartupTimeline import startup
 from .TwinBuilderSimulator import TwinBuilderSimulator
 
+if TYPE_CHECKING:
+    # Imported by import_bonsai_client while the twin loads, see RunSession
+    from microsoft_bonsai_api.simulator.client import BonsaiClient, BonsaiClientConfig
+    from microsoft_bonsai_api.simulator.generated.models import SimulatorInterface, SimulatorSessionResponse
+
+ADVANCE_SECONDS = metrics.histogram('advance_seconds', 'Time in client.session.advance, the Bonsai round trip')
+EPISODE_STEP_SECONDS = metrics.histogram('episode_step_seconds', 'Time in the simulator episode_step')
+EPISODE_FINISH_SECONDS = metrics.histogram('episode_finish_seconds', 'Time in the simulator episode_finish')
+EPISODES = metrics.counter('episodes_total', 'Episodes started')
+STEPS = metrics.counter('steps_total', 'Episode steps')
+HALTS = metrics.counter('halts_total', 'Episodes finished with the simulator halted')
+RECONNECTS = metrics.counter('reconnects_total', 'Sessions registered again after a failure or an unregister')
+ADVANCE_ERRORS = metrics.counter('advance_errors_total', 'Failed advance calls')
+
+logger = logging.getLogger(__name__)
+
+def import_bonsai_client():
+    """ Imports the Bonsai client, which takes about as long as loading the twin, with which it overlaps """
+    with startup.phase('bonsai_import'):
+        import azure.core.exceptions
+        import microsoft_bonsai_api.simulator.client
+        import microsoft_bonsai_api.simulator.generated.models
+
 def CreateSession(
-    client: BonsaiClient, registration_info: SimulatorInterface, config_client: BonsaiClientConfig
+    client: 'BonsaiClient', registration_info: 'SimulatorInterface', config_client: 'BonsaiClientConfig'
 ):
     """Creates a new Simulator Session and returns new session, sequenceId
     """
+    from azure.core.exceptions import HttpResponseError
 
     try:
-        print(
-            "config: {}, {}".format(config_client.server, config_client.workspace)
-        )
+        logger.info("config: %s, %s", config_client.server, config_client.workspace)
         registered_session: SimulatorSessionResponse = client.session.create(
             workspace_name=config_client.workspace, body=registration_info
         )
-        print("Registered simulator. {}".format(registered_session.session_id))
+        logger.info("Registered simulator. %s", registered_session.session_id)
 
         return registered_session, 1
     except HttpResponseError as ex:
-        print(
-            "HttpResponseError in Registering session: StatusCode: {}, Error: {}, Exception: {}".format(
-                ex.status_code, ex.error.message, ex
-            )
+        logger.error(
+            "HttpResponseError in Registering session: StatusCode: %s, Error: %s, Exception: %s",
+            ex.status_code, ex.error.message if ex.error else ex.message, ex
         )
         raise ex
     except Exception as ex:
-        print(
-            "UnExpected error: {}, Most likely, it's some network connectivity issue, make sure you are able to reach bonsai platform from your network.".format(
-                ex
-            )
+        logger.error(
+            "UnExpected error: %s, Most likely, it's some network connectivity issue, make sure you are able to reach bonsai platform from your network.",
+            ex
         )
         raise ex
 
+class SessionRecovery():
+    """
+    Re-registers the simulator session after a failure, retrying with jittered exponential backoff: the delay before
+    retry n is drawn uniformly between 0 and min(max_delay, base_delay * 2 ** n). Counts the reconnects and the
+    time lost from the failure until the new session is registered.
+    """
+    def __init__(self, base_delay: float = 1.0, max_delay: float = 60.0, max_attempts: int = None):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.stats = {'reconnects': 0, 'failed_attempts': 0, 'seconds_lost': 0.0}
+
+    def retry_delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def failed_attempt(self, attempt: int, err) -> float:
+        """ Records a failed registration, returns the delay before the next one or raises once out of attempts """
+        self.stats['failed_attempts'] += 1
+        if self.max_attempts is not None and attempt + 1 >= self.max_attempts:
+            raise err
+        delay = self.retry_delay(attempt)
+        logger.warning("Registering the simulator failed (%s), retrying in %.1fs", err, delay)
+        return delay
+
+    def reconnected(self, failed_at: float):
+        lost = time.perf_counter() - failed_at
+        self.stats['reconnects'] += 1
+        self.stats['seconds_lost'] += lost
+        RECONNECTS.inc()
+        logger.info("Reconnected in %.1fs, %d reconnects and %.1fs lost so far",
+                    lost, self.stats['reconnects'], self.stats['seconds_lost'])
+
+    def reconnect(self, create_session, failed_at: float):
+        attempt = 0
+        while True:
+            try:
+                result = create_session()
+            except Exception as err:
+                time.sleep(self.failed_attempt(attempt, err))
+                attempt += 1
+                continue
+            self.reconnected(failed_at)
+            return result
+
+
+def DeleteSession(client: 'BonsaiClient', registered_session: 'SimulatorSessionResponse',
+                  config_client: 'BonsaiClientConfig'):
+    """Deletes the session if the platform still knows it, errors are ignored
+    """
+    try:
+        client.session.delete(
+            workspace_name=config_client.workspace,
+            session_id=registered_session.session_id,
+        )
+    except Exception as ex:
+        logger.warning("Could not delete session %s: %s", registered_session.session_id, ex)
+
 def RunSession(twin_model_file,
                state_variable_names: List,
                action_variable_names: List,
-               number_of_warm_up_steps, warm_up_action_variable_values: List):
-    # Configure client to interact with Bonsai service
-    config_client = BonsaiClientConfig()
-    client = BonsaiClient(config_client)
+               number_of_warm_up_steps, warm_up_action_variable_values: List,
+               simulator_class=TwinBuilderSimulator, episode_callback=None, recovery: SessionRecovery = None,
+               **simulator_options):
+    """
+    Runs the simulator session until it is interrupted. When an episode_callback is given it is called with the
+    episode count and the number of steps of the episode after each episode finishes; returning True ends the
+    session gracefully.
+    When advancing fails or the platform unregisters the session, a new session is registered through recovery
+    with the same client (and connection pool) while the simulator and its warm twin are kept for the next episode.
+    """
+    recovery = recovery or SessionRecovery()
+    # Load json file as simulator integration config type file. Read before any twin loads: TwinOpen changes the
+    # working directory for a moment, which breaks relative paths opened meanwhile (by a pool's background load)
+    with open("interface.json") as file:
+        interface = json.load(file)
+
+    # The Bonsai client is imported on a thread while the twin loads (ctypes releases the GIL in the SDK calls)
+    bonsai_import = threading.Thread(target=import_bonsai_client, name="BonsaiImport", daemon=True)
+    bonsai_import.start()
 
     # Create simulator session and init sequence id
-    sim = TwinBuilderSimulator(twin_model_file, state_variable_names, action_variable_names,
-                               number_of_warm_up_steps, warm_up_action_variable_values)
+    sim = simulator_class(twin_model_file, state_variable_names, action_variable_names,
+                          number_of_warm_up_steps, warm_up_action_variable_values, **simulator_options)
 
-    # Load json file as simulator integration config type file
-    with open("interface.json") as file:
-        interface = json.load(file)
+    bonsai_import.join()
+    from azure.core.exceptions import HttpResponseError
+    from microsoft_bonsai_api.simulator.client import BonsaiClient, BonsaiClientConfig
+    from microsoft_bonsai_api.simulator.generated.models import SimulatorInterface, SimulatorState
+
+    # Configure client to interact with Bonsai service
+    config_client = BonsaiClientConfig()
+    client = BonsaiClient(config_client)
 
     # Create simulator session and init sequence id
     registration_info = SimulatorInterface(
@@ -76,85 +170,115 @@ def RunSession(twin_model_file,
         simulator_context=config_client.simulator_context,
         description=interface["description"],
     )
-    registered_session, sequence_id = CreateSession(client, registration_info, config_client)
+    with startup.phase('session_create'):
+        registered_session, sequence_id = CreateSession(client, registration_info, config_client)
+
+    def recover(failed_at):
+        DeleteSession(client, registered_session, config_client)
+        return recovery.reconnect(lambda: CreateSession(client, registration_info, config_client), failed_at)
 
     episode = 0
+    episode_started = time.perf_counter()
     iteration = 0
+    stop = False
 
     try:
-        while True:
+        while not stop:
             # Advance by the new state depending on the event type
             # TODO: it's risky not doing doing `get_state` without first initializing the sim
             sim_state = SimulatorState(
                 sequence_id=sequence_id, state=sim.get_state(), halted=sim.halted(),
             )
+            advance_started = time.perf_counter()
             try:
-                event = client.session.advance(
-                    workspace_name=config_client.workspace,
-                    session_id=registered_session.session_id,
-                    body=sim_state,
-                )
+                with profiler.span('advance', 'bonsai'):
+                    event = client.session.advance(
+                        workspace_name=config_client.workspace,
+                        session_id=registered_session.session_id,
+                        body=sim_state,
+                    )
+                ADVANCE_SECONDS.observe(time.perf_counter() - advance_started)
+                startup.finish()
                 sequence_id = event.sequence_id
-                print(
-                    "[{}] Last Event: {}".format(time.strftime("%H:%M:%S"), event.type)
-                )
+                step_logger.debug("Last Event: %s", event.type, extra={'event': event.type, 'episode': episode})
             except HttpResponseError as ex:
-                print(
-                    "HttpResponseError in Advance: StatusCode: {}, Error: {}, Exception: {}".format(
-                        ex.status_code, ex.error.message, ex
-                    )
+                ADVANCE_ERRORS.inc()
+                logger.error(
+                    "HttpResponseError in Advance: StatusCode: %s, Error: %s, Exception: %s",
+                    ex.status_code, ex.error.message if ex.error else ex.message, ex
                 )
                 # This can happen in network connectivity issue, though SDK has retry logic, but even after that request may fail,
                 # if your network has some issue, or sim session at platform is going away..
                 # So let's re-register sim-session and get a new session and continue iterating. :-)
-                registered_session, sequence_id = CreateSession(
-                    registration_info, config_client
-                )
+                registered_session, sequence_id = recover(advance_started)
                 continue
             except Exception as err:
-                print("Unexpected error in Advance: {}".format(err))
+                ADVANCE_ERRORS.inc()
+                logger.error("Unexpected error in Advance: %s", err)
                 # Ideally this shouldn't happen, but for very long-running sims It can happen with various reasons, let's re-register sim & Move on.
                 # If possible try to notify Bonsai team to see, if this is platform issue and can be fixed.
-                registered_session, sequence_id = CreateSession(
-                    registration_info, config_client
-                )
+                registered_session, sequence_id = recover(advance_started)
                 continue
 
             # Event loop
-            if event.type == "Idle":
-                time.sleep(event.idle.callback_time)
-                print("Idling...")
-            elif event.type == "EpisodeStart":
-                print(f"Episode Starting with config {event.episode_start.config}")
-                sim.episode_start(event.episode_start.config)
-                episode += 1
-            elif event.type == "EpisodeStep":
-                print(f"Stepping iteration {iteration} with action {event.episode_step.action}")
-                iteration += 1
-                sim.episode_step(event.episode_step.action)
-            elif event.type == "EpisodeFinish":
-                print("Episode Finishing")
-                sim.episode_finish()
-                iteration = 0
-            elif event.type == "Unregister":
-                print("Simulator Session unregistered by platform, Registering again!")
-                registered_session, sequence_id = CreateSession(
-                    registration_info, config_client
-                )
-                continue
-            else:
-                pass
+            with profiler.span(event.type, 'event'):
+                if event.type == "Idle":
+                    time.sleep(event.idle.callback_time)
+                    step_logger.debug("Idling...")
+                elif event.type == "EpisodeStart":
+                    logger.info("Episode %d starting with config %s", episode + 1, event.episode_start.config)
+                    sim.episode_start(event.episode_start.config)
+                    episode += 1
+                    episode_started = time.perf_counter()
+                    EPISODES.inc()
+                elif event.type == "EpisodeStep":
+                    step_logger.debug("Stepping iteration %d with action %s", iteration, event.episode_step.action,
+                                      extra={'episode': episode, 'step': iteration})
+                    iteration += 1
+                    with EPISODE_STEP_SECONDS.time():
+                        sim.episode_step(event.episode_step.action)
+                    STEPS.inc()
+                elif event.type == "EpisodeFinish":
+                    halted = sim.halted()
+                    if halted:
+                        HALTS.inc()
+                    with EPISODE_FINISH_SECONDS.time():
+                        sim.episode_finish()
+                    seconds = time.perf_counter() - episode_started
+                    logger.info("Episode %d finished%s: %d steps in %.2fs", episode, " (halted)" if halted else "",
+                                iteration, seconds, extra={'episode': episode, 'steps': iteration, 'seconds': seconds})
+                    if episode_callback is not None:
+                        stop = episode_callback(episode, iteration)
+                    iteration = 0
+                elif event.type == "Unregister":
+                    logger.warning("Simulator Session unregistered by platform, Registering again!")
+                    registered_session, sequence_id = recovery.reconnect(
+                        lambda: CreateSession(client, registration_info, config_client), time.perf_counter()
+                    )
+                    continue
+                else:
+                    pass
     except KeyboardInterrupt:
         # Gracefully unregister with keyboard interrupt
         client.session.delete(
             workspace_name=config_client.workspace,
             session_id=registered_session.session_id,
         )
-        print("Unregistered simulator.")
+        sim.close()
+        logger.info("Unregistered simulator.")
     except Exception as err:
         # Gracefully unregister for any other exceptions
         client.session.delete(
             workspace_name=config_client.workspace,
             session_id=registered_session.session_id,
         )
-        print("Unregistered simulator because: {}".format(err))
+        sim.close()
+        logger.error("Unregistered simulator because: %s", err)
+    else:
+        # Ended by the episode callback
+        client.session.delete(
+            workspace_name=config_client.workspace,
+            session_id=registered_session.session_id,
+        )
+        sim.close()
+        logger.info("Unregistered simulator.")
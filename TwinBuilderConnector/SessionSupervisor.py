@@ -0,0 +1,271 @@
+"""
+Runs several Bonsai simulator sessions in one container as supervised worker processes, pinned to CPUs, restarted with backoff when they crash and recycled after a number of episodes or past a memory threshold.
+Copyright 2021, Microsoft Corp.
+"""
+
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import time
+from typing import List
+
+from .ConnectorLogging import stop_logging
+from .Metrics import start_metrics_exporter
+from .Profiling import install_profiling_signal, profiler
+from .StartupTimeline import startup
+from .RunSession import RunSession
+
+# Exit code of a worker that stopped to be recycled, any other exit is a crash
+RECYCLE_EXIT_CODE = 0
+
+logger = logging.getLogger(__name__)
+
+def current_rss_bytes() -> int:
+    """ Resident set size of the current process """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        # Peak resident set size, in kilobytes on Linux and in bytes on macOS
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def worker_metrics_options(metrics_options, worker_index):
+    """ Exporter settings of one worker: each worker serves the port after the previous one and writes its own file """
+    port = metrics_options.get('port')
+    path = metrics_options.get('path')
+    if path is not None:
+        root, extension = os.path.splitext(path)
+        path = '{}-worker{}{}'.format(root, worker_index, extension)
+    return {'port': port + worker_index if port is not None else None, 'path': path,
+            'interval': metrics_options.get('interval', 15.0), 'worker': worker_index}
+
+
+def run_worker(worker_index, cpu, session_args, session_options, max_episodes, max_rss_bytes, messages,
+               metrics_options=None):
+    """ Worker process: runs one simulator session, reporting each episode, until it has to be recycled """
+    # Only the supervisor stops the workers, with SIGTERM, so that a Ctrl+C does not interrupt their unregistering
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, interrupt_once)
+    startup.restart()
+    if cpu is not None:
+        os.sched_setaffinity(0, {cpu})
+    if metrics_options:
+        start_metrics_exporter(**worker_metrics_options(metrics_options, worker_index))
+    install_profiling_signal()
+
+    recycle = []
+    last_finish = [time.perf_counter()]
+
+    def episode_finished(episode, steps):
+        now = time.perf_counter()
+        rss = current_rss_bytes()
+        messages.put(('episode', worker_index, steps, now - last_finish[0], rss))
+        last_finish[0] = now
+
+        if max_episodes and episode >= max_episodes:
+            recycle.append('{} episodes'.format(episode))
+        elif max_rss_bytes and rss > max_rss_bytes:
+            recycle.append('RSS {:.0f} MB'.format(rss / 2 ** 20))
+        return bool(recycle)
+
+    RunSession(*session_args, episode_callback=episode_finished, **session_options)
+    # Multiprocessing workers skip the atexit handlers, write the profile, recorded episodes and queued log
+    # records now
+    profiler.finish()
+    if session_options.get('recorder') is not None:
+        session_options['recorder'].close()
+    stop_logging()
+
+    if not recycle:
+        # RunSession returns after unregistering when the session failed
+        sys.exit(1)
+    messages.put(('recycle', worker_index, recycle[0]))
+    sys.exit(RECYCLE_EXIT_CODE)
+
+
+def interrupt_once(signal_number, frame):
+    """ Turns the first SIGTERM into a KeyboardInterrupt, later ones are ignored while shutting down """
+    signal.signal(signal_number, signal.SIG_IGN)
+    raise KeyboardInterrupt()
+
+
+class WorkerSlot():
+    """ Parent side state of one worker position, kept across restarts """
+    def __init__(self, index, cpu):
+        self.index = index
+        self.cpu = cpu
+        self.process = None
+        self.started_at = None
+        self.restart_at = None
+        self.consecutive_crashes = 0
+        self.stats = {'episodes': 0, 'steps': 0, 'busy_seconds': 0.0, 'restarts': 0, 'crashes': 0, 'recycles': 0,
+                      'rss_bytes': 0}
+        self.interval_steps = 0
+
+
+class SessionSupervisor():
+    """
+    Starts number_of_workers processes, each running RunSession with the given arguments, and keeps them running.
+    A crashed worker is restarted after restart_delay seconds, doubled for each consecutive crash up to
+    max_restart_delay; a worker that ran for healthy_seconds resets that backoff. Workers are recycled (stopped
+    gracefully at the end of an episode and restarted at once) after max_episodes_per_worker episodes or when their
+    resident memory exceeds max_rss_mb. Per-worker and total throughput is printed every report_interval seconds.
+    When metrics_options ({'port', 'path', 'interval'}) are given, every worker exports its metrics, worker i on
+    port + i and to path with a -worker<i> suffix.
+    """
+    def __init__(self, session_args: List, session_options=None, number_of_workers: int = 2,
+                 max_episodes_per_worker: int = None, max_rss_mb: float = None, pin_cpus: bool = True,
+                 restart_delay: float = 1.0, max_restart_delay: float = 60.0, healthy_seconds: float = 60.0,
+                 report_interval: float = 30.0, metrics_options=None):
+        self.session_args = list(session_args)
+        self.session_options = dict(session_options or {})
+        self.max_episodes_per_worker = max_episodes_per_worker
+        self.max_rss_bytes = max_rss_mb * 2 ** 20 if max_rss_mb else None
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.healthy_seconds = healthy_seconds
+        self.report_interval = report_interval
+        self.metrics_options = dict(metrics_options) if metrics_options else None
+
+        # Fork where available so that workers start with the modules already imported by the parent
+        start_methods = multiprocessing.get_all_start_methods()
+        self.context = multiprocessing.get_context('fork' if 'fork' in start_methods else 'spawn')
+        self.messages = self.context.Queue()
+
+        cpus = [None]
+        if pin_cpus and hasattr(os, 'sched_getaffinity'):
+            cpus = sorted(os.sched_getaffinity(0))
+        self.slots = [WorkerSlot(index, cpus[index % len(cpus)]) for index in range(number_of_workers)]
+        self.started_at = None
+        self.last_report = None
+
+    def start_worker(self, slot: WorkerSlot):
+        slot.process = self.context.Process(
+            target=run_worker, name="SimulatorWorker-{}".format(slot.index),
+            args=(slot.index, slot.cpu, self.session_args, self.session_options, self.max_episodes_per_worker,
+                  self.max_rss_bytes, self.messages, self.metrics_options))
+        slot.process.start()
+        slot.started_at = time.monotonic()
+        slot.restart_at = None
+        logger.info("Started worker %d (pid %d) on CPU %s", slot.index, slot.process.pid,
+                    'any' if slot.cpu is None else slot.cpu)
+
+    def check_worker(self, slot: WorkerSlot):
+        now = time.monotonic()
+        if slot.process is None:
+            if slot.restart_at is not None and now >= slot.restart_at:
+                slot.stats['restarts'] += 1
+                self.start_worker(slot)
+            return
+
+        if slot.process.is_alive():
+            if slot.consecutive_crashes and now - slot.started_at >= self.healthy_seconds:
+                slot.consecutive_crashes = 0
+            return
+
+        exit_code = slot.process.exitcode
+        slot.process.join()
+        slot.process = None
+        if exit_code == RECYCLE_EXIT_CODE:
+            slot.restart_at = now
+            return
+
+        slot.stats['crashes'] += 1
+        slot.consecutive_crashes += 1
+        delay = min(self.restart_delay * 2 ** (slot.consecutive_crashes - 1), self.max_restart_delay)
+        slot.restart_at = now + delay
+        logger.warning("Worker %d exited with code %s, restarting in %.1fs", slot.index, exit_code, delay)
+
+    def handle_messages(self, timeout=None):
+        """ Handles the pending worker messages, waiting up to timeout seconds for the first one """
+        try:
+            message = self.messages.get(timeout=timeout) if timeout else self.messages.get_nowait()
+            while True:
+                self.handle_message(message)
+                message = self.messages.get_nowait()
+        except queue.Empty:
+            pass
+
+    def handle_message(self, message):
+        kind, worker_index = message[0], message[1]
+        slot = self.slots[worker_index]
+        if kind == 'episode':
+            _, _, steps, seconds, rss = message
+            slot.stats['episodes'] += 1
+            slot.stats['steps'] += steps
+            slot.stats['busy_seconds'] += seconds
+            slot.stats['rss_bytes'] = rss
+            slot.interval_steps += steps
+        elif kind == 'recycle':
+            slot.stats['recycles'] += 1
+            logger.info("Recycling worker %d after %s", worker_index, message[2])
+
+    def report(self):
+        now = time.monotonic()
+        interval = max(now - self.last_report, 1e-9)
+        uptime = max(now - self.started_at, 1e-9)
+        print("{:>6} {:>8} {:>9} {:>10} {:>9} {:>9} {:>8} {:>8} {:>8}".format(
+            "worker", "pid", "episodes", "steps", "steps/s", "avg/s", "RSS MB", "crashes", "recycles"))
+        for slot in self.slots:
+            print("{:>6} {:>8} {:>9} {:>10} {:>9.1f} {:>9.1f} {:>8.0f} {:>8} {:>8}".format(
+                slot.index, slot.process.pid if slot.process is not None else '-', slot.stats['episodes'],
+                slot.stats['steps'], slot.interval_steps / interval, slot.stats['steps'] / uptime,
+                slot.stats['rss_bytes'] / 2 ** 20, slot.stats['crashes'], slot.stats['recycles']))
+        total_steps = sum(slot.stats['steps'] for slot in self.slots)
+        print("{:>6} {:>8} {:>9} {:>10} {:>9.1f} {:>9.1f}".format(
+            "total", "", sum(slot.stats['episodes'] for slot in self.slots), total_steps,
+            sum(slot.interval_steps for slot in self.slots) / interval, total_steps / uptime))
+        for slot in self.slots:
+            slot.interval_steps = 0
+        self.last_report = now
+
+    def run(self):
+        """ Supervises the workers until interrupted, then stops them gracefully """
+        self.started_at = self.last_report = time.monotonic()
+        for slot in self.slots:
+            self.start_worker(slot)
+
+        # Containers are stopped with SIGTERM
+        signal.signal(signal.SIGTERM, interrupt_once)
+        if hasattr(signal, 'SIGUSR1'):
+            # Profiling is toggled in every worker, each writing its own profile
+            signal.signal(signal.SIGUSR1, self.forward_signal)
+        try:
+            while True:
+                self.handle_messages(timeout=0.5)
+                for slot in self.slots:
+                    self.check_worker(slot)
+                if time.monotonic() - self.last_report >= self.report_interval:
+                    self.report()
+        except KeyboardInterrupt:
+            logger.info("Stopping workers")
+        finally:
+            self.stop()
+            self.report()
+
+    def forward_signal(self, signal_number, frame):
+        for slot in self.slots:
+            if slot.process is not None and slot.process.is_alive():
+                os.kill(slot.process.pid, signal_number)
+
+    def stop(self, timeout: float = 30.0):
+        # Workers turn SIGTERM into a KeyboardInterrupt, on which RunSession unregisters its session
+        running = [slot.process for slot in self.slots if slot.process is not None]
+        for process in running:
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + timeout
+        for process in running:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                process.kill()
+                process.join()
+        for slot in self.slots:
+            slot.process = None
+        self.handle_messages()
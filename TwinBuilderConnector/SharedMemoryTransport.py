@@ -0,0 +1,370 @@
+"""
+Hands the simulator events of a session to a twin running in a worker process through shared memory ring buffers with fixed layouts taken from interface.json, instead of pickling dictionaries of actions and states across a pipe.
+Copyright 2021, Microsoft Corp.
+"""
+
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import signal
+import sys
+import time
+import traceback
+from typing import Dict, List
+
+import numpy as np
+
+from twin_runtime.twin_runtime_error import TwinRuntimeError
+
+from .ConnectorLogging import stop_logging
+from .TwinBuilderSimulator import TwinBuilderSimulator
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python 3.7: anonymous shared memory, inherited by the worker processes only
+    shared_memory = None
+
+logger = logging.getLogger(__name__)
+
+yield_cpu = getattr(os, 'sched_yield', lambda: time.sleep(0))
+
+# The rings publish slots without locks only where 8 byte stores are seen by other CPUs in program order
+ORDERED_STORES = platform.machine().lower() in ('x86_64', 'amd64', 'x86', 'i386', 'i686')
+
+# Request kinds, in the first value of a request slot
+START_EPISODE = 1.0
+STEP_EPISODE = 2.0
+FINISH_EPISODE = 3.0
+STOP_WORKER = 4.0
+
+# Response statuses, in the first value of a response slot
+RESPONSE_OK = 0.0
+RESPONSE_ERROR = 1.0
+
+
+class InterfaceLayout():
+    """
+    Fixed layouts of the request and response slots, from the action, config and state fields of a simulator
+    interface. A request holds its kind, the action values and the config values (NaN when not given); a response
+    holds its status, the halted flag, the state values (NaN for the ones the simulator does not have) and the
+    time index of the state. Only Number fields fit in a slot.
+    """
+    def __init__(self, action_names: List, state_names: List, config_names: List = ()):
+        self.action_names = list(action_names)
+        self.state_names = list(state_names)
+        self.config_names = list(config_names)
+        self.request_size = 1 + len(self.action_names) + len(self.config_names)
+        self.response_size = 2 + len(self.state_names) + 1
+
+    @classmethod
+    def from_interface(cls, interface) -> 'InterfaceLayout':
+        """ Layout of an interface.json file path or of its loaded content """
+        if isinstance(interface, str):
+            with open(interface) as file:
+                interface = json.load(file)
+        description = interface['description']
+
+        def field_names(schema):
+            names = []
+            for field in (description.get(schema) or {}).get('fields', []):
+                if field['type']['category'] != 'Number':
+                    raise ValueError("The {} field {} is a {}, shared memory slots only hold Number fields".format(
+                        schema, field['name'], field['type']['category']))
+                names.append(field['name'])
+            return names
+
+        return cls(field_names('action'), field_names('state'), field_names('config'))
+
+
+class SpscRing():
+    """
+    Single producer, single consumer ring of capacity fixed size slots of float64 values in a shared buffer. The
+    producer only writes the head counter and the consumer only the tail counter, each on its own cache line, and a
+    slot is written before the counter that publishes it, so neither side takes a lock: this relies on aligned
+    8 byte stores being atomic and kept in order, as they are on x86-64. Elsewhere (ARM, POWER) a lock shared by
+    both sides is given, whose acquire and release are the memory barriers ordering the slot and counter accesses.
+    Waiting sides spin, yielding the CPU, for spin_seconds and then sleep in increasing intervals up to max_sleep.
+    """
+    HEADER_BYTES = 128
+
+    def __init__(self, buffer, capacity: int, slot_size: int, offset: int = 0, spin_seconds: float = 0.0002,
+                 max_sleep: float = 0.001, lock=None):
+        self.capacity = capacity
+        self.slot_size = slot_size
+        self.counters = np.ndarray((self.HEADER_BYTES // 8,), dtype=np.uint64, buffer=buffer, offset=offset)
+        self.slots = np.ndarray((capacity, slot_size), dtype=np.float64, buffer=buffer,
+                                offset=offset + self.HEADER_BYTES)
+        self.spin_seconds = spin_seconds
+        self.max_sleep = max_sleep
+        self.lock = lock
+        if lock is not None:
+            self.try_put = self.locked(self.try_put)
+            self.try_get = self.locked(self.try_get)
+
+    def locked(self, attempt):
+        def locked_attempt(values):
+            with self.lock:
+                return attempt(values)
+        return locked_attempt
+
+    @classmethod
+    def buffer_size(cls, capacity: int, slot_size: int) -> int:
+        return cls.HEADER_BYTES + capacity * slot_size * 8
+
+    def try_put(self, values) -> bool:
+        counters = self.counters
+        head = int(counters[0])
+        if head - int(counters[8]) >= self.capacity:
+            return False
+        self.slots[head % self.capacity] = values
+        counters[0] = head + 1
+        return True
+
+    def try_get(self, out) -> bool:
+        counters = self.counters
+        tail = int(counters[8])
+        if tail == int(counters[0]):
+            return False
+        out[:] = self.slots[tail % self.capacity]
+        counters[8] = tail + 1
+        return True
+
+    def put(self, values, timeout: float = None, alive=None):
+        self.wait(lambda: self.try_put(values), timeout, alive)
+
+    def get(self, out, timeout: float = None, alive=None):
+        self.wait(lambda: self.try_get(out), timeout, alive)
+
+    def wait(self, attempt, timeout, alive):
+        """ Retries attempt until it succeeds, raising TimeoutError after timeout or once alive() is False """
+        if attempt():
+            return
+        start = time.perf_counter()
+        spin_until = start + self.spin_seconds
+        while time.perf_counter() < spin_until:
+            yield_cpu()
+            if attempt():
+                return
+        sleep = 0.00005
+        while not attempt():
+            if timeout is not None and time.perf_counter() - start > timeout:
+                raise TimeoutError("No shared memory slot after {}s".format(timeout))
+            if alive is not None and not alive():
+                raise TimeoutError("The other side of the shared memory ring is gone")
+            time.sleep(sleep)
+            sleep = min(sleep * 2, self.max_sleep)
+
+
+class SharedMemoryChannel():
+    """
+    A request ring and a response ring of a layout in one shared memory block. The block is a
+    multiprocessing.shared_memory segment, or anonymous shared memory on Python 3.7; either way it is inherited
+    by the forked worker processes without copying, and attached again by spawned ones. Each ring takes a lock
+    when locked is set, by default on CPUs that do not keep stores in order (see SpscRing).
+    """
+    def __init__(self, layout: InterfaceLayout, capacity: int = 4, locked: bool = None):
+        self.layout = layout
+        self.capacity = capacity
+        if locked is None:
+            locked = not ORDERED_STORES
+        self.locks = (multiprocessing.Lock(), multiprocessing.Lock()) if locked else (None, None)
+        size = SpscRing.buffer_size(capacity, layout.request_size) + SpscRing.buffer_size(capacity, layout.response_size)
+        if shared_memory is not None:
+            self.memory = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.memory = multiprocessing.RawArray('b', size)
+        self.attach()
+
+    def attach(self):
+        buffer = self.memory.buf if shared_memory is not None else memoryview(self.memory).cast('B')
+        self.requests = SpscRing(buffer, self.capacity, self.layout.request_size, lock=self.locks[0])
+        self.responses = SpscRing(buffer, self.capacity, self.layout.response_size,
+                                  offset=SpscRing.buffer_size(self.capacity, self.layout.request_size),
+                                  lock=self.locks[1])
+
+    def __getstate__(self):
+        # The segment is pickled by name, the rings are views of it
+        return {'layout': self.layout, 'capacity': self.capacity, 'locks': self.locks, 'memory': self.memory}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.attach()
+
+    def close(self, unlink: bool = True):
+        # The views go first, a segment with exported buffers cannot be closed
+        self.requests = self.responses = None
+        if shared_memory is not None and isinstance(self.memory, shared_memory.SharedMemory):
+            self.memory.close()
+            if unlink:
+                self.memory.unlink()
+        self.memory = None
+
+
+def serve_simulator(channel: SharedMemoryChannel, simulator_args: List, simulator_options: Dict, parent_pid: int):
+    """
+    Worker process: runs the requests of the channel on its own simulator until a stop request, or until the parent
+    process is gone. A failed request is answered with an error status, its traceback going to the worker's stderr.
+    When the simulator cannot be built, every request is answered with an error status.
+    """
+    # The parent stops the worker with a stop request, after a Ctrl+C too
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    layout = channel.layout
+    simulator_options = dict(simulator_options)
+    simulator_class = simulator_options.pop('simulator_class', TwinBuilderSimulator)
+    action_variable_names = simulator_args[2]
+    action_columns = 1 + np.array([layout.action_names.index(name) for name in action_variable_names], dtype=int)
+    config_start = 1 + len(layout.action_names)
+    request = np.empty(layout.request_size)
+    response = np.empty(layout.response_size)
+    state_names = layout.state_names + ['time_index']
+
+    def parent_alive():
+        return os.getppid() == parent_pid
+
+    simulator = None
+    try:
+        try:
+            simulator = simulator_class(*simulator_args, **simulator_options)
+        except Exception:
+            traceback.print_exc()
+
+        while True:
+            try:
+                channel.requests.get(request, alive=parent_alive)
+            except TimeoutError:
+                return
+            kind = request[0]
+            if kind == STOP_WORKER:
+                return
+
+            if simulator is None:
+                response[0] = RESPONSE_ERROR
+                response[1] = True
+                response[2:] = np.nan
+                channel.responses.put(response, alive=parent_alive)
+                continue
+
+            response[0] = RESPONSE_OK
+            try:
+                if kind == STEP_EPISODE:
+                    simulator.episode_step(dict(zip(action_variable_names, request[action_columns].tolist())))
+                elif kind == START_EPISODE:
+                    simulator.episode_start({name: value for name, value in
+                                             zip(layout.config_names, request[config_start:].tolist())
+                                             if value == value})
+                elif kind == FINISH_EPISODE:
+                    simulator.episode_finish()
+            except Exception:
+                traceback.print_exc()
+                response[0] = RESPONSE_ERROR
+            state = simulator.state
+            response[1] = simulator.halted()
+            response[2:] = [state.get(name, np.nan) for name in state_names]
+            channel.responses.put(response, alive=parent_alive)
+    finally:
+        if simulator is not None:
+            simulator.close()
+        if simulator_options.get('recorder') is not None:
+            simulator_options['recorder'].close()
+        stop_logging()
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+
+class SharedMemoryTwinBuilderSimulator():
+    """
+    Simulator running a TwinBuilderSimulator (or worker_simulator_class) in a worker process, for a session loop
+    such as RunSession. Every event is one request slot written to shared memory and one response slot read back,
+    in the layout of interface_file, instead of dictionaries pickled across a pipe. Actions and configs outside
+    the layout are ignored. The worker starts with the process, forked where available, and stops on close.
+    """
+    def __init__(self, twin_model_file, state_variable_names: List,
+                 action_variable_names: List,
+                 number_of_warm_up_steps, warm_up_action_variable_values: List,
+                 interface_file: str = 'interface.json', worker_simulator_class=TwinBuilderSimulator,
+                 ring_capacity: int = 4, **simulator_options):
+        self.state_variable_names = state_variable_names
+        self.action_variable_names = action_variable_names
+        self.layout = InterfaceLayout.from_interface(interface_file)
+        missing = [name for name in action_variable_names if name not in self.layout.action_names]
+        if missing:
+            raise ValueError("The actions {} are not in the action fields of {}".format(missing, interface_file))
+        self.channel = SharedMemoryChannel(self.layout, ring_capacity)
+        self.request = np.full(self.layout.request_size, np.nan)
+        self.response = np.empty(self.layout.response_size)
+        self.action_columns = {name: 1 + index for index, name in enumerate(self.layout.action_names)}
+        self.config_columns = {name: 1 + len(self.layout.action_names) + index
+                               for index, name in enumerate(self.layout.config_names)}
+        self.state = {}
+        self.done = False
+
+        simulator_options['simulator_class'] = worker_simulator_class
+        start_methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('fork' if 'fork' in start_methods else 'spawn')
+        self.process = context.Process(
+            target=serve_simulator, name="SimulatorWorker", daemon=True,
+            args=(self.channel, [twin_model_file, state_variable_names, action_variable_names,
+                                 number_of_warm_up_steps, warm_up_action_variable_values],
+                  simulator_options, os.getpid()))
+        self.process.start()
+
+    def call(self, kind: float):
+        """ Sends the request being built, waits for its response and reads the state from it """
+        self.request[0] = kind
+        self.channel.requests.put(self.request, alive=self.process.is_alive)
+        try:
+            self.channel.responses.get(self.response, alive=self.process.is_alive)
+        except TimeoutError:
+            self.done = True
+            raise TwinRuntimeError("The simulator worker process {} exited".format(self.process.pid))
+        response = self.response.tolist()
+        self.done = bool(response[1])
+        self.state = dict(zip(self.layout.state_names + ['time_index'], response[2:]))
+        if response[0] == RESPONSE_ERROR:
+            self.done = True
+            raise TwinRuntimeError("The simulator worker process {} failed, see its output for details".format(
+                self.process.pid))
+
+    def get_state(self) -> Dict[str, float]:
+        return self.state
+
+    def halted(self) -> bool:
+        return self.done
+
+    def episode_start(self, config: Dict = None) -> None:
+        request = self.request
+        request[1:] = np.nan
+        for name, value in (config or {}).items():
+            column = self.config_columns.get(name)
+            if column is not None and isinstance(value, (int, float)):
+                request[column] = value
+        self.call(START_EPISODE)
+
+    def episode_step(self, action: Dict):
+        request = self.request
+        for name, column in self.action_columns.items():
+            request[column] = action.get(name, np.nan)
+        self.call(STEP_EPISODE)
+
+    def episode_finish(self):
+        self.call(FINISH_EPISODE)
+
+    def close(self):
+        """ Stops the worker process and releases the shared memory """
+        if self.process is None:
+            return
+        if self.process.is_alive():
+            self.request[0] = STOP_WORKER
+            try:
+                self.channel.requests.put(self.request, timeout=5.0, alive=self.process.is_alive)
+            except TimeoutError:
+                pass
+            self.process.join(10.0)
+            if self.process.is_alive():
+                self.process.terminate()
+                self.process.join()
+        self.process = None
+        self.channel.close()
@@ -0,0 +1,78 @@
+"""
+Timeline of the connector start-up, from the imports to the first advance: twin runtime library load, twin open, instantiate, initialize, warm-up, Bonsai client import and session creation.
+Copyright 2021, Microsoft Corp.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from .Profiling import NULL_SPAN, Span, profiler
+
+logger = logging.getLogger(__name__)
+
+
+class StartupTimeline():
+    """
+    Start and duration of each start-up phase, relative to origin (the import of this module unless given), until
+    finish is called on the first advance. Only the first occurrence of a phase is kept: later twin loads and
+    sessions are not part of the start-up. Phases are also recorded as profiler spans when profiling is on.
+    """
+    def __init__(self, origin_ns: int = None):
+        self.origin = origin_ns or time.perf_counter_ns()
+        self.phases = OrderedDict()
+        self.finished_at = None
+        self.lock = threading.Lock()
+
+    def restart(self):
+        """ Starts the timeline over from now, in a new worker process """
+        with self.lock:
+            self.origin = time.perf_counter_ns()
+            self.phases = OrderedDict()
+            self.finished_at = None
+
+    @property
+    def active(self) -> bool:
+        return self.finished_at is None
+
+    def phase(self, name: str):
+        """ Context manager recording its block as the start-up phase name """
+        if self.finished_at is not None:
+            return NULL_SPAN
+        return Span(self, name, 'startup', None)
+
+    def mark(self, name: str):
+        """ Records name as the phase from the origin until now, such as the imports """
+        self.record(name, 'startup', self.origin, time.perf_counter_ns())
+
+    def record(self, name, category, start_ns, end_ns, track=None):
+        with self.lock:
+            if self.finished_at is not None or name in self.phases:
+                return
+            self.phases[name] = (start_ns, end_ns)
+        if profiler.enabled:
+            profiler.record(name, category, start_ns, end_ns, track)
+
+    def finish(self):
+        """ Ends the start-up at the first advance and logs the timeline, once """
+        if self.finished_at is not None:
+            return
+        with self.lock:
+            if self.finished_at is not None:
+                return
+            self.finished_at = time.perf_counter_ns()
+        logger.info("Start-up took %.3fs to the first advance: %s", (self.finished_at - self.origin) / 1e9,
+                    ', '.join('{} {:.3f}s (at {:.3f}s)'.format(name, phase['seconds'], phase['start'])
+                              for name, phase in self.summary().items()))
+
+    def summary(self) -> OrderedDict:
+        """ Phase name -> start and duration in seconds, in the order the phases ended """
+        with self.lock:
+            phases = list(self.phases.items())
+        return OrderedDict((name, {'start': (start - self.origin) / 1e9, 'seconds': (end - start) / 1e9})
+                           for name, (start, end) in phases)
+
+
+# Start-up of this process
+startup = StartupTimeline()
@@ -0,0 +1,277 @@
+"""
+Records the episodes of a simulator (config, per-step actions, states and timings) into preallocated NumPy column buffers, written per episode to partitioned .npz, Parquet or Arrow files by a background thread.
+Copyright 2021, Microsoft Corp.
+"""
+
+import itertools
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+import zipfile
+from collections import OrderedDict, deque
+from typing import Dict, List
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+RECORD_FORMATS = ('npz', 'parquet', 'arrow')
+RECORD_FORMAT_VERSION = 1
+
+
+class EpisodeTrajectory():
+    """
+    Column buffers of one episode: the time index and duration of each step, and the action and state values in
+    Fortran order, so that every column is contiguous. Rows are appended in place; the buffers double when full.
+    """
+    def __init__(self, capacity: int, number_of_actions: int, number_of_states: int, dtype):
+        self.time_index = np.empty(capacity)
+        self.step_seconds = np.empty(capacity)
+        self.actions = np.empty((capacity, number_of_actions), dtype=dtype, order='F')
+        self.states = np.empty((capacity, number_of_states), dtype=dtype, order='F')
+        self.length = 0
+        self.metadata = {}
+
+    def append(self, time_index: float, action_values, state_values, step_seconds: float):
+        if self.length == self.time_index.shape[0]:
+            self.grow()
+        row = self.length
+        self.time_index[row] = time_index
+        self.step_seconds[row] = step_seconds
+        self.actions[row] = action_values
+        self.states[row] = state_values
+        self.length = row + 1
+
+    def grow(self):
+        capacity = 2 * self.time_index.shape[0]
+        for name in ('time_index', 'step_seconds', 'actions', 'states'):
+            column = getattr(self, name)
+            grown = np.empty((capacity,) + column.shape[1:], dtype=column.dtype, order='F')
+            grown[:self.length] = column[:self.length]
+            setattr(self, name, grown)
+
+
+class TrajectoryRecorder():
+    """
+    Records the episodes of any number of simulators of the process. start_episode hands out column buffers,
+    taken from a pool of recycled ones, which the simulator fills step by step; finish_episode queues them for
+    a background thread that writes one file per episode under output_dir/date=<YYYY-MM-DD>/ and then returns
+    them to the pool. The stepping thread never waits on the disk: when max_pending episodes are already
+    queued, the episode is dropped and counted in stats.
+
+    Files hold the time_index, step_seconds, action.<name> and state.<name> columns, and the metadata (config,
+    initial state, reset time, halted...) as JSON. npz files are uncompressed unless compress is set, so that
+    load_episode can map their columns in memory; Arrow files (uncompressed) are mapped by pyarrow.
+    float32 stores the action and state columns in single precision.
+    """
+    def __init__(self, output_dir: str, action_names: List, state_names: List, file_format: str = 'npz',
+                 float32: bool = False, compress: bool = False, capacity: int = 1024, max_pending: int = 64):
+        if file_format not in RECORD_FORMATS:
+            raise ValueError("Unknown trajectory format {}, expected one of {}".format(file_format, RECORD_FORMATS))
+        if file_format in ('parquet', 'arrow'):
+            try:
+                import pyarrow
+            except ImportError:
+                raise ImportError("Recording trajectories as {} requires the pyarrow package".format(file_format))
+        # Absolute, as twin loads on other threads change the working directory for a moment
+        self.output_dir = os.path.abspath(output_dir)
+        self.action_names = list(action_names)
+        self.state_names = list(state_names)
+        self.file_format = file_format
+        self.dtype = np.float32 if float32 else np.float64
+        self.compress = compress
+        self.capacity = capacity
+        self.max_pending = max_pending
+        self.stats = {'episodes': 0, 'steps': 0, 'written': 0, 'dropped': 0, 'failed': 0, 'bytes': 0,
+                      'write_seconds': 0.0}
+        self._reset_process_state()
+
+    def _reset_process_state(self):
+        self.run_id = '{}-{}'.format(socket.gethostname(), os.getpid())
+        self._episodes = itertools.count()
+        self._free = deque()
+        self._queue = queue.Queue(self.max_pending)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def __getstate__(self):
+        # A spawned worker starts its own writer thread and pool
+        state = dict(self.__dict__)
+        for name in ('_episodes', '_free', '_queue', '_thread', '_lock'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset_process_state()
+
+    def start_episode(self, config: Dict = None, initial_state=None, reset_seconds: float = None) \
+            -> EpisodeTrajectory:
+        if self._pid != os.getpid():
+            # Forked worker: the writer thread and the queued episodes belong to the parent
+            self._reset_process_state()
+        try:
+            trajectory = self._free.pop()
+            trajectory.length = 0
+        except IndexError:
+            trajectory = EpisodeTrajectory(self.capacity, len(self.action_names), len(self.state_names), self.dtype)
+        trajectory.metadata = {
+            'format_version': RECORD_FORMAT_VERSION,
+            'run_id': self.run_id,
+            'episode': next(self._episodes),
+            'started_at': time.time(),
+            'config': dict(config or {}),
+            'initial_state': None if initial_state is None else [float(value) for value in initial_state],
+            'reset_seconds': reset_seconds,
+            'action_names': self.action_names,
+            'state_names': self.state_names,
+        }
+        return trajectory
+
+    def finish_episode(self, trajectory: EpisodeTrajectory, halted: bool = False, finished: bool = True):
+        """ Queues the episode for writing; finished is False for an episode abandoned without EpisodeFinish """
+        trajectory.metadata.update(steps=trajectory.length, halted=bool(halted), finished=finished,
+                                   finished_at=time.time())
+        self.stats['episodes'] += 1
+        self.stats['steps'] += trajectory.length
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._write_episodes, name="TrajectoryWriter", daemon=True)
+                self._thread.start()
+        try:
+            self._queue.put_nowait(trajectory)
+        except queue.Full:
+            self.stats['dropped'] += 1
+            self._free.append(trajectory)
+
+    def _write_episodes(self):
+        while True:
+            trajectory = self._queue.get()
+            try:
+                if trajectory is None:
+                    return
+                start = time.perf_counter()
+                path = self.write(trajectory)
+                self.stats['written'] += 1
+                self.stats['bytes'] += os.path.getsize(path)
+                self.stats['write_seconds'] += time.perf_counter() - start
+            except Exception as err:
+                self.stats['failed'] += 1
+                logger.error("Could not write the trajectory of episode %s: %s", trajectory.metadata['episode'], err)
+            finally:
+                if trajectory is not None:
+                    self._free.append(trajectory)
+                self._queue.task_done()
+
+    def columns(self, trajectory: EpisodeTrajectory) -> OrderedDict:
+        """ Column name -> values of the recorded steps (views of the buffers) """
+        length = trajectory.length
+        columns = OrderedDict([('time_index', trajectory.time_index[:length]),
+                               ('step_seconds', trajectory.step_seconds[:length])])
+        for index, name in enumerate(self.action_names):
+            columns['action.' + name] = trajectory.actions[:length, index]
+        for index, name in enumerate(self.state_names):
+            columns['state.' + name] = trajectory.states[:length, index]
+        return columns
+
+    def episode_path(self, metadata: Dict) -> str:
+        partition = time.strftime('date=%Y-%m-%d', time.gmtime(metadata['started_at']))
+        file_name = '{}-{:06d}.{}'.format(metadata['run_id'], metadata['episode'], self.file_format)
+        return os.path.join(self.output_dir, partition, file_name)
+
+    def write(self, trajectory: EpisodeTrajectory) -> str:
+        path = self.episode_path(trajectory.metadata)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        columns = self.columns(trajectory)
+        metadata = json.dumps(trajectory.metadata, default=str)
+        # Written next to the final name and renamed, readers never see a partial file
+        temp_path = path + '.tmp'
+        if self.file_format == 'npz':
+            save = np.savez_compressed if self.compress else np.savez
+            with open(temp_path, 'wb') as episode_file:
+                save(episode_file, metadata=np.array(metadata), **columns)
+        else:
+            import pyarrow as pa
+            table = pa.table(OrderedDict((name, pa.array(values)) for name, values in columns.items()),
+                             metadata={'trajectory': metadata})
+            if self.file_format == 'parquet':
+                import pyarrow.parquet as pq
+                pq.write_table(table, temp_path, compression='zstd' if self.compress else 'none')
+            else:
+                import pyarrow.feather as feather
+                feather.write_feather(table, temp_path, compression='zstd' if self.compress else 'uncompressed')
+        os.replace(temp_path, path)
+        return path
+
+    def wait(self):
+        """ Blocks until the queued episodes are written """
+        self._queue.join()
+
+    def close(self):
+        self.wait()
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._thread = None
+
+
+def episode_paths(output_dir: str) -> List[str]:
+    """ Recorded episode files under output_dir, in partition and file name order """
+    paths = []
+    for root, _, file_names in os.walk(output_dir):
+        paths.extend(os.path.join(root, name) for name in file_names
+                     if os.path.splitext(name)[1][1:] in RECORD_FORMATS)
+    return sorted(paths)
+
+
+def _map_npz(path: str) -> Dict:
+    # Members of an uncompressed npz are .npy files stored as is, mapped at their offset in the archive
+    arrays = {}
+    with zipfile.ZipFile(path) as archive, open(path, 'rb') as npz_file:
+        for info in archive.infolist():
+            name = info.filename[:-len('.npy')]
+            if info.compress_type != zipfile.ZIP_STORED:
+                arrays[name] = np.load(archive.open(info))
+                continue
+            # The local header is 30 bytes followed by the file name and an extra field of their own length
+            npz_file.seek(info.header_offset + 26)
+            name_length, extra_length = np.frombuffer(npz_file.read(4), dtype='<u2')
+            npz_file.seek(info.header_offset + 30 + name_length + extra_length)
+            if np.lib.format.read_magic(npz_file) == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(npz_file)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(npz_file)
+            if dtype.hasobject or not shape:
+                npz_file.seek(info.header_offset + 30 + name_length + extra_length)
+                arrays[name] = np.lib.format.read_array(npz_file)
+                continue
+            arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=npz_file.tell(), shape=shape,
+                                     order='F' if fortran_order else 'C')
+    return arrays
+
+
+def load_episode(path: str, mmap: bool = True):
+    """
+    Returns (columns, metadata) of a recorded episode. With mmap, the columns of uncompressed npz and Arrow files
+    are mapped in memory rather than read.
+    """
+    if path.endswith('.npz'):
+        arrays = _map_npz(path) if mmap else dict(np.load(path))
+        metadata = json.loads(str(arrays.pop('metadata')))
+        return arrays, metadata
+
+    import pyarrow as pa
+    if path.endswith('.arrow'):
+        import pyarrow.feather as feather
+        table = feather.read_table(path, memory_map=mmap)
+    else:
+        import pyarrow.parquet as pq
+        table = pq.read_table(path, memory_map=mmap)
+    metadata = json.loads(table.schema.metadata[b'trajectory'])
+    columns = OrderedDict((name, table.column(name).to_numpy()) for name in table.column_names)
+    return columns, metadata
@@ -0,0 +1,209 @@
+"""
+Replays recorded action trajectories on the twin in one batch mode call per trajectory instead of one step at a time, across a pool of worker threads or processes, and checks the replayed states against a stepwise replay.
+Copyright 2021, Microsoft Corp.
+"""
+
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import numpy as np
+
+from twin_runtime.twin_runtime_error import TwinRuntimeError
+
+from .TrajectoryRecorder import load_episode
+from .TwinBuilderSimulator import TwinBuilderSimulator
+
+logger = logging.getLogger(__name__)
+
+
+def build_replay_schedule(start_inputs, input_indices, start_time: float, time_index, action_values) -> np.ndarray:
+    """
+    Batch mode input rows replaying the actions of a trajectory from start_time: each action is held from the time
+    of the previous step (start_time for the first one) up to its own time index, as episode_step holds it, and the
+    last action is repeated at the last time index to end the simulation there. Inputs that are not replayed keep
+    their value in start_inputs.
+    """
+    steps = len(time_index)
+    schedule = np.empty((steps + 1, 1 + len(start_inputs)))
+    schedule[:, 1:] = start_inputs
+    schedule[0, 0] = start_time
+    schedule[1:, 0] = time_index
+    columns = 1 + np.asarray(input_indices)
+    schedule[:steps, columns] = action_values
+    schedule[steps, columns] = action_values[-1]
+    return schedule
+
+
+def compare_trajectories(states, reference_states, rtol: float = 1e-6, atol: float = 1e-8) -> Dict:
+    """ Largest absolute and relative differences between two state trajectories, and whether they are within tolerance """
+    difference = np.abs(states - reference_states)
+    relative = difference / np.maximum(np.abs(reference_states), np.finfo(np.float64).tiny)
+    return {
+        'max_abs_error': float(difference.max()) if difference.size else 0.0,
+        'max_rel_error': float(relative.max()) if relative.size else 0.0,
+        'matches': bool(np.allclose(states, reference_states, rtol=rtol, atol=atol)),
+    }
+
+
+class TrajectoryReplayer():
+    """
+    Replays action trajectories on a simulator of its own, built from the TwinBuilderSimulator arguments (without a
+    recorder). Each replay resets the simulator as episode_start would, warm-up included, then runs every step of
+    the trajectory in a single twin_simulate_batch_mode_array call and returns the states at the time index of each
+    step. replay_stepwise runs the same trajectory through step_values, as the connector does, for reference.
+    """
+    def __init__(self, simulator_args: List, simulator_options: Dict = None):
+        simulator_options = dict(simulator_options or {})
+        simulator_options.pop('recorder', None)
+        simulator_class = simulator_options.pop('simulator_class', TwinBuilderSimulator)
+        self.simulator = simulator_class(*simulator_args, **simulator_options)
+        self.state_variable_names = list(self.simulator.state_variable_names)
+
+    def start(self, step_size: float, action_names: List):
+        """ Resets the simulator and returns the IO plan of the replayed inputs """
+        simulator = self.simulator
+        simulator.reset(step_size)
+        if action_names is None or list(action_names) == simulator.action_variable_names:
+            return simulator.io_plan
+        io_plan = simulator.twin_runtime.twin_build_io_plan(action_names, self.state_variable_names)
+        # The other inputs keep the values the warm-up left them at
+        io_plan.inputs[:] = simulator.io_plan.inputs
+        return io_plan
+
+    def replay(self, time_index, action_values, step_size: float = 0.5, action_names: List = None) -> np.ndarray:
+        """
+        Returns the states after each step (steps x state variables) of the actions (steps x actions, columns in
+        action_names order, the simulator action variables by default) applied up to time_index, in one batch
+        mode call
+        """
+        time_index = np.asarray(time_index, dtype=np.float64)
+        action_values = np.asarray(action_values, dtype=np.float64)
+        io_plan = self.start(step_size, action_names)
+        twin_runtime = self.simulator.twin_runtime
+        start_time = self.simulator.state['time_index']
+        if time_index.size == 0:
+            return np.empty((0, len(self.state_variable_names)))
+        if time_index[0] <= start_time or np.any(np.diff(time_index) <= 0):
+            raise ValueError("The time index must increase from the end of the warm-up ({}s)".format(start_time))
+
+        schedule = build_replay_schedule(io_plan.inputs, io_plan.input_indices, start_time, time_index, action_values)
+        try:
+            # A batch mode call continuing a simulation holds the inputs already set until its second row
+            io_plan.set_inputs_from(action_values[0])
+            output_array = twin_runtime.twin_simulate_batch_mode_array(schedule)
+        except TwinRuntimeError:
+            self.simulator.needs_reload = True
+            raise
+
+        # Only the outputs after the current time are written, one per row but the first
+        output_array = output_array[:len(time_index)]
+        if not np.array_equal(output_array[:, 0], time_index):
+            raise TwinRuntimeError("The batch mode replay did not return the outputs at the time index of every step!")
+        return output_array[:, 1 + io_plan.output_indices]
+
+    def replay_stepwise(self, time_index, action_values, step_size: float = 0.5, action_names: List = None) \
+            -> np.ndarray:
+        """ Same as replay, one step_values call per step """
+        time_index = np.asarray(time_index, dtype=np.float64)
+        action_values = np.asarray(action_values, dtype=np.float64)
+        io_plan = self.start(step_size, action_names)
+        simulator = self.simulator
+        states = np.empty((len(time_index), len(self.state_variable_names)))
+        if io_plan is simulator.io_plan:
+            for step, values in enumerate(action_values):
+                simulator.time_index = time_index[step]
+                states[step] = simulator.step_values(values)
+            return states
+
+        for step, values in enumerate(action_values):
+            io_plan.set_inputs_from(values)
+            simulator.twin_runtime.twin_simulate(time_index[step])
+            io_plan.read_outputs_into(states[step])
+        return states
+
+    def replay_episode(self, path: str, verify: bool = False, rtol: float = 1e-6, atol: float = 1e-8) -> Dict:
+        """
+        Replays the episode recorded in path and returns its replayed states, with their differences to the
+        recorded states and, when verify is set, to a stepwise replay
+        """
+        columns, metadata = load_episode(path)
+        action_names = metadata['action_names']
+        time_index = np.array(columns['time_index'])
+        action_values = np.column_stack([columns['action.' + name] for name in action_names]) \
+            if len(time_index) else np.empty((0, len(action_names)))
+        step_size = metadata['config'].get('step_size') or 0.5
+
+        start = time.perf_counter()
+        states = self.replay(time_index, action_values, step_size, action_names)
+        result = {'path': path, 'steps': len(time_index), 'seconds': time.perf_counter() - start,
+                  'time_index': time_index, 'states': states}
+
+        recorded_names = ['state.' + name for name in self.state_variable_names]
+        if all(name in columns for name in recorded_names):
+            recorded_states = np.column_stack([columns[name] for name in recorded_names]) \
+                if len(time_index) else np.empty_like(states)
+            # Recorded as float32 or by another model version they may differ, reported but not checked
+            result['recorded'] = compare_trajectories(states, recorded_states, rtol, atol)
+        if verify:
+            start = time.perf_counter()
+            stepwise_states = self.replay_stepwise(time_index, action_values, step_size, action_names)
+            result['stepwise_seconds'] = time.perf_counter() - start
+            result['stepwise'] = compare_trajectories(states, stepwise_states, rtol, atol)
+            if not result['stepwise']['matches']:
+                logger.warning("The batch replay of %s differs from its stepwise replay by up to %g (%g relative)",
+                               path, result['stepwise']['max_abs_error'], result['stepwise']['max_rel_error'])
+        return result
+
+    def close(self):
+        self.simulator.close()
+
+
+# Replayer of each worker thread, or of each worker process
+_replayers = threading.local()
+
+
+def _thread_replayer(simulator_args, simulator_options, replayers):
+    replayer = getattr(_replayers, 'replayer', None)
+    if replayer is None:
+        replayer = _replayers.replayer = TrajectoryReplayer(simulator_args, simulator_options)
+        replayers.append(replayer)
+    return replayer
+
+
+def _start_replay_process(simulator_args, simulator_options):
+    _replayers.replayer = TrajectoryReplayer(simulator_args, simulator_options)
+
+
+def _replay_in_process(path, verify, rtol, atol):
+    return _replayers.replayer.replay_episode(path, verify, rtol, atol)
+
+
+def replay_episodes(paths: List[str], simulator_args: List, simulator_options: Dict = None, workers: int = 1,
+                    processes: bool = False, verify: bool = False, rtol: float = 1e-6, atol: float = 1e-8) -> List[Dict]:
+    """
+    Replays the recorded episodes in paths on workers threads (each with its own twin, as twins step in parallel
+    on separate threads) or worker processes, and returns their replay_episode results in the order of paths
+    """
+    paths = list(paths)
+    if processes:
+        start_methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('fork' if 'fork' in start_methods else 'spawn')
+        with context.Pool(workers, _start_replay_process, (simulator_args, simulator_options)) as pool:
+            return pool.starmap(_replay_in_process, [(path, verify, rtol, atol) for path in paths], chunksize=1)
+
+    replayers = []
+
+    def replay_in_thread(path):
+        replayer = _thread_replayer(simulator_args, simulator_options, replayers)
+        return replayer.replay_episode(path, verify, rtol, atol)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='TrajectoryReplay') as executor:
+            return list(executor.map(replay_in_thread, paths))
+    finally:
+        for replayer in replayers:
+            replayer.close()
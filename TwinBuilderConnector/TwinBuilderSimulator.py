@@ -3,40 +3,118 @@ Uses the twin runtime to load a digital twin model and supports the reset, step,
 Copyright 2021, Microsoft Corp.
 """
 
+import logging
+import time
 from typing import Dict, List
 
-from twin_runtime.twin_runtime_core import TwinRuntime
+import numpy as np
+
+from twin_runtime.twin_runtime_core import TwinRuntime, OUTPUT_AGGREGATIONS, aggregate_output_rows
 from twin_runtime.twin_runtime_core import LogLevel
+from twin_runtime.twin_log_router import TwinLogRouter, default_twin_log_router
+from twin_runtime.twin_runtime_error import TwinRuntimeError
+
+from .ConnectorLogging import step_logger
+from .Metrics import metrics
+from .StartupTimeline import startup
+from .TrajectoryRecorder import TrajectoryRecorder
+
+RESET_MODES = ('rewind', 'reload', 'fork', 'pool')
+RESET_PHASES = ('open', 'instantiate', 'initialize', 'rewind', 'warm_up')
+SUB_STEP_METHODS = ('batch', 'loop')
+
+SET_INPUTS_SECONDS = metrics.histogram('set_inputs_seconds', 'Time setting the twin inputs of an episode step')
+SIMULATE_SECONDS = metrics.histogram('twin_simulate_seconds', 'Time in twin_simulate for an episode step')
+GET_OUTPUTS_SECONDS = metrics.histogram('get_outputs_seconds', 'Time reading the twin outputs of an episode step')
+RESET_SECONDS = {mode: metrics.histogram('reset_seconds', 'Time resetting the simulator for an episode',
+                                         {'mode': mode})
+                 for mode in RESET_MODES}
+RESET_PHASE_SECONDS = {phase: metrics.histogram('reset_phase_seconds', 'Time in each phase of a simulator reset',
+                                                {'phase': phase})
+                       for phase in RESET_PHASES}
+POOL_HITS = metrics.counter('twin_pool_hits_total', 'Episode starts that took a twin prepared in the background')
+POOL_MISSES = metrics.counter('twin_pool_misses_total', 'Episode starts that found no prepared twin')
+POOL_ERRORS = metrics.counter('twin_pool_errors_total', 'Twins that failed to be prepared in the background')
+POOL_PREPARE_SECONDS = metrics.histogram('twin_pool_prepare_seconds', 'Time preparing a pooled twin in the background')
+ZYGOTE_HITS = metrics.counter('zygote_hits_total', 'Episode starts forked from a cached zygote')
+ZYGOTE_MISSES = metrics.counter('zygote_misses_total', 'Episode starts that loaded a new zygote')
+ZYGOTE_EVICTIONS = metrics.counter('zygote_evictions_total', 'Zygotes closed to keep at most max_zygotes')
+
+logger = logging.getLogger(__name__)
 
 class TwinBuilderSimulator():
     def __init__(self, twin_model_file, state_variable_names: List,
                  action_variable_names: List,
-                 number_of_warm_up_steps, warm_up_action_variable_values: List):
+                 number_of_warm_up_steps, warm_up_action_variable_values: List,
+                 reuse_twin: bool = True, reload_config_keys: List = (), step_size: float = 0.5,
+                 twin_log_level: LogLevel = LogLevel.TWIN_LOG_WARNING, log_router: TwinLogRouter = None,
+                 recorder: TrajectoryRecorder = None, action_repeat: int = 1, state_aggregation: str = 'last',
+                 sub_step_method: str = 'batch'):
         self.state = {}
         self.twin_runtime = None #assigned in reset
+        self.io_plan = None #assigned in reset
         self.done = False
         self.twin_model_file = twin_model_file
         self.state_variable_names = state_variable_names
         self.action_variable_names = action_variable_names
         self.number_of_warm_up_steps = number_of_warm_up_steps
         self.warm_up_action_variable_values = warm_up_action_variable_values
-        self.step_size = 0.5
+        self.step_size = step_size
         self.time_index = 0
+
+        # Each twin logs to its own file given by the router (the process default one unless set), archived and
+        # compressed in the background when the twin is closed. TWIN_LOG_ALL is meant for debugging a model only.
+        self.twin_log_level = twin_log_level
+        self.log_router = log_router
+        self.log_stem = None
+
+        # When a recorder is given, each episode (config, actions, states and step times) is recorded to disk
+        self.recorder = recorder
+        self.trajectory = None
+
+        # Each step holds the action for action_repeat twin steps of step_size and reports the state aggregated
+        # over them, through one batch mode call or a loop of twin_simulate calls. The episode config keys
+        # action_repeat and state_aggregation override these defaults.
+        if sub_step_method not in SUB_STEP_METHODS:
+            raise ValueError("Unknown sub-step method {}, expected one of {}".format(sub_step_method, SUB_STEP_METHODS))
+        self.sub_step_method = sub_step_method
+        self.default_action_repeat = action_repeat
+        self.default_state_aggregation = state_aggregation
+        self.set_action_repeat(action_repeat, state_aggregation)
+
+        # When reuse_twin is set the model stays open between episodes and is rewound with twin_reset.
+        # It is reloaded only after an error, when a config key listed in reload_config_keys changes,
+        # or when the model does not come back to its initial outputs after twin_reset.
+        self.reuse_twin = reuse_twin
+        self.reload_config_keys = list(reload_config_keys)
+        self.rewind_supported = True
+        self.needs_reload = False
+        self.initial_outputs = None
+        self.last_config = {}
+        self.reset_stats = {'count': 0, 'rewind': 0, 'reload': 0, 'total_seconds': 0.0, 'last_seconds': 0.0}
+
         self.reset(self.step_size)
 
     def reset(self, step_size):
+        start = time.perf_counter()
         self.done = False
-        runtime_log = self.twin_model_file.replace('.twin', '.log')
         self.step_size = step_size
 
-        if self.twin_runtime != None:
-            self.twin_runtime.twin_close()
-            self.twin_runtime = None
+        if self.can_rewind() and self.log_needs_rotation():
+            # The runtime writes its log until TwinClose, reloading the twin archives it and starts a new one
+            logger.info("The twin log %s passed its size limit, reloading the twin", self.twin_runtime.log_path.decode())
+            self.needs_reload = True
 
-        # Load Twin, set the parameters values, initialize (and generate snapshots, output)
-        self.twin_runtime = TwinRuntime(self.twin_model_file, runtime_log, log_level=LogLevel.TWIN_LOG_ALL)
-        self.twin_runtime.twin_instantiate()
-        self.twin_runtime.twin_initialize()
+        rewound = False
+        if self.can_rewind():
+            with RESET_PHASE_SECONDS['rewind'].time():
+                rewound = self.rewind_twin()
+        if rewound:
+            reset_mode = 'rewind'
+        else:
+            self.load_twin()
+            reset_mode = 'reload'
+        self.needs_reload = False
 
         for state_variable_name in self.state_variable_names:
             self.state[state_variable_name] = 0
@@ -46,13 +124,107 @@ class TwinBuilderSimulator():
 
         # Run initial steps to "warm up" the simulation
         if self.number_of_warm_up_steps > 0:
-            action = dict(zip(self.action_variable_names, self.warm_up_action_variable_values))
-            for i in range(self.number_of_warm_up_steps):
-                self.episode_step(action)
+            with RESET_PHASE_SECONDS['warm_up'].time(), startup.phase('warm_up'):
+                self.warm_up()
+
+        elapsed = time.perf_counter() - start
+        RESET_SECONDS[reset_mode].observe(elapsed)
+        self.reset_stats['count'] += 1
+        self.reset_stats[reset_mode] += 1
+        self.reset_stats['total_seconds'] += elapsed
+        self.reset_stats['last_seconds'] = elapsed
+        logger.info("Reset (%s) took %.3fs, average %.3fs over %d resets",
+                    reset_mode, elapsed, self.reset_stats['total_seconds'] / self.reset_stats['count'],
+                    self.reset_stats['count'])
+
+    def can_rewind(self) -> bool:
+        return self.reuse_twin and self.rewind_supported and not self.needs_reload and self.twin_runtime is not None
+
+    def log_needs_rotation(self) -> bool:
+        twin_runtime = self.twin_runtime
+        return twin_runtime.log_router is not None and twin_runtime.log_router.needs_rotation(
+            twin_runtime.log_path.decode())
+
+    def load_twin(self):
+        """ Closes the current twin if any, then opens, instantiates and initializes the twin model file """
+        self.close_twin()
+
+        # Load Twin, set the parameters values, initialize (and generate snapshots, output)
+        with RESET_PHASE_SECONDS['open'].time():
+            with startup.phase('dll_load'):
+                # Loaded once per process, timed apart from the twin open in the start-up timeline
+                TwinRuntime.load_dll()
+            log_router = self.log_router or default_twin_log_router()
+            if self.log_stem is None:
+                self.log_stem = log_router.instance_stem(self.twin_model_file)
+            with startup.phase('twin_open'):
+                self.twin_runtime = TwinRuntime(self.twin_model_file, log_level=self.twin_log_level,
+                                                log_router=log_router, log_stem=self.log_stem)
+        with RESET_PHASE_SECONDS['instantiate'].time(), startup.phase('instantiate'):
+            self.twin_runtime.twin_instantiate()
+        with RESET_PHASE_SECONDS['initialize'].time(), startup.phase('initialize'):
+            self.twin_runtime.twin_initialize()
+        self.io_plan = self.twin_runtime.twin_build_io_plan(self.action_variable_names, self.state_variable_names)
+        self.state_values = np.zeros(len(self.state_variable_names))
+        self.initial_outputs = self.twin_runtime.twin_get_outputs()
+
+    def rewind_twin(self) -> bool:
+        """
+        Rewinds the open twin to its initial state, returns False if the twin has to be reloaded instead
+        """
+        try:
+            self.twin_runtime.twin_reset()
+            self.io_plan.restore_start_inputs()
+            self.twin_runtime.twin_initialize()
+            outputs = self.twin_runtime.twin_get_outputs()
+        except TwinRuntimeError as err:
+            logger.warning("Rewinding the twin failed, reloading it: %s", err.message)
+            return False
+
+        # Some models do not restore all their states on twin_reset, stop rewinding those
+        if not np.allclose(outputs, self.initial_outputs, equal_nan=True):
+            logger.warning("The twin did not return to its initial outputs after twin_reset, reloading it for every episode")
+            self.rewind_supported = False
+            return False
+
+        return True
+
+    def warm_up(self):
+        """
+        Advances the twin through the warm-up steps in a single batch mode call, as number_of_warm_up_steps
+        calls to episode_step with the warm-up actions would, then reads the warmed outputs into the state
+        """
+        # episode_step simulates up to the current time index before increasing it, so the first step is at time 0
+        step_times = np.zeros(self.number_of_warm_up_steps)
+        np.cumsum(np.full(self.number_of_warm_up_steps - 1, self.step_size), out=step_times[1:])
+
+        try:
+            self.io_plan.set_inputs_from(self.warm_up_action_variable_values)
+            if self.number_of_warm_up_steps > 1:
+                schedule = np.empty((self.number_of_warm_up_steps, 1 + len(self.io_plan.inputs)))
+                schedule[:, 0] = step_times
+                schedule[:, 1:] = self.io_plan.inputs
+                self.twin_runtime.twin_simulate_batch_mode_array(schedule, step_size=self.step_size)
+            else:
+                # Batch mode needs an end time past the start time
+                self.twin_runtime.twin_simulate(step_times[-1])
+
+            values = self.io_plan.read_outputs_into(self.state_values).tolist()
+        except TwinRuntimeError:
+            self.needs_reload = True
+            raise
+
+        for state_variable_name, value in zip(self.state_variable_names, values):
+            self.state[state_variable_name] = value
+
+        self.state['time_index'] = step_times[-1].item()
+        self.time_index = self.state['time_index'] + self.step_size
 
     def get_state(self) -> Dict[str, float]:
         """Called to retreive the current state of the simulator. """
-        print(f"returning state: {self.state}")
+        if step_logger.isEnabledFor(logging.DEBUG):
+            # A copy, the record is formatted later on the logging thread
+            step_logger.debug("returning state: %s", dict(self.state))
         return self.state
 
     def halted(self) -> bool:
@@ -63,25 +235,152 @@ class TwinBuilderSimulator():
 
     def episode_start(self, config: Dict = None) -> None:
         """ Called at the start of each episode """
-        self.reset(config["step_size"] or 0.5)
-        
-    def episode_step(self, action: Dict):
-        """ Called for each step of the episode """
-        for f in action.keys():
-            self.twin_runtime.twin_set_input_by_name(f, action[f])
+        config = config or {}
+        if any(config.get(key) != self.last_config.get(key) for key in self.reload_config_keys):
+            self.needs_reload = True
+        self.last_config = dict(config)
+        self.set_action_repeat(config.get("action_repeat") or self.default_action_repeat,
+                               config.get("state_aggregation") or self.default_state_aggregation)
+        # An episode left without EpisodeFinish (session lost) is still written
+        self.end_trajectory(finished=False)
+        self.reset(config.get("step_size") or 0.5)
+        if self.recorder is not None:
+            self.trajectory = self.recorder.start_episode(
+                config, [self.state[name] for name in self.state_variable_names], self.reset_stats['last_seconds'])
 
-        self.twin_runtime.twin_simulate(self.time_index)
+    def set_action_repeat(self, action_repeat: int, state_aggregation: str = 'last'):
+        """ Holds each action for action_repeat twin steps, the state being aggregated over them """
+        action_repeat = int(action_repeat)
+        if action_repeat < 1:
+            raise ValueError("The action repeat must be at least 1, got {}".format(action_repeat))
+        if state_aggregation not in OUTPUT_AGGREGATIONS:
+            raise ValueError("Unknown state aggregation {}, expected one of {}".format(state_aggregation,
+                                                                                      OUTPUT_AGGREGATIONS))
+        self.action_repeat = action_repeat
+        self.state_aggregation = state_aggregation
+        # Sub-step buffers, sized for the twin when first used
+        self.sub_step_schedule = None
+        self.sub_step_outputs = None
+        self.sub_step_states = None
 
-        for state_variable_name in self.state_variable_names:
-            value = self.twin_runtime.twin_get_output_by_name(state_variable_name).value
-            print(value)
-            self.state[state_variable_name] = value
+    def step_values(self, action_values) -> np.ndarray:
+        """
+        NumPy core of episode_step: applies the action values (in action_variable_names order) for one step and
+        returns the state values in state_variable_names order, in a buffer that the next step overwrites.
+        The state dictionary is left as is.
+        """
+        if self.action_repeat > 1:
+            return self.sub_step_values(action_values)
+        try:
+            start = time.perf_counter()
+            self.io_plan.set_inputs_from(action_values)
+            inputs_set = time.perf_counter()
+
+            self.twin_runtime.twin_simulate(self.time_index)
+            simulated = time.perf_counter()
+
+            self.io_plan.read_outputs_into(self.state_values)
+        except TwinRuntimeError:
+            self.needs_reload = True
+            raise
+        SET_INPUTS_SECONDS.observe(inputs_set - start)
+        SIMULATE_SECONDS.observe(simulated - inputs_set)
+        GET_OUTPUTS_SECONDS.observe(time.perf_counter() - simulated)
 
-        self.state['time_index'] = self.time_index
         #increase the index
         self.time_index = self.time_index + self.step_size
- 
+        return self.state_values
+
+    def sub_step_values(self, action_values) -> np.ndarray:
+        """
+        step_values holding the action for action_repeat twin steps: the twin is simulated to each sub-step time
+        and the state values are aggregated over the sub-steps (last, mean, min or max)
+        """
+        repeat = self.action_repeat
+        io_plan = self.io_plan
+        # The sub-steps end at the time index and the repeat - 1 step times after it
+        last_time_index = self.time_index + (repeat - 1) * self.step_size
+        try:
+            start = time.perf_counter()
+            io_plan.set_inputs_from(action_values)
+            inputs_set = time.perf_counter()
+
+            # Without warm-up the first sub-step is at time 0, where the twin already is: a continuation row
+            # cannot come before it, so that step runs in the loop, as warm_up falls back to twin_simulate
+            if self.sub_step_method == 'batch' and self.time_index >= self.step_size:
+                schedule = self.sub_step_schedule
+                if schedule is None or schedule.shape[1] != 1 + len(io_plan.inputs):
+                    schedule = self.sub_step_schedule = np.empty((repeat + 1, 1 + len(io_plan.inputs)))
+                    self.sub_step_outputs = np.zeros((repeat + 1, 1 + self.twin_runtime.number_outputs))
+                # A continuation from the current time, one output row per sub-step (see warm_up)
+                schedule[0, 0] = self.time_index - self.step_size
+                schedule[1:, 0] = np.linspace(self.time_index, last_time_index, repeat)
+                schedule[:, 1:] = io_plan.inputs
+                outputs = self.twin_runtime.twin_simulate_batch_mode_array(schedule, output_array=self.sub_step_outputs)
+                simulated = time.perf_counter()
+
+                aggregated = aggregate_output_rows(outputs[:repeat], repeat, self.state_aggregation)
+                np.take(aggregated[0, 1:], io_plan.output_indices, out=self.state_values)
+            else:
+                states = self.sub_step_states
+                if states is None:
+                    states = self.sub_step_states = np.empty((repeat, len(self.state_variable_names)))
+                for sub_step, sub_step_time in enumerate(np.linspace(self.time_index, last_time_index, repeat)):
+                    self.twin_runtime.twin_simulate(sub_step_time)
+                    if self.state_aggregation != 'last':
+                        io_plan.read_outputs_into(states[sub_step])
+                simulated = time.perf_counter()
+
+                if self.state_aggregation == 'last':
+                    io_plan.read_outputs_into(self.state_values)
+                else:
+                    getattr(np, self.state_aggregation)(states, axis=0, out=self.state_values)
+        except TwinRuntimeError:
+            self.needs_reload = True
+            raise
+        SET_INPUTS_SECONDS.observe(inputs_set - start)
+        SIMULATE_SECONDS.observe(simulated - inputs_set)
+        GET_OUTPUTS_SECONDS.observe(time.perf_counter() - simulated)
+
+        self.time_index = last_time_index + self.step_size
+        return self.state_values
+
+    def episode_step(self, action: Dict):
+        """ Called for each step of the episode """
+        start = time.perf_counter()
+        # The time of the state, the end of the last sub-step
+        time_index = self.time_index + (self.action_repeat - 1) * self.step_size
+        action_values = [action[name] for name in self.action_variable_names]
+        values = self.step_values(action_values)
+        if self.trajectory is not None:
+            self.trajectory.append(time_index, action_values, values, time.perf_counter() - start)
+        values = values.tolist()
+
+        for state_variable_name, value in zip(self.state_variable_names, values):
+            self.state[state_variable_name] = value
+
+        self.state['time_index'] = time_index
+
     def episode_finish(self):
         """ Called at the end of each episode """
-        self.twin_runtime.twin_close()
-        self.twin_runtime = None
+        self.end_trajectory()
+        if not self.reuse_twin:
+            self.close_twin()
+
+    def end_trajectory(self, finished: bool = True):
+        """ Hands the recorded episode, if any, to the recorder for writing """
+        if self.trajectory is not None:
+            self.recorder.finish_episode(self.trajectory, halted=self.done, finished=finished)
+            self.trajectory = None
+
+    def close(self):
+        """ Releases the simulator resources """
+        self.end_trajectory(finished=False)
+        self.close_twin()
+
+    def close_twin(self):
+        """ Closes the twin model, if it is open """
+        if self.twin_runtime is not None:
+            self.twin_runtime.twin_close()
+            self.twin_runtime = None
+            self.io_plan = None
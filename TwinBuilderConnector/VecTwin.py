@@ -0,0 +1,298 @@
+"""
+Steps many instances of a digital twin in lockstep with array-in, array-out calls: one (instances x actions) matrix in, one (instances x states) matrix out, the instances being spread over worker threads or processes sharing those matrices.
+Copyright 2021, Microsoft Corp.
+"""
+
+import logging
+import multiprocessing
+import os
+import pickle
+import signal
+import sys
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import numpy as np
+
+from twin_runtime.twin_runtime_error import TwinRuntimeError
+
+from .ConnectorLogging import stop_logging
+from .TwinBuilderSimulator import TwinBuilderSimulator
+
+logger = logging.getLogger(__name__)
+
+# Shared matrices of a VecTwin: name -> (columns, dtype), each with one row per instance
+VEC_TWIN_BUFFERS = {
+    'actions': ('actions', np.float64),
+    'states': ('states', np.float64),
+    'final_states': ('states', np.float64),
+    'time_index': (None, np.float64),
+    'episode_steps': (None, np.int64),
+    'dones': (None, np.bool_),
+}
+
+# Worker process commands, the step one being a single byte
+STEP_COMMAND = b's'
+RESET_COMMAND = b'r'
+
+
+class VecTwinWorker():
+    """
+    Steps the instances start to stop of a VecTwin, reading their actions from and writing their states to the
+    rows of the shared buffers. An instance whose step fails with a TwinRuntimeError, whose simulator halts or that
+    reached max_episode_steps is done: with auto_reset its final state goes to final_states and it starts a new
+    episode at once, otherwise it is left out of the steps until reset.
+    """
+    def __init__(self, start: int, stop: int, buffers: Dict, simulator_args: List, simulator_options: Dict,
+                 config: Dict, auto_reset: bool, max_episode_steps: int = None):
+        self.start = start
+        self.stop = stop
+        self.buffers = buffers
+        self.config = dict(config or {})
+        self.auto_reset = auto_reset
+        self.max_episode_steps = max_episode_steps
+
+        simulator_options = dict(simulator_options or {})
+        simulator_class = simulator_options.pop('simulator_class', TwinBuilderSimulator)
+        simulator_options.setdefault('step_size', self.config.get('step_size') or 0.5)
+        self.simulators = [simulator_class(*simulator_args, **simulator_options) for _ in range(start, stop)]
+        for index, simulator in enumerate(self.simulators, start):
+            self.read_initial_state(index, simulator)
+
+    def read_initial_state(self, index: int, simulator: TwinBuilderSimulator):
+        buffers = self.buffers
+        buffers['states'][index] = [simulator.state[name] for name in simulator.state_variable_names]
+        buffers['time_index'][index] = simulator.state['time_index']
+        buffers['episode_steps'][index] = 0
+        buffers['dones'][index] = False
+
+    def reset(self, indices=None, config: Dict = None):
+        """ Starts a new episode on the given instances of this worker, all of them by default """
+        if config is not None:
+            self.config = dict(config)
+        for index in range(self.start, self.stop):
+            if indices is None or index in indices:
+                simulator = self.simulators[index - self.start]
+                simulator.episode_start(self.config)
+                self.read_initial_state(index, simulator)
+
+    def step(self):
+        buffers = self.buffers
+        actions, states, dones = buffers['actions'], buffers['states'], buffers['dones']
+        time_index, episode_steps = buffers['time_index'], buffers['episode_steps']
+        for index, simulator in enumerate(self.simulators, self.start):
+            if dones[index]:
+                if not self.auto_reset:
+                    continue
+                dones[index] = False
+
+            try:
+                states[index] = simulator.step_values(actions[index])
+                time_index[index] = simulator.time_index - simulator.step_size
+                episode_steps[index] += 1
+                done = simulator.halted() or (self.max_episode_steps is not None
+                                              and episode_steps[index] >= self.max_episode_steps)
+            except TwinRuntimeError as err:
+                logger.warning("Instance %d halted: %s", index, err.message)
+                done = True
+            if not done:
+                continue
+
+            if self.auto_reset:
+                # The states of the step are those of the new episode, the flag tells the episode ended
+                buffers['final_states'][index] = states[index]
+                simulator.episode_finish()
+                simulator.episode_start(self.config)
+                self.read_initial_state(index, simulator)
+            dones[index] = True
+
+    def close(self):
+        for simulator in self.simulators:
+            simulator.close()
+
+
+def shared_buffer_views(raw_buffers: Dict, shapes: Dict) -> Dict:
+    """ NumPy views of the shared buffers """
+    return {name: np.frombuffer(raw, dtype=VEC_TWIN_BUFFERS[name][1]).reshape(shapes[name])
+            for name, raw in raw_buffers.items()}
+
+
+def serve_instances(connection, cpu, start, stop, raw_buffers, shapes, simulator_args, simulator_options, config,
+                    auto_reset, max_episode_steps):
+    """
+    Worker process: builds the simulators of its instances, then runs the commands received until an empty message.
+    Every command is answered with an empty message, or with the error it failed with.
+    """
+    # The parent stops the workers by closing their connection
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if cpu is not None:
+        os.sched_setaffinity(0, {cpu})
+    worker = None
+    try:
+        try:
+            worker = VecTwinWorker(start, stop, shared_buffer_views(raw_buffers, shapes), simulator_args,
+                                   simulator_options, config, auto_reset, max_episode_steps)
+            connection.send_bytes(b'')
+        except Exception:
+            connection.send_bytes(traceback.format_exc().encode())
+            return
+
+        while True:
+            try:
+                command = connection.recv_bytes()
+            except EOFError:
+                return
+            if not command:
+                return
+            try:
+                if command == STEP_COMMAND:
+                    worker.step()
+                else:
+                    worker.reset(*pickle.loads(command[1:]))
+                reply = b''
+            except Exception:
+                reply = traceback.format_exc().encode()
+            connection.send_bytes(reply)
+    finally:
+        if worker is not None:
+            worker.close()
+        connection.close()
+        stop_logging()
+        sys.stdout.flush()
+
+
+class VecTwin():
+    """
+    number_of_instances copies of a twin model stepped in lockstep. step takes the actions of every instance as a
+    (number_of_instances x actions) array, in action_variable_names order, and returns the states as a
+    (number_of_instances x states) array with the done flag of each instance, without a dictionary per instance.
+    The instances are TwinBuilderSimulator (or simulator_class) instances built from simulator_args and
+    simulator_options and spread in contiguous blocks over workers threads, or worker processes pinned to CPUs
+    when processes is set. The action, state and flag matrices are shared with the workers (shared memory for
+    processes), each worker reading and writing the rows of its own instances, so a step only sends a one byte
+    command per worker process.
+
+    Done instances start a new episode at once with auto_reset: the states returned are then those of the new
+    episode and final_states holds the last state of the finished one. reset starts new episodes on some or all
+    of the instances, with the episode config (step_size, action_repeat, ...).
+    """
+    def __init__(self, number_of_instances: int, simulator_args: List, simulator_options: Dict = None,
+                 config: Dict = None, workers: int = None, processes: bool = False, auto_reset: bool = True,
+                 max_episode_steps: int = None, pin_cpus: bool = True):
+        self.number_of_instances = number_of_instances
+        self.action_variable_names = list(simulator_args[2])
+        self.state_variable_names = list(simulator_args[1])
+        self.processes = processes
+        cpus = [None]
+        if hasattr(os, 'sched_getaffinity'):
+            cpus = sorted(os.sched_getaffinity(0))
+        workers = min(workers or len(cpus), number_of_instances)
+        if not (pin_cpus and processes):
+            cpus = [None]
+
+        columns = {'actions': len(self.action_variable_names), 'states': len(self.state_variable_names)}
+        shapes = {name: (number_of_instances, columns[kind]) if kind else (number_of_instances,)
+                  for name, (kind, _) in VEC_TWIN_BUFFERS.items()}
+        # Contiguous blocks of instances, the first ones one instance larger when they do not divide evenly
+        bounds = np.linspace(0, number_of_instances, workers + 1).astype(int)
+        blocks = list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+        self.workers = []
+        self.connections = []
+        self.executor = None
+        if processes:
+            # Fork where available so that workers start with the modules already imported by the parent
+            start_methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('fork' if 'fork' in start_methods else 'spawn')
+            raw_buffers = {name: context.RawArray(np.ctypeslib.as_ctypes_type(dtype), int(np.prod(shapes[name])))
+                           for name, (_, dtype) in VEC_TWIN_BUFFERS.items()}
+            self.buffers = shared_buffer_views(raw_buffers, shapes)
+            for worker_index, (start, stop) in enumerate(blocks):
+                parent_connection, child_connection = context.Pipe()
+                process = context.Process(
+                    target=serve_instances, name="VecTwinWorker-{}".format(worker_index), daemon=True,
+                    args=(child_connection, cpus[worker_index % len(cpus)], start, stop, raw_buffers, shapes,
+                          simulator_args, simulator_options, config, auto_reset, max_episode_steps))
+                process.start()
+                child_connection.close()
+                self.workers.append(process)
+                self.connections.append(parent_connection)
+            # The instances load in parallel, each worker answering once its simulators are built
+            self.wait_for_workers()
+        else:
+            self.buffers = {name: np.zeros(shapes[name], dtype=dtype) for name, (_, dtype) in VEC_TWIN_BUFFERS.items()}
+            self.workers = [VecTwinWorker(start, stop, self.buffers, simulator_args, simulator_options, config,
+                                          auto_reset, max_episode_steps)
+                            for start, stop in blocks]
+            if len(self.workers) > 1:
+                self.executor = ThreadPoolExecutor(max_workers=len(self.workers), thread_name_prefix='VecTwin')
+
+        self.actions = self.buffers['actions']
+        self.states = self.buffers['states']
+        self.final_states = self.buffers['final_states']
+        self.time_index = self.buffers['time_index']
+        self.episode_steps = self.buffers['episode_steps']
+        self.dones = self.buffers['dones']
+
+    def wait_for_workers(self):
+        errors = [reply.decode() for reply in (connection.recv_bytes() for connection in self.connections) if reply]
+        if errors:
+            raise RuntimeError("VecTwin worker failed:\n{}".format(errors[0]))
+
+    def reset(self, indices: List[int] = None, config: Dict = None) -> np.ndarray:
+        """ Starts new episodes on the given instances (all by default) and returns the states of every instance """
+        if indices is not None:
+            indices = set(int(index) for index in indices)
+        if self.processes:
+            command = RESET_COMMAND + pickle.dumps((indices, config))
+            for connection in self.connections:
+                connection.send_bytes(command)
+            self.wait_for_workers()
+        elif self.executor is None:
+            self.workers[0].reset(indices, config)
+        else:
+            list(self.executor.map(lambda worker: worker.reset(indices, config), self.workers))
+        return self.states
+
+    def step(self, actions=None):
+        """
+        Steps every instance with its row of actions (or of the actions buffer, when actions is None) and returns
+        the states and done flags buffers, overwritten by the next step
+        """
+        if actions is not None:
+            np.copyto(self.actions, actions)
+        if self.processes:
+            for connection in self.connections:
+                connection.send_bytes(STEP_COMMAND)
+            self.wait_for_workers()
+        elif self.executor is None:
+            self.workers[0].step()
+        else:
+            list(self.executor.map(VecTwinWorker.step, self.workers))
+        return self.states, self.dones
+
+    def close(self):
+        if self.processes:
+            for connection in self.connections:
+                try:
+                    connection.send_bytes(b'')
+                except (BrokenPipeError, OSError):
+                    pass
+                connection.close()
+            for process in self.workers:
+                process.join()
+        else:
+            if self.executor is not None:
+                self.executor.shutdown()
+            for worker in self.workers:
+                worker.close()
+        self.workers = []
+        self.connections = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
@@ -0,0 +1,194 @@
+"""
+Starts each episode in a process forked from a cached, already warmed-up twin (a "zygote"), so that episode start costs a fork instead of load, initialize and warm-up.
+Copyright 2021, Microsoft Corp.
+"""
+
+import logging
+import os
+import sys
+import time
+import traceback
+from collections import OrderedDict
+from multiprocessing import Pipe
+from typing import List
+
+import numpy as np
+
+from twin_runtime.twin_runtime_error import TwinRuntimeError
+
+from .ConnectorLogging import stop_logging
+from .TwinBuilderSimulator import RESET_SECONDS, ZYGOTE_EVICTIONS, ZYGOTE_HITS, ZYGOTE_MISSES, TwinBuilderSimulator
+
+logger = logging.getLogger(__name__)
+
+class ZygoteEpisode():
+    """ Parent side of an episode running in a process forked from a zygote """
+    def __init__(self, pid, connection, number_of_actions):
+        self.pid = pid
+        self.connection = connection
+        self.actions = np.zeros(number_of_actions)
+
+    def step(self, action_values: List) -> np.ndarray:
+        self.actions[:] = action_values
+        try:
+            self.connection.send_bytes(self.actions)
+            reply = self.connection.recv_bytes()
+        except (EOFError, OSError):
+            # The episode process died without replying
+            reply = b''
+        if not reply:
+            pid = self.pid
+            self.finish()
+            raise TwinRuntimeError("The episode process {} failed, see its output for details".format(pid))
+        return np.frombuffer(reply, dtype=np.float64)
+
+    def finish(self):
+        if self.pid is None:
+            return
+        try:
+            self.connection.send_bytes(b'')
+        except (BrokenPipeError, OSError):
+            pass
+        self.connection.close()
+        os.waitpid(self.pid, 0)
+        self.pid = None
+
+
+def serve_episode(zygote: TwinBuilderSimulator, connection):
+    """
+    Runs in the forked child: steps the inherited copy of the zygote for every action received
+    and replies with the state values followed by the state time index. An empty message ends the episode.
+    """
+    state_names = zygote.state_variable_names + ['time_index']
+    while True:
+        message = connection.recv_bytes()
+        if not message:
+            return
+        action_values = np.frombuffer(message, dtype=np.float64).tolist()
+        try:
+            zygote.episode_step(dict(zip(zygote.action_variable_names, action_values)))
+        except Exception:
+            traceback.print_exc()
+            connection.send_bytes(b'')
+            return
+        connection.send_bytes(np.array([zygote.state[name] for name in state_names]))
+
+
+def fork_episode(zygote: TwinBuilderSimulator) -> ZygoteEpisode:
+    parent_connection, child_connection = Pipe()
+    sys.stdout.flush()
+    pid = os.fork()
+    if pid == 0:
+        exit_code = 0
+        try:
+            parent_connection.close()
+            serve_episode(zygote, child_connection)
+        except BaseException:
+            traceback.print_exc()
+            exit_code = 1
+        finally:
+            # Skip the interpreter teardown, the twins belong to the parent process
+            stop_logging()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(exit_code)
+
+    child_connection.close()
+    return ZygoteEpisode(pid, parent_connection, len(zygote.action_variable_names))
+
+
+class ZygoteTwinBuilderSimulator(TwinBuilderSimulator):
+    """
+    TwinBuilderSimulator whose episodes run in child processes forked from warmed-up twins.
+    Twins are loaded, initialized and warmed up once per distinct (step_size, warm-up actions) key and kept
+    in a least recently used cache of at most max_zygotes entries. Requires os.fork (Linux containers).
+    """
+    def __init__(self, twin_model_file, state_variable_names: List,
+                 action_variable_names: List,
+                 number_of_warm_up_steps, warm_up_action_variable_values: List,
+                 max_zygotes: int = 4, **simulator_options):
+        if not hasattr(os, 'fork'):
+            raise RuntimeError("ZygoteTwinBuilderSimulator requires os.fork, which is not available on this platform")
+
+        self.zygotes = OrderedDict()
+        self.max_zygotes = max_zygotes
+        self.episode = None
+        self.zygote_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        super().__init__(twin_model_file, state_variable_names, action_variable_names,
+                         number_of_warm_up_steps, warm_up_action_variable_values, **simulator_options)
+
+    def get_zygote(self, step_size) -> TwinBuilderSimulator:
+        key = (step_size, tuple(self.warm_up_action_variable_values))
+        zygote = self.zygotes.get(key)
+        if zygote is not None:
+            self.zygotes.move_to_end(key)
+            self.zygote_stats['hits'] += 1
+            ZYGOTE_HITS.inc()
+            return zygote
+
+        self.zygote_stats['misses'] += 1
+        ZYGOTE_MISSES.inc()
+        zygote = TwinBuilderSimulator(self.twin_model_file, self.state_variable_names, self.action_variable_names,
+                                      self.number_of_warm_up_steps, self.warm_up_action_variable_values,
+                                      reuse_twin=False, step_size=step_size, twin_log_level=self.twin_log_level,
+                                      log_router=self.log_router)
+        self.zygotes[key] = zygote
+        while len(self.zygotes) > self.max_zygotes:
+            _, evicted = self.zygotes.popitem(last=False)
+            evicted.close()
+            self.zygote_stats['evictions'] += 1
+            ZYGOTE_EVICTIONS.inc()
+        return zygote
+
+    def reset(self, step_size):
+        start = time.perf_counter()
+        self.finish_episode()
+        self.done = False
+        self.step_size = step_size
+
+        zygote = self.get_zygote(step_size)
+        # Inherited by the episode process, which does the sub-steps
+        zygote.sub_step_method = self.sub_step_method
+        zygote.set_action_repeat(self.action_repeat, self.state_aggregation)
+        self.state = dict(zygote.state)
+        self.time_index = zygote.time_index
+        self.episode = fork_episode(zygote)
+
+        elapsed = time.perf_counter() - start
+        RESET_SECONDS['fork'].observe(elapsed)
+        self.reset_stats['count'] += 1
+        self.reset_stats['total_seconds'] += elapsed
+        self.reset_stats['last_seconds'] = elapsed
+        logger.info("Reset (fork) took %.3fs, zygote hits %d, misses %d, evictions %d",
+                    elapsed, self.zygote_stats['hits'], self.zygote_stats['misses'], self.zygote_stats['evictions'])
+
+    def step_values(self, action_values) -> np.ndarray:
+        """ Steps the twin in the episode process, see TwinBuilderSimulator.step_values """
+        try:
+            values = self.episode.step(action_values)
+        except TwinRuntimeError:
+            self.episode = None
+            self.done = True
+            raise
+
+        # The reply ends with the time index of the state
+        self.time_index = values[-1] + self.step_size
+        return values[:-1]
+
+    def episode_finish(self):
+        """ Called at the end of each episode """
+        self.end_trajectory()
+        self.finish_episode()
+
+    def finish_episode(self):
+        if self.episode is not None:
+            self.episode.finish()
+            self.episode = None
+
+    def close(self):
+        """ Ends the running episode and closes every zygote """
+        self.end_trajectory(finished=False)
+        self.finish_episode()
+        while self.zygotes:
+            _, zygote = self.zygotes.popitem()
+            zygote.close()
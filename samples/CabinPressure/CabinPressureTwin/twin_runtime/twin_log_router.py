@@ -0,0 +1,234 @@
+import gzip
+import itertools
+import logging
+import os
+import queue
+import re
+import shutil
+import tempfile
+import threading
+import weakref
+
+logger = logging.getLogger(__name__)
+
+# Routers whose background compression has to be restarted in a forked child
+_routers = weakref.WeakSet()
+
+
+def default_twin_log_dir(use_tmpfs=False):
+    # TWIN_LOG_DIR overrides the location; tmpfs keeps verbose logs off the disk, falling back when it is missing
+    log_dir = os.environ.get('TWIN_LOG_DIR')
+    if log_dir:
+        return log_dir
+    if use_tmpfs and os.path.isdir('/dev/shm'):
+        return os.path.join('/dev/shm', 'twin_logs')
+    return os.path.join(tempfile.gettempdir(), 'twin_logs')
+
+
+class TwinLogRouter:
+    """
+    Gives each TwinRuntime instance its own log file, or one per opening of the model when per_open is set, so that
+    twins of one container never write the same file. The runtime writes a log until TwinClose; finish then moves it
+    to a numbered archive, keeping its last max_bytes bytes, and a background thread compresses it. At most
+    backup_count archives are kept per instance, and the oldest archives of the folder are removed once they add up
+    to more than max_total_bytes.
+
+    A twin kept open between episodes writes a single log until it is closed, so max_bytes alone would only cap
+    its archive. needs_rotation tells when such a live log has grown past max_bytes: the simulator then reopens the
+    twin at the next episode start, which archives the log and starts a new one.
+    """
+
+    def __init__(self, log_dir=None, use_tmpfs=False, max_bytes=10 * 2 ** 20, backup_count=3,
+                 max_total_bytes=200 * 2 ** 20, compress=True, per_open=False):
+        self.log_dir = log_dir or default_twin_log_dir(use_tmpfs)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.max_total_bytes = max_total_bytes
+        self.compress = compress
+        self.per_open = per_open
+        self.stats = {'rotated': 0, 'finished': 0, 'compressed': 0, 'truncated': 0, 'removed': 0, 'bytes_in': 0, 'bytes_out': 0}
+        self._reset_process_state()
+        _routers.add(self)
+
+    def _reset_process_state(self):
+        self._instances = itertools.count()
+        self._opens = {}
+        self._stems = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def __getstate__(self):
+        # Locks, queues and threads stay in the process, a spawned worker starts its own
+        state = dict(self.__dict__)
+        for name in ('_instances', '_opens', '_stems', '_lock', '_queue', '_thread'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset_process_state()
+        _routers.add(self)
+
+    def instance_stem(self, model_path):
+        model_name = os.path.splitext(os.path.basename(model_path))[0]
+        return '{}-{}-{}'.format(model_name, os.getpid(), next(self._instances))
+
+    def log_path(self, stem):
+        """ Log file for the next opening of the twin of the instance stem """
+        os.makedirs(self.log_dir, exist_ok=True)
+        if not self.per_open:
+            return os.path.join(self.log_dir, stem + '.log')
+        with self._lock:
+            opening = self._opens.get(stem, 0)
+            self._opens[stem] = opening + 1
+            log_path = os.path.join(self.log_dir, '{}-{}.log'.format(stem, opening))
+            self._stems[log_path] = stem
+        return log_path
+
+    def needs_rotation(self, log_path):
+        """ Whether the live log of an open twin is past max_bytes and has to be reopened """
+        if not self.max_bytes:
+            return False
+        try:
+            if os.path.getsize(log_path) <= self.max_bytes:
+                return False
+        except OSError:
+            return False
+        self.stats['rotated'] += 1
+        return True
+
+    def finish(self, log_path):
+        """ Archives the log of a closed twin and queues its compression """
+        try:
+            size = os.path.getsize(log_path)
+        except OSError:
+            return
+        if size == 0:
+            os.remove(log_path)
+            return
+
+        with self._lock:
+            stem = self._stems.pop(log_path, None) or os.path.splitext(os.path.basename(log_path))[0]
+            archive_path = os.path.join(self.log_dir, '{}.{}.log'.format(stem, self._next_archive_number(stem)))
+            os.replace(log_path, archive_path)
+            self.stats['finished'] += 1
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._archive_logs, name="TwinLogArchiver", daemon=True)
+                self._thread.start()
+        self._queue.put((stem, archive_path))
+
+    def _next_archive_number(self, stem):
+        pattern = re.compile(re.escape(stem) + r'\.(\d+)\.log')
+        numbers = [int(match.group(1)) for match in map(pattern.match, os.listdir(self.log_dir)) if match]
+        return max(numbers, default=-1) + 1
+
+    def _archive_logs(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._archive(*item)
+            except OSError as err:
+                logger.warning("Could not archive the twin log %s: %s", item[1], err)
+            finally:
+                self._queue.task_done()
+
+    def _archive(self, stem, archive_path):
+        try:
+            self._compact(archive_path)
+        except FileNotFoundError:
+            # Pruned meanwhile by another process sharing the folder, to keep it under max_total_bytes
+            pass
+        self._remove_old_archives(stem)
+
+    def _compact(self, archive_path):
+        size = os.path.getsize(archive_path)
+        self.stats['bytes_in'] += size
+        if self.max_bytes and size > self.max_bytes:
+            # Errors are at the end of the log, keep its tail (in place, an archive pruned meanwhile stays removed)
+            with open(archive_path, 'r+b') as log_file:
+                log_file.seek(size - self.max_bytes)
+                tail = log_file.read()
+                log_file.seek(0)
+                log_file.write(tail)
+                log_file.truncate()
+            self.stats['truncated'] += 1
+
+        if self.compress:
+            with open(archive_path, 'rb') as log_file, gzip.open(archive_path + '.gz', 'wb', compresslevel=6) as gz:
+                shutil.copyfileobj(log_file, gz, 1 << 20)
+            os.remove(archive_path)
+            self.stats['compressed'] += 1
+            archive_path += '.gz'
+        self.stats['bytes_out'] += os.path.getsize(archive_path)
+
+    def _remove_old_archives(self, stem):
+        pattern = re.compile(re.escape(stem) + r'\.(\d+)\.log(\.gz)?$')
+        archives = sorted(((int(match.group(1)), match.group(0))
+                           for match in map(pattern.match, os.listdir(self.log_dir)) if match), reverse=True)
+        for _, file_name in archives[self.backup_count:]:
+            self._remove(os.path.join(self.log_dir, file_name))
+
+        if self.max_total_bytes:
+            # Archives of every instance and process, the newest first
+            archives = []
+            for entry in os.scandir(self.log_dir):
+                if re.search(r'\.\d+\.log(\.gz)?$', entry.name):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        # Compressed or removed meanwhile by the process that wrote it
+                        continue
+                    archives.append((stat.st_mtime, stat.st_size, entry.path))
+            archives.sort(reverse=True)
+            total = 0
+            for _, size, path in archives:
+                total += size
+                if total > self.max_total_bytes:
+                    self._remove(path)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            self.stats['removed'] += 1
+        except FileNotFoundError:
+            pass
+
+    def wait(self):
+        """ Blocks until the queued logs are archived """
+        self._queue.join()
+
+    def close(self):
+        self.wait()
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._thread = None
+
+
+_default_router = None
+_default_router_lock = threading.Lock()
+
+
+def default_twin_log_router():
+    """ Router shared by the twins of this process that were not given one """
+    global _default_router
+    with _default_router_lock:
+        if _default_router is None:
+            _default_router = TwinLogRouter()
+        return _default_router
+
+
+def _reset_routers_after_fork():
+    global _default_router_lock
+    _default_router_lock = threading.Lock()
+    for router in _routers:
+        router._lock = threading.Lock()
+        router._queue = queue.Queue()
+        router._thread = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_routers_after_fork)
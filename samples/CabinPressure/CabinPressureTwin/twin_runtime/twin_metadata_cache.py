@@ -0,0 +1,156 @@
+from twin_runtime.twin_runtime_error import PropertyStatusFlag
+
+import hashlib
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+METADATA_FORMAT_VERSION = 1
+
+# Text and numeric properties of the variables, in the column order of the model properties DataFrame
+TEXT_PROPERTIES = ['Type', 'Unit', 'Quantity Type', 'Description']
+VALUE_PROPERTIES = ['Start', 'Min', 'Max', 'Nominal']
+
+# Status stored for a text property the runtime returned as NULL, the other codes are PropertyStatusFlag values
+NULL_TEXT_STATUS = -1
+
+# Content hashes keyed by (path, size, modification time), and metadata loaded in this process keyed by content hash
+_content_hashes = {}
+_loaded_metadata = {}
+_cache_lock = threading.Lock()
+
+
+def default_metadata_cache_dir():
+    # TWIN_METADATA_CACHE_DIR overrides the location, an empty value disables the cache
+    cache_dir = os.environ.get('TWIN_METADATA_CACHE_DIR')
+    if cache_dir is None:
+        cache_dir = os.path.join(tempfile.gettempdir(), 'twin_runtime_metadata')
+    return cache_dir or None
+
+
+def twin_content_hash(model_path):
+    model_path = os.path.abspath(model_path)
+    stat = os.stat(model_path)
+    stat_key = (model_path, stat.st_size, stat.st_mtime_ns)
+    with _cache_lock:
+        content_hash = _content_hashes.get(stat_key)
+    if content_hash is not None:
+        return content_hash
+
+    sha256 = hashlib.sha256()
+    with open(model_path, 'rb') as model_file:
+        for block in iter(lambda: model_file.read(1 << 20), b''):
+            sha256.update(block)
+    content_hash = sha256.hexdigest()
+    with _cache_lock:
+        _content_hashes[stat_key] = content_hash
+    return content_hash
+
+
+class TwinMetadata:
+    """
+    Names, default settings and variable properties of a twin model, stored in a .npz file named after the content
+    hash of the .twin file. The file is written once (atomically) and only read afterwards, so any number of
+    processes can share it; within a process the loaded metadata is shared by all the TwinRuntime instances.
+    The arrays are read from the file on first access.
+    """
+
+    def __init__(self, cache_path, arrays=None):
+        self.cache_path = cache_path
+        self._arrays = arrays
+        self._property_rows = None
+
+    @staticmethod
+    def load(cache_dir, content_hash):
+        cache_path = os.path.join(cache_dir, '{}.npz'.format(content_hash))
+        with _cache_lock:
+            metadata = _loaded_metadata.get(cache_path)
+            if metadata is None and os.path.isfile(cache_path):
+                metadata = TwinMetadata(cache_path)
+                _loaded_metadata[cache_path] = metadata
+        return metadata
+
+    @staticmethod
+    def store(cache_dir, content_hash, arrays):
+        cache_path = os.path.join(cache_dir, '{}.npz'.format(content_hash))
+        arrays = dict(arrays, format_version=np.array(METADATA_FORMAT_VERSION))
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            file_descriptor, temp_path = tempfile.mkstemp(dir=cache_dir, suffix='.npz.tmp')
+            with os.fdopen(file_descriptor, 'wb') as temp_file:
+                np.savez(temp_file, **arrays)
+            os.replace(temp_path, cache_path)
+        except OSError as err:
+            print("Could not write the twin metadata cache {}: {}".format(cache_path, err))
+
+        metadata = TwinMetadata(cache_path, arrays)
+        with _cache_lock:
+            _loaded_metadata[cache_path] = metadata
+        return metadata
+
+    @property
+    def arrays(self):
+        if self._arrays is None:
+            with np.load(self.cache_path, allow_pickle=False) as npz_file:
+                arrays = {name: npz_file[name] for name in npz_file.files}
+            if arrays.get('format_version') != METADATA_FORMAT_VERSION:
+                arrays = {}
+            self._arrays = arrays
+        return self._arrays
+
+    @property
+    def is_valid(self):
+        return 'model_name' in self.arrays
+
+    @property
+    def has_properties(self):
+        return 'property_names' in self.arrays
+
+    @property
+    def parameter_names(self):
+        return self.arrays['parameter_names']
+
+    @property
+    def input_names(self):
+        return self.arrays['input_names']
+
+    @property
+    def output_names(self):
+        return self.arrays['output_names']
+
+    @property
+    def default_settings(self):
+        return tuple(self.arrays['default_settings'].tolist())
+
+    def has_property(self, var_name):
+        return var_name in self._decoded_property_rows()
+
+    def property_rows(self, var_names):
+        """ Rows of the model properties DataFrame for the given variables, as build_prop_info_df returns them """
+        rows = self._decoded_property_rows()
+        return [list(rows[name]) for name in var_names]
+
+    def _decoded_property_rows(self):
+        if self._property_rows is None:
+            arrays = self.arrays
+            rows = {}
+            for index, name in enumerate(arrays['property_names'].tolist()):
+                text = [decode_property(value, status)
+                        for value, status in zip(arrays['property_text'][index].tolist(),
+                                                 arrays['property_text_status'][index].tolist())]
+                values = [decode_property(value, status)
+                          for value, status in zip(arrays['property_values'][index].tolist(),
+                                                   arrays['property_value_status'][index].tolist())]
+                rows[name] = [name, text[0], text[1], text[2], values[0], values[1], values[2], values[3], text[3]]
+            self._property_rows = rows
+        return self._property_rows
+
+
+def decode_property(value, status):
+    if status == PropertyStatusFlag.TWIN_VARPROP_OK.value:
+        return value
+    if status == NULL_TEXT_STATUS:
+        return None
+    return PropertyStatusFlag(status).name
@@ -1,69 +1,133 @@
 from twin_runtime.twin_runtime_error import *
 from twin_runtime.twin_runtime_error import TwinRuntimeError
 from twin_runtime.log_level import LogLevel
+from twin_runtime.twin_log_router import TwinLogRouter
+from twin_runtime.twin_metadata_cache import TwinMetadata, TEXT_PROPERTIES, VALUE_PROPERTIES, NULL_TEXT_STATUS, \
+    default_metadata_cache_dir, twin_content_hash
 
 from pathlib import Path
 from ctypes import*
 
-
-import pandas as pd
+# pandas is only needed by the DataFrame variants of batch mode and the property tables, it is imported by those on
+# first use so that the stepping path starts without it
 import numpy as np
 import os
 import json
 import sys
 import math
 import platform
+import threading
 
 CUR_DIR = getattr(sys, '_MEIPASS', os.path.abspath(os.path.dirname(__file__)))
 
 default_log_name = "model.log"
 
+# Process-wide registry of the loaded twin runtime libraries, keyed by absolute library path
+_loaded_libraries = {}
+_loaded_libraries_lock = threading.Lock()
+
+# TwinOpen unpacks the model into a folder shared by all the twins of that model, which TwinClose removes:
+# concurrent opens and closes fail, so they are serialized in the process
+_open_close_lock = threading.Lock()
+
+# (argtypes, restype) of every twin runtime SDK function used by the wrapper.
+# Name and value arrays are passed as pointers to their first element so that one declaration fits all sizes.
+SDK_PROTOTYPES = {
+    'IsTwinCrossPlatform': ([c_char_p, POINTER(c_bool)], c_int),
+    'TwinGetModelDependencies': ([c_char_p, POINTER(c_char_p)], c_int),
+    'TwinOpen': ([c_char_p, POINTER(c_void_p), c_char_p, c_int], c_int),
+    'TwinClose': ([c_void_p], c_int),
+    'TwinReset': ([c_void_p], c_int),
+    'TwinGetStatusString': ([c_void_p], c_char_p),
+    'TwinGetModelName': ([c_void_p], c_char_p),
+    'TwinGetAPIVersion': ([c_void_p], c_char_p),
+    'TwinGetNumParameters': ([c_void_p, POINTER(c_int)], c_int),
+    'TwinGetNumInputs': ([c_void_p, POINTER(c_int)], c_int),
+    'TwinGetNumOutputs': ([c_void_p, POINTER(c_int)], c_int),
+    'TwinGetParamNames': ([c_void_p, POINTER(c_char_p), c_int], c_int),
+    'TwinGetInputNames': ([c_void_p, POINTER(c_char_p), c_int], c_int),
+    'TwinGetOutputNames': ([c_void_p, POINTER(c_char_p), c_int], c_int),
+    'TwinInstantiate': ([c_void_p], c_int),
+    'TwinInitialize': ([c_void_p], c_int),
+    'TwinSetParamByName': ([c_void_p, c_char_p, c_double], c_int),
+    'TwinSetStrParamByName': ([c_void_p, c_char_p, c_char_p], c_int),
+    'TwinSetParamByIndex': ([c_void_p, c_int, c_double], c_int),
+    'TwinGetOutputs': ([c_void_p, POINTER(c_double), c_int], c_int),
+    'TwinSimulate': ([c_void_p, c_double, c_double], c_int),
+    'TwinSimulateBatchMode': ([c_void_p, POINTER(POINTER(c_double)), c_int, POINTER(POINTER(c_double)), c_int,
+                               c_double, c_int], c_int),
+    'TwinSimulateBatchModeCSV': ([c_void_p, c_char_p, c_char_p, c_double, c_int], c_int),
+    'TwinSetInputs': ([c_void_p, POINTER(c_double), c_int], c_int),
+    'TwinSetInputByName': ([c_void_p, c_char_p, c_double], c_int),
+    'TwinSetInputByIndex': ([c_void_p, c_int, c_double], c_int),
+    'TwinGetOutputByName': ([c_void_p, c_char_p, POINTER(c_double)], c_int),
+    'TwinGetOutputByIndex': ([c_void_p, c_int, POINTER(c_double)], c_int),
+    'TwinGetDefaultSimulationSettings': ([c_void_p, POINTER(c_double), POINTER(c_double), POINTER(c_double)], c_int),
+    'TwinGetVarDataType': ([c_void_p, c_char_p, POINTER(c_char_p)], c_int),
+    'TwinGetVarUnit': ([c_void_p, c_char_p, POINTER(c_char_p)], c_int),
+    'TwinGetVarStart': ([c_void_p, c_char_p, POINTER(c_double)], c_int),
+    'TwinGetStrVarStart': ([c_void_p, c_char_p, POINTER(c_char_p)], c_int),
+    'TwinGetVarMin': ([c_void_p, c_char_p, POINTER(c_double)], c_int),
+    'TwinGetVarMax': ([c_void_p, c_char_p, POINTER(c_double)], c_int),
+    'TwinGetVarNominal': ([c_void_p, c_char_p, POINTER(c_double)], c_int),
+    'TwinGetVarQuantityType': ([c_void_p, c_char_p, POINTER(c_char_p)], c_int),
+    'TwinGetVarDescription': ([c_void_p, c_char_p, POINTER(c_char_p)], c_int),
+    'TwinGetVisualizationResources': ([c_void_p, POINTER(c_char_p)], c_int),
+    'TwinEnableROMImages': ([c_void_p, c_char_p, POINTER(c_char_p), c_int], c_int),
+    'TwinDisableROMImages': ([c_void_p, c_char_p, POINTER(c_char_p), c_int], c_int),
+    'TwinGetROMImages': ([c_void_p, c_char_p, POINTER(c_char_p), c_int, POINTER(c_char_p)], c_int),
+    'TwinGetDefaultROMImageDirectory': ([c_void_p, c_char_p, POINTER(c_char_p)], c_int),
+    'TwinSetROMImageDirectory': ([c_void_p, c_char_p, c_char_p], c_int),
+}
+
+
+def declare_sdk_prototypes(twin_runtime_library):
+    for function_name, (argtypes, restype) in SDK_PROTOTYPES.items():
+        sdk_function = getattr(twin_runtime_library, function_name)
+        sdk_function.argtypes = argtypes
+        sdk_function.restype = restype
+
+
+def _setup_env(sdk_folder_path):
+    if platform.system() == 'Windows':
+        sep = ';'
+    else:
+        sep = ':'
+    path = os.environ.get('PATH', '')
+    if sdk_folder_path not in path.split(sep):
+        os.environ['PATH'] = '{}{}{}'.format(sdk_folder_path, sep, path)
+
 
 class TwinRuntime:
+    """
+    Several TwinRuntime instances can simulate concurrently, each on its own thread: ctypes releases the GIL during
+    the SDK calls, the SDK prototypes are declared once per library and all the model state lives on the instance.
+    A single instance must not be used from several threads at the same time.
+    """
 
     debug_mode = False
-    twin_status = None
-    is_model_opened = False
-    is_model_initialized = False
-    is_model_instantiated = False
-    last_time_stop = 0
-
-    model_name = None
-    number_parameters = None
-    number_inputs = None
-    number_outputs = None
-
-    has_default_settings = False
-    p_end_time = None
-    p_step_size = None
-    p_tolerance = None
-
-    output_names = None
-    input_names = None
-    parameter_names = None
 
     if platform.system() == 'Windows':
         twin_runtime_library = 'TwinRuntimeSDK.dll'
     else:
         twin_runtime_library = 'TwinRuntimeSDK.so'
 
-    @staticmethod    
+    @staticmethod
     def load_dll(twin_runtime_library_path=None):
+        # The library is loaded, the environment patched and the prototypes declared once per process and path.
+        if twin_runtime_library_path is None:
+            twin_runtime_library_path = os.path.join(CUR_DIR, TwinRuntime.twin_runtime_library)
+        twin_runtime_library_path = os.path.abspath(twin_runtime_library_path)
 
-        def _setup_env(sdk_folder_path):
-            if platform.system() == 'Windows':
-                sep = ';'
-            else:
-                sep = ':'
-            os.environ['PATH'] = '{}{}{}'.format(sdk_folder_path, sep, os.environ['PATH'])
+        with _loaded_libraries_lock:
+            twin_runtime_library = _loaded_libraries.get(twin_runtime_library_path)
+            if twin_runtime_library is None:
+                _setup_env(sdk_folder_path=os.path.dirname(twin_runtime_library_path))
+                twin_runtime_library = cdll.LoadLibrary(twin_runtime_library_path)
+                declare_sdk_prototypes(twin_runtime_library)
+                _loaded_libraries[twin_runtime_library_path] = twin_runtime_library
 
-        if twin_runtime_library_path is None:
-            folder = os.path.join(CUR_DIR)
-            _setup_env(sdk_folder_path=folder)
-            return cdll.LoadLibrary(os.path.join(folder, TwinRuntime.twin_runtime_library))
-        else:
-            _setup_env(sdk_folder_path=os.path.dirname(twin_runtime_library_path))
-            return cdll.LoadLibrary(twin_runtime_library_path)
+        return twin_runtime_library
 
     @staticmethod
     def twin_is_cross_platform(twin_runtime_lib, file_path):
@@ -92,11 +156,39 @@ class TwinRuntime:
         return twin_dependencies_dict
 
     def __init__(self, model_path, log_path=None, twin_runtime_library_path=None, log_level=LogLevel.TWIN_LOG_WARNING, 
-                 load_model=True):
+                 load_model=True, use_metadata_cache=True, log_router: TwinLogRouter = None, log_stem=None):
 
         local_path = os.path.dirname(__file__)
         model_path = Path(model_path)
         self.log_level = log_level
+        explicit_log_path = log_path
+
+        # Model state, per instance so that instances can run on separate threads
+        self.twin_status = None
+        self.is_model_opened = False
+        self.is_model_initialized = False
+        self.is_model_instantiated = False
+        self.last_time_stop = 0
+
+        self.model_name = None
+        self.number_parameters = None
+        self.number_inputs = None
+        self.number_outputs = None
+
+        self.has_default_settings = False
+        self.p_end_time = None
+        self.p_step_size = None
+        self.p_tolerance = None
+
+        self.output_names = None
+        self.input_names = None
+        self.parameter_names = None
+
+        self._outputs_buffer = None
+
+        # Names, default settings and variable properties are read from the metadata cache when it is enabled
+        self.metadata_cache_dir = default_metadata_cache_dir() if use_metadata_cache else None
+        self._metadata = None
 
         if model_path.is_file() is False:
             raise FileNotFoundError("File is not found at {}".format(model_path.absolute()))
@@ -112,142 +204,51 @@ class TwinRuntime:
         self.log_path = log_path.encode()
 
         # ---------------- Mapping sdk functions as class methods --------------------
+        # Prototypes are declared once per library by load_dll, see SDK_PROTOTYPES
         self._modelPointer = c_void_p()
 
         self._TwinOpen = self._twin_runtime_library.TwinOpen
-        self._TwinOpen.restype = c_int
-
         self._TwinClose = self._twin_runtime_library.TwinClose
-
         self._TwinReset = self._twin_runtime_library.TwinReset
-        self._TwinReset.restype = c_int
-
         self.TwinGetStatusString = self._twin_runtime_library.TwinGetStatusString
-        self.TwinGetStatusString.argtypes = [c_void_p]
-        self.TwinGetStatusString.restype = c_char_p
-
         self._TwinGetModelName = self._twin_runtime_library.TwinGetModelName
-        self._TwinGetModelName.restype = c_char_p
-
         self._TwinGetAPIVersion = self._twin_runtime_library.TwinGetAPIVersion
-        self._TwinGetAPIVersion.restype = c_char_p
-
         self._TwinGetNumParameters = self._twin_runtime_library.TwinGetNumParameters
-        self._TwinGetNumParameters.restype = c_int
-
         self._TwinGetNumInputs = self._twin_runtime_library.TwinGetNumInputs
-        self._TwinGetNumInputs.restype = c_int
-
         self._TwinGetNumOutputs = self._twin_runtime_library.TwinGetNumOutputs
-        self._TwinGetNumOutputs.restype = c_int
-
         self._TwinGetParamNames = self._twin_runtime_library.TwinGetParamNames
-        self._TwinGetParamNames.restype = c_int
-
         self._TwinGetInputNames = self._twin_runtime_library.TwinGetInputNames
-        self._TwinGetInputNames.restype = c_int
-
         self._TwinGetOutputNames = self._twin_runtime_library.TwinGetOutputNames
-        self._TwinGetOutputNames.restype = c_int
-
         self._TwinInstantiate = self._twin_runtime_library.TwinInstantiate
-        self._TwinInstantiate.argtypes = [c_void_p]
-        self._TwinInstantiate.restype = c_int
-
         self._TwinInitialize = self._twin_runtime_library.TwinInitialize
-        self._TwinInitialize.argtypes = [c_void_p]
-        self._TwinInitialize.restype = c_int
-
         self._TwinSetParamByName = self._twin_runtime_library.TwinSetParamByName
-        self._TwinSetParamByName.argtypes = [c_void_p, c_char_p, c_double]
-        self._TwinSetParamByName.restype = c_int
-
         self._TwinSetStrParamByName = self._twin_runtime_library.TwinSetStrParamByName
-        self._TwinSetStrParamByName.argtypes = [c_void_p, c_char_p, c_char_p]
-        self._TwinSetStrParamByName.restype = c_int
-
         self._TwinSetParamByIndex = self._twin_runtime_library.TwinSetParamByIndex
-        self._TwinSetParamByIndex.argtypes = [c_void_p, c_int, c_double]
-        self._TwinSetParamByIndex.restype = c_int
-
         self._TwinGetOutputs = self._twin_runtime_library.TwinGetOutputs
-        self._TwinGetOutputs.restype = c_int
-
         self._TwinSimulate = self._twin_runtime_library.TwinSimulate
-        self._TwinSimulate.restype = c_int
-
         self._TwinSimulateBatchMode = self._twin_runtime_library.TwinSimulateBatchMode
-        self._TwinSimulateBatchMode.restype = c_int
-
         self._TwinSimulateBatchModeCSV = self._twin_runtime_library.TwinSimulateBatchModeCSV
-        self._TwinSimulateBatchModeCSV.restype = c_int
-
         self._TwinSetInputs = self._twin_runtime_library.TwinSetInputs
-        self._TwinSetInputs.restype = c_int
-
         self._TwinSetInputByName = self._twin_runtime_library.TwinSetInputByName
-        self._TwinSetInputByName.argtypes = [c_void_p, c_char_p, c_double]
-        self._TwinSetInputByName.restype = c_int
-
         self._TwinSetInputByIndex = self._twin_runtime_library.TwinSetInputByIndex
-        self._TwinSetInputByIndex.argtypes = [c_void_p, c_int, c_double]
-        self._TwinSetInputByIndex.restype = c_int
-
         self._TwinGetOutputByName = self._twin_runtime_library.TwinGetOutputByName
-        self._TwinGetOutputByName.restype = c_int
-
         self._TwinGetOutputByIndex = self._twin_runtime_library.TwinGetOutputByIndex
-        self._TwinGetOutputByIndex.restype = c_int
-
         self._TwinGetDefaultSimulationSettings = self._twin_runtime_library.TwinGetDefaultSimulationSettings
-        self._TwinGetDefaultSimulationSettings.restype = c_int
-
         self._TwinGetVarDataType = self._twin_runtime_library.TwinGetVarDataType
-        self._TwinGetVarDataType.restype = c_int
-
         self._TwinGetVarUnit = self._twin_runtime_library.TwinGetVarUnit
-        self._TwinGetVarUnit.restype = c_int
-
         self._TwinGetVarStart = self._twin_runtime_library.TwinGetVarStart
-        self._TwinGetVarStart.restype = c_int
-
         self._TwinGetStrVarStart = self._twin_runtime_library.TwinGetStrVarStart
-        self._TwinGetStrVarStart.restype = c_int
-
         self._TwinGetVarMin = self._twin_runtime_library.TwinGetVarMin
-        self._TwinGetVarMin.restype = c_int
-
         self._TwinGetVarMax = self._twin_runtime_library.TwinGetVarMax
-        self._TwinGetVarMax.restype = c_int
-
         self._TwinGetVarNominal = self._twin_runtime_library.TwinGetVarNominal
-        self._TwinGetVarNominal.restype = c_int
-
         self._TwinGetVarQuantityType = self._twin_runtime_library.TwinGetVarQuantityType
-        self._TwinGetVarQuantityType.restype = c_int
-
         self._TwinGetVarDescription = self._twin_runtime_library.TwinGetVarDescription
-        self._TwinGetVarDescription.restype = c_int
-
         self._TwinGetVisualizationResources = self._twin_runtime_library.TwinGetVisualizationResources
-        self._TwinGetVisualizationResources.restype = c_int
-
         self._TwinEnableROMImages = self._twin_runtime_library.TwinEnableROMImages
-        self._TwinEnableROMImages.restype = c_int
-
         self._TwinDisableROMImages = self._twin_runtime_library.TwinDisableROMImages
-        self._TwinDisableROMImages.restype = c_int
-
         self._TwinGetROMImages = self._twin_runtime_library.TwinGetROMImages
-        self._TwinGetROMImages.restype = c_int
-
         self._TwinGetDefaultROMImageDirectory = self._twin_runtime_library.TwinGetDefaultROMImageDirectory
-        self._TwinGetDefaultROMImageDirectory.argtypes = [c_void_p, c_char_p, POINTER(c_char_p)]
-        self._TwinGetDefaultROMImageDirectory.restype = c_int
-
         self._TwinSetROMImageDirectory = self._twin_runtime_library.TwinSetROMImageDirectory
-        self._TwinSetROMImageDirectory.argtypes = [c_void_p, c_char_p, c_char_p]
-        self._TwinSetROMImageDirectory.restype = c_int
 
         model_path = Path(model_path)
         if model_path.is_file() is False:
@@ -261,6 +262,13 @@ class TwinRuntime:
         self.model_path = model_path.absolute().as_posix().encode()
         self.log_path = log_path.encode()
 
+        # With a log router the runtime log goes to a file of this instance (or of log_stem, which successive
+        # instances can share), archived by the router on twin_close
+        self.log_router = log_router if explicit_log_path is None else None
+        self._log_stem = None
+        if self.log_router is not None:
+            self._log_stem = log_stem or self.log_router.instance_stem(model_path)
+
         if load_model:
             self.twin_load(log_level)
 
@@ -306,16 +314,31 @@ class TwinRuntime:
     Functions for opening and closing a Twin model. Opening models is hidden within the constructor.
     """
     def twin_load(self, log_level):
+        if self.log_router is not None:
+            self.log_path = self.log_router.log_path(self._log_stem).encode()
         file_buf = create_string_buffer(self.model_path)
         log_buf = create_string_buffer(self.log_path)
 
-        self.twin_status = self._TwinOpen(file_buf, byref(self._modelPointer), log_buf, c_int(log_level.value))
+        with _open_close_lock:
+            self.twin_status = self._TwinOpen(file_buf, byref(self._modelPointer), log_buf, c_int(log_level.value))
 
         self.evaluate_twin_status(self.twin_status, self, "twin_load")
         self.is_model_opened = True
 
         self.model_name = self._TwinGetModelName(self._modelPointer)
 
+        metadata = self.twin_get_metadata()
+        if metadata is not None:
+            self.parameter_names = metadata.parameter_names
+            self.input_names = metadata.input_names
+            self.output_names = metadata.output_names
+            self.number_parameters = len(self.parameter_names)
+            self.number_inputs = len(self.input_names)
+            self.number_outputs = len(self.output_names)
+            self.p_end_time, self.p_step_size, self.p_tolerance = metadata.default_settings
+            self.has_default_settings = True
+            return
+
         self.twin_get_number_inputs()
         self.twin_get_number_outputs()
         self.twin_get_number_params()
@@ -325,8 +348,13 @@ class TwinRuntime:
         self.twin_get_output_names()
         self.load_twin_default_sim_settings()
 
+        self.store_metadata()
+
     def twin_close(self):
-        self._TwinClose(self._modelPointer)
+        with _open_close_lock:
+            self._TwinClose(self._modelPointer)
+        if self.log_router is not None and self.is_model_opened:
+            self.log_router.finish(self.log_path.decode())
         self.is_model_opened = False
         self.is_model_initialized = False
         self.is_model_instantiated = False
@@ -337,7 +365,7 @@ class TwinRuntime:
         self.number_inputs = None
         self.number_outputs = None
 
-        self.has_default_settings = None
+        self.has_default_settings = False
         self.p_end_time = None
         self.p_step_size = None
         self.p_tolerance = None
@@ -400,8 +428,6 @@ class TwinRuntime:
             raise TwinRuntimeError("The model has to be opened before returning parameter names!")
 
         if self.parameter_names is None:
-            self._TwinGetParamNames.argtypes = [c_void_p, POINTER(c_char_p * self.number_parameters), c_int]
-
             parameter_names_c = (c_char_p * self.number_parameters)()
 
             self.twin_status = self._TwinGetParamNames(self._modelPointer,parameter_names_c, self.number_parameters)
@@ -418,8 +444,6 @@ class TwinRuntime:
             raise TwinRuntimeError("The model has to be opened before returning input names!")
 
         if self.input_names is None:
-            self._TwinGetInputNames.argtypes = [c_void_p, POINTER(c_char_p * self.number_inputs), c_int]
-
             input_names_c = (c_char_p * self.number_inputs)()
 
             self.twin_status = self._TwinGetInputNames(self._modelPointer, input_names_c, self.number_inputs)
@@ -436,8 +460,6 @@ class TwinRuntime:
             raise TwinRuntimeError("The model has to be opened before returning output names!")
 
         if self.output_names is None:
-            self._TwinGetInputNames.argtypes = [c_void_p, POINTER(c_char_p * self.number_outputs), c_int]
-
             output_names_c = (c_char_p * self.number_outputs)()
 
             self.twin_status = self._TwinGetOutputNames(self._modelPointer, output_names_c, self.number_outputs)
@@ -643,38 +665,145 @@ class TwinRuntime:
         self.evaluate_twin_status(self.twin_status, self, "twin_simulate")
 
     def twin_simulate_batch_mode(self, input_df, output_column_names, step_size=0, interpolate=0, time_as_index=False):
-        output_number_of_columns = self.number_outputs + 1
-
         if self.is_model_initialized is False:
             raise TwinRuntimeError("The Model has to be initialized before simulation!")
 
         local_df = input_df  # Creates a local copy so that the source DF does not get modified outside this scope
-        num_input_rows = local_df.shape[0]
         if time_as_index:
             local_df = local_df.reset_index()
 
-        end_time = local_df.iloc[-1, 0]
+        input_array = np.ascontiguousarray(local_df.to_numpy(dtype=np.float64))
+        output_array = self.twin_simulate_batch_mode_array(input_array, step_size, interpolate)
+
+        # The DataFrame wraps the output buffer written by the runtime, no copy is made
+        import pandas as pd
+        output_df = pd.DataFrame(data=output_array, index=np.arange(0, output_array.shape[0]),
+                                 columns=output_column_names, copy=False)
+
+        return output_df
+
+    # Same as twin_simulate_batch_mode but works on C-contiguous float64 arrays (first column being the time)
+    def twin_simulate_batch_mode_array(self, input_array, step_size=0, interpolate=0, output_array=None):
+        output_number_of_columns = self.number_outputs + 1
+
+        if self.is_model_initialized is False:
+            raise TwinRuntimeError("The Model has to be initialized before simulation!")
+
+        input_array = np.ascontiguousarray(input_array, dtype=np.float64)
+        if input_array.ndim != 2:
+            raise TwinRuntimeError("The input array must be two dimensional (rows x [time, inputs])!")
+        num_input_rows = input_array.shape[0]
+
+        end_time = input_array[-1, 0]
         if step_size != 0:
             max_output_rows = int(math.ceil(end_time / step_size) + 1)
         else:
             max_output_rows = num_input_rows
 
-        # Preallocate Dataframe rows
-        local_df = local_df.astype(np.float64)
-        input_data = build_ctype_2d_array(num_input_rows, local_df)
+        if output_array is None:
+            output_array = np.zeros((max_output_rows, output_number_of_columns), dtype=np.float64)
+        elif output_array.dtype != np.float64 or not output_array.flags['C_CONTIGUOUS'] \
+                or output_array.shape[1] != output_number_of_columns or output_array.shape[0] < max_output_rows:
+            raise TwinRuntimeError("The output array must be a C-contiguous float64 array of at least {} rows and "
+                                   "{} columns!".format(max_output_rows, output_number_of_columns))
 
-        # Pandas float to Python equivalent
-        out_data = build_empty_ctype_2d_array(max_output_rows, output_number_of_columns)
+        input_data = build_row_pointer_table(input_array)
+        out_data = build_row_pointer_table(output_array)
 
-        self.twin_status = self._TwinSimulateBatchMode(self._modelPointer, byref(input_data), c_int(num_input_rows),
-                                                       byref(out_data), c_int(max_output_rows),
+        self.twin_status = self._TwinSimulateBatchMode(self._modelPointer, input_data, c_int(num_input_rows),
+                                                       out_data, c_int(max_output_rows),
                                                        c_double(step_size),
                                                        c_int(interpolate))
-        data = [np.ctypeslib.as_array(out_data[i], shape=(output_number_of_columns,)) for i in range(max_output_rows)]
-        output_df = pd.DataFrame(data=data, index=np.arange(0, max_output_rows), columns=output_column_names)
         self.evaluate_twin_status(self.twin_status, self, "twin_simulate_batch_mode")
 
-        return output_df
+        return output_array
+
+    # Generator version of batch mode for inputs that do not fit in memory. Input chunks (arrays or DataFrames with
+    # the time first, or a CSV/Parquet file path) are simulated one after the other, the model state carrying over
+    # from one chunk to the next, and the output is yielded chunk by chunk, optionally reduced over windows of
+    # 'decimation' rows with aggregation 'last', 'mean', 'min' or 'max'. Peak memory is bounded by the chunk size.
+    def twin_simulate_batch_mode_stream(self, input_chunks, step_size=0, interpolate=0, decimation=1,
+                                        aggregation='last', output_column_names=None, chunk_rows=100000):
+        if self.is_model_initialized is False:
+            raise TwinRuntimeError("The Model has to be initialized before simulation!")
+        if aggregation not in OUTPUT_AGGREGATIONS:
+            raise TwinRuntimeError("The aggregation must be one of {}!".format(", ".join(OUTPUT_AGGREGATIONS)))
+
+        output_number_of_columns = self.number_outputs + 1
+        last_input_row = None
+        grid_start = None
+        next_grid_index = 0
+        pending = np.empty((0, output_number_of_columns))
+
+        chunks = read_input_chunks(input_chunks, chunk_rows)
+        next_chunk = next(chunks, None)
+        while next_chunk is not None:
+            input_chunk, next_chunk = next_chunk, next(chunks, None)
+            if input_chunk.shape[0] == 0:
+                continue
+            if last_input_row is None and input_chunk.shape[0] == 1 and next_chunk is not None:
+                # Batch mode needs an end time past the start time
+                next_chunk = np.vstack((input_chunk, next_chunk))
+                continue
+
+            # A batch mode call continuing a simulation only writes the outputs after the current time, the last
+            # input row of the previous chunk is repeated so that the inputs are held or interpolated across chunks
+            if last_input_row is not None and input_chunk[0, 0] > last_input_row[0]:
+                input_chunk = np.vstack((last_input_row, input_chunk))
+            last_input_row = input_chunk[-1].copy()
+
+            # A continuation with a step_size would restart its output grid at its first input row, so every chunk
+            # is simulated at its input times merged with the step_size grid (and the final end time, as batch mode
+            # does), keeping only the outputs on the grid. This gives the same outputs as a single batch mode call.
+            output_times = None
+            if step_size != 0:
+                if grid_start is None:
+                    grid_start = input_chunk[0, 0]
+                last_grid_index = int(math.floor((input_chunk[-1, 0] - grid_start) / step_size + 1e-9))
+                output_times = grid_start + step_size * np.arange(next_grid_index, last_grid_index + 1)
+                next_grid_index = last_grid_index + 1
+                if next_chunk is None:
+                    output_times = np.union1d(output_times, input_chunk[-1:, 0])
+                input_chunk = merge_input_times(input_chunk, output_times, interpolate)
+
+            output_array = np.zeros((input_chunk.shape[0], output_number_of_columns), dtype=np.float64)
+            input_data = build_row_pointer_table(input_chunk)
+            out_data = build_row_pointer_table(output_array)
+            self.twin_status = self._TwinSimulateBatchMode(self._modelPointer, input_data, c_int(input_chunk.shape[0]),
+                                                           out_data, c_int(input_chunk.shape[0]),
+                                                           c_double(0),
+                                                           c_int(interpolate))
+            self.evaluate_twin_status(self.twin_status, self, "twin_simulate_batch_mode_stream")
+
+            # Rows past the last one written by the runtime are left zeroed, their time goes backwards
+            backwards = np.flatnonzero(np.diff(output_array[:, 0]) <= 0)
+            if backwards.size:
+                output_array = output_array[:backwards[0] + 1]
+            if output_times is not None:
+                output_array = output_array[np.isin(output_array[:, 0], output_times)]
+            if output_array.shape[0] == 0:
+                continue
+
+            if decimation > 1:
+                output_array = np.vstack((pending, output_array))
+                complete_rows = output_array.shape[0] - output_array.shape[0] % decimation
+                pending = output_array[complete_rows:].copy()
+                output_array = aggregate_output_rows(output_array[:complete_rows], decimation, aggregation)
+                if output_array.shape[0] == 0:
+                    continue
+
+            yield self._wrap_stream_output(output_array, output_column_names)
+
+        if pending.shape[0]:
+            yield self._wrap_stream_output(aggregate_output_rows(pending, pending.shape[0], aggregation),
+                                           output_column_names)
+
+    @staticmethod
+    def _wrap_stream_output(output_array, output_column_names):
+        if output_column_names is None:
+            return output_array
+        import pandas as pd
+        return pd.DataFrame(data=output_array, columns=output_column_names, copy=False)
 
     # This method will generate the response also as a csv
     def twin_simulate_batch_mode_csv(self, input_csv, output_csv, step_size=0, interpolate=0):
@@ -698,6 +827,9 @@ class TwinRuntime:
     def twin_reset(self):
         self.twin_status = self._TwinReset(self._modelPointer)
         self.evaluate_twin_status(self.twin_status, self, "twin_reset")
+        # The model stays instantiated but has to be initialized again
+        self.is_model_initialized = False
+        self.last_time_stop = 0
 
     """
     Input/output handling
@@ -710,25 +842,31 @@ class TwinRuntime:
         if len(input_array) != self.number_inputs:
             raise TwinRuntimeError("The input array size must match the the models number of inputs!")
 
-        array_np = np.array(input_array)
-        array_ctypes = array_np.ctypes.data_as(POINTER(c_double * self.number_inputs))
+        array_np = np.ascontiguousarray(input_array, dtype=np.float64)
+        array_ctypes = array_np.ctypes.data_as(POINTER(c_double))
 
-        self._TwinSetInputs.argtypes = [c_void_p, POINTER(c_double * self.number_inputs), c_int]
         self.twin_status = self._TwinSetInputs(self._modelPointer, array_ctypes, self.number_inputs)
-        self.evaluate_twin_status(self.twin_status, self, "twin_get_outputs")
+        self.evaluate_twin_status(self.twin_status, self, "twin_set_inputs")
 
     def twin_get_outputs(self):
         if self.is_model_initialized is False:
             raise TwinRuntimeError("The Model has to be initialized before it can return outputs!")
 
-        self._TwinGetOutputs.argtypes = [c_void_p, POINTER(c_double * self.number_outputs), c_int]
-        outputs = (c_double * self.number_outputs)()
+        # The ctypes buffer is reused across calls, only the returned list is new
+        outputs = self._outputs_buffer
+        if outputs is None or len(outputs) != self.number_outputs:
+            outputs = self._outputs_buffer = (c_double * self.number_outputs)()
 
         self.twin_status = self._TwinGetOutputs(self._modelPointer, outputs, self.number_outputs)
         self.evaluate_twin_status(self.twin_status, self, "twin_get_outputs")
 
-        outputs_list = np.array(outputs).tolist()
-        return outputs_list
+        return outputs[:]
+
+    def twin_build_io_plan(self, input_names, output_names):
+        if self.is_model_opened is False:
+            raise TwinRuntimeError("The model has to be opened before building an input/output plan!")
+
+        return TwinIOPlan(self, input_names, output_names)
 
     def twin_set_param_by_name(self, param_name, value):
         if self.is_model_instantiated is False:
@@ -875,6 +1013,68 @@ class TwinRuntime:
             self.p_end_time, self.p_step_size, self.p_tolerance = self.twin_get_default_simulation_settings()
             self.has_default_settings = True
 
+    # Metadata cached on disk for this model file content, None when the cache is disabled or has no entry yet
+    def twin_get_metadata(self):
+        if self._metadata is None and self.metadata_cache_dir is not None:
+            metadata = TwinMetadata.load(self.metadata_cache_dir, twin_content_hash(self.model_path.decode()))
+            if metadata is not None and metadata.is_valid:
+                self._metadata = metadata
+        return self._metadata
+
+    def store_metadata(self, with_properties=False):
+        arrays = {'model_name': np.array(self.model_name.decode()),
+                  'parameter_names': np.asarray(self.parameter_names, dtype=str),
+                  'input_names': np.asarray(self.input_names, dtype=str),
+                  'output_names': np.asarray(self.output_names, dtype=str),
+                  'default_settings': np.array([self.p_end_time, self.p_step_size, self.p_tolerance], dtype=np.float64)}
+        if with_properties:
+            var_names = list(self.input_names) + list(self.output_names) + list(self.parameter_names)
+            arrays.update(self.twin_query_var_properties(var_names))
+
+        if self.metadata_cache_dir is None:
+            self._metadata = TwinMetadata(None, arrays)
+        else:
+            self._metadata = TwinMetadata.store(self.metadata_cache_dir,
+                                                twin_content_hash(self.model_path.decode()), arrays)
+        return self._metadata
+
+    # Properties of the variables with their status codes, reading the SDK status instead of raising per property
+    def twin_query_var_properties(self, var_names):
+        text_functions = [self._TwinGetVarDataType, self._TwinGetVarUnit, self._TwinGetVarQuantityType,
+                          self._TwinGetVarDescription]
+        value_functions = [self._TwinGetVarStart, self._TwinGetVarMin, self._TwinGetVarMax, self._TwinGetVarNominal]
+
+        property_text = np.full((len(var_names), len(TEXT_PROPERTIES)), '', dtype=object)
+        property_text_status = np.zeros(property_text.shape, dtype=np.int8)
+        property_values = np.full((len(var_names), len(VALUE_PROPERTIES)), np.nan)
+        property_value_status = np.zeros(property_values.shape, dtype=np.int8)
+
+        text_value = c_char_p()
+        number_value = c_double()
+        for row, var_name in enumerate(var_names):
+            c_var_name = c_char_p(var_name if type(var_name) is bytes else var_name.encode())
+            for column, function in enumerate(text_functions):
+                text_value.value = None
+                status = function(self._modelPointer, c_var_name, byref(text_value))
+                if status in (1, 2, 3, 4):
+                    property_text_status[row, column] = status
+                elif text_value.value is None:
+                    property_text_status[row, column] = NULL_TEXT_STATUS
+                else:
+                    property_text[row, column] = text_value.value.decode()
+            for column, function in enumerate(value_functions):
+                status = function(self._modelPointer, c_var_name, byref(number_value))
+                if status in (1, 2, 3, 4):
+                    property_value_status[row, column] = status
+                else:
+                    property_values[row, column] = number_value.value
+
+        return {'property_names': np.asarray(var_names, dtype=str),
+                'property_text': property_text.astype(str),
+                'property_text_status': property_text_status,
+                'property_values': property_values,
+                'property_value_status': property_value_status}
+
     # pragma: no cover
     def print_model_info(self, max_var_to_print=np.inf):
 
@@ -923,6 +1123,7 @@ class TwinRuntime:
         prop_matrix_list += self.build_prop_info_df(param_vars)
 
         var_inf_columns = ['Name', 'Type', 'Unit', 'Quantity Type', 'Start', 'Min', 'Max', 'Nominal', 'Description']
+        import pandas as pd
         variable_info_df = pd.DataFrame(prop_matrix_list, columns=var_inf_columns)
 
         return variable_info_df
@@ -932,50 +1133,149 @@ class TwinRuntime:
         prop_matrix_list = self.build_prop_info_df(vars_names[:max_var_to_print])
 
         var_inf_columns = ['Name', 'Type', 'Unit', 'Quantity Type', 'Start', 'Min', 'Max', 'Nominal', 'Description']
-
+        import pandas as pd
         variable_info_df = pd.DataFrame(data=prop_matrix_list, columns=var_inf_columns)
         return variable_info_df
 
     def build_prop_info_df(self, var_names):
-        prop_matrix_list = []
-        for value in var_names:
-            o_name = value
-            try:
-                o_type = self.twin_get_var_data_type(value)
-            except (PropertyNotDefinedError, PropertyNotApplicableError, PropertyInvalidError, PropertyError) as e:
-                o_type = e.property_status_flag.name
-            try:
-                o_unit = self.twin_get_var_unit(value)
-            except (PropertyNotDefinedError, PropertyNotApplicableError, PropertyInvalidError, PropertyError) as e:
-                o_unit = e.property_status_flag.name
-            try:
-                o_quantity_type = self.twin_get_var_quantity_type(value)
-            except (PropertyNotDefinedError, PropertyNotApplicableError, PropertyInvalidError, PropertyError) as e:
-                o_quantity_type = e.property_status_flag.name
-            try:
-                o_var_description = self.twin_get_var_description(value)
-            except (PropertyNotDefinedError, PropertyNotApplicableError, PropertyInvalidError, PropertyError) as e:
-                o_var_description = e.property_status_flag.name
-            try:
-                o_start = self.twin_get_var_start(value)
-            except (PropertyNotDefinedError, PropertyNotApplicableError, PropertyInvalidError, PropertyError) as e:
-                o_start = e.property_status_flag.name
-            try:
-                o_min = self.twin_get_var_min(value)
-            except (PropertyNotDefinedError, PropertyNotApplicableError, PropertyInvalidError, PropertyError) as e:
-                o_min = e.property_status_flag.name
+        metadata = self.twin_get_metadata()
+        if metadata is None or not metadata.has_properties:
+            # All the variables are queried at once so that the cache entry serves every later request
+            metadata = self.store_metadata(with_properties=True)
+
+        other_names = [name for name in var_names if not metadata.has_property(name)]
+        if not other_names:
+            return metadata.property_rows(var_names)
+        other_metadata = TwinMetadata(None, self.twin_query_var_properties(other_names))
+        return [(metadata if metadata.has_property(name) else other_metadata).property_rows([name])[0]
+                for name in var_names]
+
+
+class TwinIOPlan:
+    """
+    Input/output plan compiled for a fixed list of input and output names.
+    Names are resolved to indices once and the plan owns reusable float64 buffers holding all the model inputs and
+    outputs, so setting the planned inputs and reading the planned outputs cost one SDK call each.
+    Inputs that are not part of the plan keep their start value.
+    """
+
+    def __init__(self, twin_runtime, input_names, output_names):
+        self.twin_runtime = twin_runtime
+        self.input_names = list(input_names)
+        self.output_names = list(output_names)
+
+        self.input_indices = _resolve_indices(twin_runtime.twin_get_input_names(), self.input_names, "input")
+        self.output_indices = _resolve_indices(twin_runtime.twin_get_output_names(), self.output_names, "output")
+
+        self.inputs = np.zeros(twin_runtime.number_inputs, dtype=np.float64)
+        for index, input_name in enumerate(twin_runtime.input_names):
             try:
-                o_max = self.twin_get_var_max(value)
-            except (PropertyNotDefinedError, PropertyNotApplicableError, PropertyInvalidError, PropertyError) as e:
-                o_max = e.property_status_flag.name
+                self.inputs[index] = twin_runtime.twin_get_var_start(input_name)
+            except (PropertyNotDefinedError, PropertyNotApplicableError, PropertyInvalidError, PropertyError):
+                pass
+        self.start_inputs = self.inputs.copy()
+        self.outputs = np.zeros(twin_runtime.number_outputs, dtype=np.float64)
+
+        self._inputs_pointer = self.inputs.ctypes.data_as(POINTER(c_double))
+        self._outputs_pointer = self.outputs.ctypes.data_as(POINTER(c_double))
+
+    def set_inputs_from(self, values):
+        twin_runtime = self.twin_runtime
+        if twin_runtime.is_model_instantiated is False:
+            raise TwinRuntimeError("The model has to be instantiated before setting inputs!")
+
+        self.inputs[self.input_indices] = values
+
+        twin_runtime.twin_status = twin_runtime._TwinSetInputs(twin_runtime._modelPointer, self._inputs_pointer,
+                                                               twin_runtime.number_inputs)
+        twin_runtime.evaluate_twin_status(twin_runtime.twin_status, twin_runtime, "set_inputs_from")
+
+    def restore_start_inputs(self):
+        # Sets every model input back to its start value, e.g. before initializing a model that was reset
+        self.inputs[:] = self.start_inputs
+        self.set_inputs_from(self.inputs[self.input_indices])
+
+    def read_outputs_into(self, values=None):
+        twin_runtime = self.twin_runtime
+        if twin_runtime.is_model_initialized is False:
+            raise TwinRuntimeError("The Model has to be initialized before it can return outputs!")
+
+        twin_runtime.twin_status = twin_runtime._TwinGetOutputs(twin_runtime._modelPointer, self._outputs_pointer,
+                                                                twin_runtime.number_outputs)
+        twin_runtime.evaluate_twin_status(twin_runtime.twin_status, twin_runtime, "read_outputs_into")
+
+        if values is None:
+            values = np.empty(len(self.output_indices), dtype=np.float64)
+        np.take(self.outputs, self.output_indices, out=values)
+        return values
+
+
+OUTPUT_AGGREGATIONS = ('last', 'mean', 'min', 'max')
+
+
+def aggregate_output_rows(output_array, window_rows, aggregation):
+    # Reduces each window of rows to one row, the time column keeping the time of the last row of the window
+    windows = output_array.reshape(-1, window_rows, output_array.shape[1])
+    if aggregation == 'last':
+        return windows[:, -1, :].copy()
+
+    reduced = getattr(np, aggregation)(windows, axis=1)
+    reduced[:, 0] = windows[:, -1, 0]
+    return reduced
+
+
+def merge_input_times(input_rows, times, interpolate):
+    # Adds input rows at the given times, held from the last row before them or linearly interpolated
+    times = times[~np.isin(times, input_rows[:, 0])]
+    if times.size == 0:
+        return input_rows
+
+    if interpolate:
+        added_rows = np.column_stack([np.interp(times, input_rows[:, 0], column) for column in input_rows.T])
+    else:
+        added_rows = input_rows[np.maximum(np.searchsorted(input_rows[:, 0], times, side='right') - 1, 0)]
+        added_rows[:, 0] = times
+    merged_rows = np.vstack((input_rows, added_rows))
+    return np.ascontiguousarray(merged_rows[np.argsort(merged_rows[:, 0], kind='stable')])
+
+
+def _is_dataframe(value):
+    # Without pandas imported there can be no DataFrame, so the check does not import it
+    pandas = sys.modules.get('pandas')
+    return pandas is not None and isinstance(value, pandas.DataFrame)
+
+
+def read_input_chunks(source, chunk_rows=100000):
+    # Yields C-contiguous float64 input chunks from an iterable of arrays/DataFrames or from a CSV or Parquet file
+    if isinstance(source, (str, Path)):
+        suffix = Path(source).suffix.lower()
+        if suffix == '.parquet':
             try:
-                o_nominal = self.twin_get_var_nominal(value)
-            except (PropertyNotDefinedError, PropertyNotApplicableError, PropertyInvalidError, PropertyError) as e:
-                o_nominal = e.property_status_flag.name
+                import pyarrow.parquet as pq
+            except ImportError:
+                raise TwinRuntimeError("Reading Parquet inputs requires the pyarrow package!")
+            chunks = (batch.to_pandas() for batch in pq.ParquetFile(source).iter_batches(batch_size=chunk_rows))
+        else:
+            import pandas as pd
+            chunks = pd.read_csv(source, chunksize=chunk_rows)
+    elif isinstance(source, np.ndarray) or _is_dataframe(source):
+        chunks = [source]
+    else:
+        chunks = source
+
+    for chunk in chunks:
+        if _is_dataframe(chunk):
+            chunk = chunk.to_numpy(dtype=np.float64)
+        yield np.ascontiguousarray(chunk, dtype=np.float64)
 
-            prop_row = [o_name, o_type, o_unit, o_quantity_type, o_start, o_min, o_max, o_nominal, o_var_description]
-            prop_matrix_list.append(prop_row)
-        return prop_matrix_list
+
+def _resolve_indices(model_names, names, kind):
+    positions = {name: index for index, name in enumerate(model_names)}
+    missing = [name for name in names if name not in positions]
+    if missing:
+        raise TwinRuntimeError("The model has no {} named {}!".format(kind, ", ".join(missing)))
+
+    return np.array([positions[name] for name in names], dtype=np.intp)
 
 
 def build_empty_ctype_2d_array(num_input_rows, number_of_columns):
@@ -1002,6 +1302,13 @@ def build_ctype_2d_array(num_input_rows, source_df):
     return input_data
 
 
+def build_row_pointer_table(array):
+    # Table of row pointers into a C-contiguous 2D float64 array, no data is copied.
+    # The table keeps a reference to the addresses buffer, the array itself must outlive the table.
+    row_addresses = array.ctypes.data + np.arange(array.shape[0], dtype=np.uintp) * np.uintp(array.strides[0])
+    return (POINTER(c_double) * array.shape[0]).from_buffer(row_addresses)
+
+
 def to_np_array(ctypes_array):
 
     array_np = np.array([x.decode() for x in ctypes_array])
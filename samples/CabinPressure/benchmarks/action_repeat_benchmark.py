@@ -0,0 +1,73 @@
+"""
+Measures the steps per second of episodes holding each action for --action-repeat twin steps, with the sub-steps in
+one batch mode call or in a loop of twin_simulate calls, checking that both give the same states for every state
+aggregation and every number of warm-up steps, none included.
+Copyright 2021, Microsoft Corp.
+"""
+
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import argparse
+
+CUR_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Add parent directory containing the TwinBuilderConnector folder to path.
+sys.path.append(os.path.dirname(os.path.dirname(CUR_DIR)))
+# Add CabinPressureTwin directory containing twin_runtime to the path.
+sys.path.append(os.path.join(CUR_DIR, "CabinPressureTwin"))
+
+import numpy as np
+
+from TwinBuilderConnector.ConnectorLogging import configure_logging
+from TwinBuilderConnector.TwinBuilderSimulator import TwinBuilderSimulator
+
+
+def run(simulator, actions, config):
+    """ Returns the states and time index after every step of one episode and the seconds spent stepping """
+    simulator.episode_start(config)
+    names = simulator.state_variable_names + ['time_index']
+    trajectory = np.empty((len(actions), len(names)))
+    start = time.perf_counter()
+    for step, action in enumerate(actions):
+        simulator.episode_step(dict(zip(simulator.action_variable_names, action)))
+        trajectory[step] = [simulator.state[name] for name in names]
+    return trajectory, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--step-size", type=float, default=0.5)
+    parser.add_argument("--action-repeat", type=int, default=4)
+    parser.add_argument("--warm-up-steps", type=int, nargs="+", default=[0, 5])
+    args = parser.parse_args()
+    configure_logging("WARNING")
+
+    twin_model_file = os.path.join(CUR_DIR, "CabinPressureTwin", "TwinModel.twin")
+    state_variable_names = ['PC', 'PCabin', 'ceiling_t', 'altitude_out', 'velocity_out']
+    action_variable_names = ['controlFlow', 'outflow']
+    rng = np.random.default_rng(0)
+    actions = rng.uniform([0.0, 0.0], [6.0, 350.0], (args.steps, 2))
+
+    print("{} steps holding each action for {} twin steps".format(args.steps, args.action_repeat))
+    print("{:>8} {:>12} {:>12} {:>12} {:>10}".format("warm-up", "aggregation", "batch st/s", "loop st/s",
+                                                    "results"))
+    for warm_up_steps in args.warm_up_steps:
+        simulators = {method: TwinBuilderSimulator(twin_model_file, state_variable_names, action_variable_names,
+                                                   warm_up_steps, [3.0, 175.0], reuse_twin=False,
+                                                   step_size=args.step_size, sub_step_method=method)
+                      for method in ('batch', 'loop')}
+        for state_aggregation in ('last', 'mean', 'min', 'max'):
+            config = {'step_size': args.step_size, 'action_repeat': args.action_repeat,
+                      'state_aggregation': state_aggregation}
+            runs = {method: run(simulator, actions, config) for method, simulator in simulators.items()}
+            print("{:>8} {:>12} {:>12.0f} {:>12.0f} {:>10}".format(
+                warm_up_steps, state_aggregation, args.steps / runs['batch'][1], args.steps / runs['loop'][1],
+                "same" if np.array_equal(runs['batch'][0], runs['loop'][0]) else "DIFFERENT"))
+        for simulator in simulators.values():
+            simulator.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+Compares the contiguous-buffer batch mode of the twin runtime against the former per-row ctypes marshalling.
+Copyright 2021, Microsoft Corp.
+"""
+
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import argparse
+import tempfile
+from ctypes import c_int, c_double
+
+# Add CabinPressureTwin directory containing twin_runtime to the path.
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "CabinPressureTwin"))
+
+import numpy as np
+import pandas as pd
+
+from twin_runtime.twin_runtime_core import TwinRuntime, build_ctype_2d_array, build_empty_ctype_2d_array, \
+    build_row_pointer_table
+
+
+def legacy_batch_mode(twin_runtime, input_df, output_column_names, step_size):
+    """ Batch mode as implemented before, one ctypes row per input and output row """
+    output_number_of_columns = twin_runtime.number_outputs + 1
+    num_input_rows = input_df.shape[0]
+    max_output_rows = int(np.ceil(input_df.iloc[-1, 0] / step_size) + 1)
+
+    local_df = input_df.astype(np.float64)
+    input_data = build_ctype_2d_array(num_input_rows, local_df)
+    out_data = build_empty_ctype_2d_array(max_output_rows, output_number_of_columns)
+
+    twin_runtime.twin_status = twin_runtime._TwinSimulateBatchMode(twin_runtime._modelPointer, input_data,
+                                                                   c_int(num_input_rows), out_data,
+                                                                   c_int(max_output_rows), c_double(step_size),
+                                                                   c_int(0))
+    data = [np.ctypeslib.as_array(out_data[i], shape=(output_number_of_columns,)) for i in range(max_output_rows)]
+    return pd.DataFrame(data=data, index=np.arange(0, max_output_rows), columns=output_column_names)
+
+
+def build_input_df(twin_runtime, rows, step_size):
+    rng = np.random.default_rng(0)
+    data = {'Time': np.arange(rows) * step_size}
+    for input_name in twin_runtime.input_names:
+        data[input_name] = rng.uniform(0.0, 1.0, rows)
+    return pd.DataFrame(data)
+
+
+def open_twin(twin_model_file, log_file):
+    twin_runtime = TwinRuntime(twin_model_file, log_file)
+    twin_runtime.twin_instantiate()
+    twin_runtime.twin_initialize()
+    return twin_runtime
+
+
+def time_call(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 5000])
+    parser.add_argument("--step-size", type=float, default=0.5)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--marshal-only", action="store_true",
+                        help="skip the end to end runs, which are dominated by the solver for large inputs")
+    args = parser.parse_args()
+
+    cur_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    twin_model_file = os.path.join(cur_dir, "CabinPressureTwin", "TwinModel.twin")
+    log_file = os.path.join(tempfile.gettempdir(), "batch_mode_benchmark.log")
+
+    print("{:>10} {:>16} {:>16} {:>16} {:>16} {:>8}".format("rows", "legacy marshal", "array marshal",
+                                                          "legacy total", "array total", "speedup"))
+    for rows in args.rows:
+        probe = open_twin(twin_model_file, log_file)
+        input_df = build_input_df(probe, rows, args.step_size)
+        output_column_names = ['Time'] + list(probe.output_names)
+        max_output_rows = int(np.ceil(input_df.iloc[-1, 0] / args.step_size) + 1)
+        probe.twin_close()
+
+        # Marshalling only: build the input structure and wrap the output into a DataFrame
+        def legacy_marshal():
+            input_data = build_ctype_2d_array(rows, input_df.astype(np.float64))
+            out_data = build_empty_ctype_2d_array(max_output_rows, len(output_column_names))
+            data = [np.ctypeslib.as_array(out_data[i], shape=(len(output_column_names),))
+                    for i in range(max_output_rows)]
+            pd.DataFrame(data=data, index=np.arange(0, max_output_rows), columns=output_column_names)
+
+        def array_marshal():
+            input_array = np.ascontiguousarray(input_df.to_numpy(dtype=np.float64))
+            output_array = np.zeros((max_output_rows, len(output_column_names)))
+            build_row_pointer_table(input_array)
+            build_row_pointer_table(output_array)
+            pd.DataFrame(data=output_array, index=np.arange(0, max_output_rows), columns=output_column_names,
+                         copy=False)
+
+        # End to end, each run on a freshly initialized twin so both paths simulate the same trajectory
+        def legacy_total():
+            twin_runtime = open_twin(twin_model_file, log_file)
+            start = time.perf_counter()
+            legacy_batch_mode(twin_runtime, input_df, output_column_names, args.step_size)
+            elapsed = time.perf_counter() - start
+            twin_runtime.twin_close()
+            return elapsed
+
+        def array_total():
+            twin_runtime = open_twin(twin_model_file, log_file)
+            start = time.perf_counter()
+            twin_runtime.twin_simulate_batch_mode(input_df, output_column_names, step_size=args.step_size)
+            elapsed = time.perf_counter() - start
+            twin_runtime.twin_close()
+            return elapsed
+
+        legacy_marshal_time = time_call(legacy_marshal, args.repeat)
+        array_marshal_time = time_call(array_marshal, args.repeat)
+        if not args.marshal_only:
+            legacy_total_time = min(legacy_total() for _ in range(args.repeat))
+            array_total_time = min(array_total() for _ in range(args.repeat))
+
+        if args.marshal_only:
+            totals = "{:>16} {:>16}".format("-", "-")
+            speedup = legacy_marshal_time / array_marshal_time
+        else:
+            totals = "{:>15.4f}s {:>15.4f}s".format(legacy_total_time, array_total_time)
+            speedup = legacy_total_time / array_total_time
+        print("{:>10} {:>15.4f}s {:>15.4f}s {} {:>7.1f}x".format(rows, legacy_marshal_time, array_marshal_time,
+                                                                totals, speedup))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+"""
+Runs the connector end to end against a local stand-in for the Bonsai service and reports steps per second, step
+turnaround percentiles, reset latency and the share of each step spent outside the twin solver.
+Copyright 2021, Microsoft Corp.
+"""
+
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import signal
+import asyncio
+import argparse
+import threading
+
+CUR_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Add parent directory containing the TwinBuilderConnector folder to path.
+sys.path.append(os.path.dirname(os.path.dirname(CUR_DIR)))
+# Add CabinPressureTwin directory containing twin_runtime to the path.
+sys.path.append(os.path.join(CUR_DIR, "CabinPressureTwin"))
+
+import numpy as np
+
+from TwinBuilderConnector.ConnectorLogging import configure_logging
+from TwinBuilderConnector.MockBonsaiService import MockBonsaiService
+from TwinBuilderConnector.Profiling import profiler
+from TwinBuilderConnector.TrajectoryRecorder import TrajectoryRecorder
+from TwinBuilderConnector.RunSession import RunSession, SessionRecovery
+from TwinBuilderConnector.TwinBuilderSimulator import TwinBuilderSimulator
+from TwinBuilderConnector.ZygoteTwinBuilderSimulator import ZygoteTwinBuilderSimulator
+from TwinBuilderConnector.PooledTwinBuilderSimulator import PooledTwinBuilderSimulator
+from TwinBuilderConnector.SharedMemoryTransport import SharedMemoryTwinBuilderSimulator
+
+SIMULATOR_CLASSES = {
+    'default': TwinBuilderSimulator,
+    'zygote': ZygoteTwinBuilderSimulator,
+    'pooled': PooledTwinBuilderSimulator,
+    'shared_memory': SharedMemoryTwinBuilderSimulator,
+}
+
+# Simulator side timings, in seconds, of the sessions run in this process
+simulator_timings = {'episode_start': [], 'episode_step': []}
+
+
+def timed_simulator_class(simulator_class):
+    """ Subclass of simulator_class recording how long resets and steps take in simulator_timings """
+    class TimedSimulator(simulator_class):
+        def episode_start(self, config=None):
+            start = time.perf_counter()
+            super().episode_start(config)
+            simulator_timings['episode_start'].append(time.perf_counter() - start)
+
+        def episode_step(self, action):
+            start = time.perf_counter()
+            super().episode_step(action)
+            simulator_timings['episode_step'].append(time.perf_counter() - start)
+
+    TimedSimulator.__name__ = 'Timed' + simulator_class.__name__
+    return TimedSimulator
+
+
+class SilencedStdout():
+    """ Sends the per-step output of the sessions (including the twin runtime's own) to /dev/null """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.saved_fd = None
+
+    def __enter__(self):
+        if self.enabled:
+            sys.stdout.flush()
+            self.saved_fd = os.dup(1)
+            with open(os.devnull, 'w') as devnull:
+                os.dup2(devnull.fileno(), 1)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.saved_fd is not None:
+            sys.stdout.flush()
+            os.dup2(self.saved_fd, 1)
+            os.close(self.saved_fd)
+            self.saved_fd = None
+
+
+def run_sync(service, session_args, simulator_options, recovery):
+    RunSession(*session_args, episode_callback=lambda episode, steps: service.all_episodes_finished.is_set(),
+               recovery=recovery, **simulator_options)
+
+
+def run_async(service, session_args, simulator_options, number_of_sessions):
+    from TwinBuilderConnector.AsyncRunSession import run_sessions
+
+    async def run_until_finished():
+        sessions = asyncio.ensure_future(run_sessions(*session_args, number_of_sessions=number_of_sessions,
+                                                      **simulator_options))
+        finished = asyncio.get_running_loop().run_in_executor(None, service.all_episodes_finished.wait)
+        await asyncio.wait([sessions, finished], return_when=asyncio.FIRST_COMPLETED)
+        # The sessions that are left only get Idle events, cancelling them unregisters them
+        sessions.cancel()
+        try:
+            await sessions
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(run_until_finished())
+
+
+def run_supervised(service, session_args, simulator_options, number_of_workers):
+    from TwinBuilderConnector.SessionSupervisor import SessionSupervisor
+
+    def stop_when_finished():
+        service.all_episodes_finished.wait()
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    supervisor = SessionSupervisor(session_args, simulator_options, number_of_workers, report_interval=3600)
+    threading.Thread(target=stop_when_finished, daemon=True).start()
+    supervisor.run()
+
+
+def percentiles_ms(samples):
+    if not samples:
+        return "{:>9} {:>9}".format("-", "-")
+    p50, p99 = np.percentile(np.asarray(samples) * 1000, [50, 99])
+    return "{:>9.2f} {:>9.2f}".format(p50, p99)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--episodes", type=int, default=10, help="episodes over all sessions")
+    parser.add_argument("--steps", type=int, default=50, help="steps per episode")
+    parser.add_argument("--step-size", type=float, default=0.5)
+    parser.add_argument("--action-repeat", type=int, default=1,
+                        help="twin steps each action is held for (episode config action_repeat)")
+    parser.add_argument("--state-aggregation", default="last", choices=["last", "mean", "min", "max"])
+    parser.add_argument("--sub-step-method", default="batch", choices=["batch", "loop"])
+    parser.add_argument("--simulator", choices=sorted(SIMULATOR_CLASSES), default='default')
+    parser.add_argument("--sessions", type=int, default=0,
+                        help="run this many sessions with AsyncRunSession, 0 to run one with RunSession")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="run this many sessions as SessionSupervisor worker processes")
+    parser.add_argument("--latency", type=float, default=0.0, help="service response delay in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="uniform jitter added to the delay in seconds")
+    parser.add_argument("--idle-every", type=int, default=0, help="send an Idle event every this many events")
+    parser.add_argument("--unregister-every", type=int, default=0,
+                        help="unregister each session after this many episodes")
+    parser.add_argument("--verbose", action="store_true", help="keep the sessions' output")
+    parser.add_argument("--log-steps-every", type=int, default=0,
+                        help="log one in every N per-step records, to measure the cost of step logging")
+    parser.add_argument("--profile", default=None, help="write a Chrome trace of the run (in process) to this file")
+    parser.add_argument("--profile-sample-ms", type=float, default=0,
+                        help="also sample the stacks every this many ms, written next to the trace as .folded")
+    parser.add_argument("--record-dir", default=None, help="record the episodes under this folder")
+    parser.add_argument("--record-format", default="npz", choices=["npz", "parquet", "arrow"])
+    args = parser.parse_args()
+    configure_logging("INFO" if args.verbose else "WARNING", step_every=args.log_steps_every)
+
+    twin_model_file = os.path.join(CUR_DIR, "CabinPressureTwin", "TwinModel.twin")
+    state_variable_names = ['PC', 'PCabin', 'ceiling_t', 'altitude_out', 'velocity_out']
+    action_variable_names = ['controlFlow', 'outflow']
+    session_args = [twin_model_file, state_variable_names, action_variable_names, 5, [3.0, 175.0]]
+
+    simulator_class = SIMULATOR_CLASSES[args.simulator]
+    simulator_options = {'simulator_class': timed_simulator_class(simulator_class),
+                         'sub_step_method': args.sub_step_method}
+    if simulator_class is ZygoteTwinBuilderSimulator:
+        simulator_options['max_zygotes'] = 1
+    elif simulator_class is PooledTwinBuilderSimulator:
+        simulator_options['pool_size'] = 1
+    recorder = None
+    if args.record_dir:
+        recorder = TrajectoryRecorder(args.record_dir, action_variable_names, state_variable_names,
+                                      file_format=args.record_format)
+        simulator_options['recorder'] = recorder
+
+    service = MockBonsaiService(total_episodes=args.episodes, steps_per_episode=args.steps,
+                                config={'step_size': args.step_size, 'action_repeat': args.action_repeat,
+                                        'state_aggregation': args.state_aggregation},
+                                action_ranges={'controlFlow': (0.0, 6.0), 'outflow': (0.0, 350.0)},
+                                latency=args.latency, jitter=args.jitter, idle_every=args.idle_every,
+                                idle_time=0.01, unregister_every=args.unregister_every).start()
+    os.environ.update(SIM_API_HOST=service.url, SIM_WORKSPACE='benchmark', SIM_ACCESS_KEY='benchmark')
+    # The sessions read interface.json from the working directory
+    os.chdir(CUR_DIR)
+
+    recovery = SessionRecovery(base_delay=0.01, max_delay=0.1)
+    if args.profile:
+        profiler.enable(args.profile_sample_ms / 1000.0 or None)
+    start = time.perf_counter()
+    with SilencedStdout(not args.verbose):
+        if args.workers > 0:
+            mode = "{} workers".format(args.workers)
+            run_supervised(service, session_args, simulator_options, args.workers)
+        elif args.sessions > 0:
+            mode = "{} async sessions".format(args.sessions)
+            run_async(service, session_args, simulator_options, args.sessions)
+        else:
+            mode = "1 session"
+            run_sync(service, session_args, simulator_options, recovery)
+    elapsed = time.perf_counter() - start
+    service.stop()
+    if recorder is not None:
+        recorder.close()
+    if args.profile:
+        profiler.disable()
+        profiler.dump(args.profile)
+
+    step_turnarounds = service.turnarounds['EpisodeStep']
+    step_times = simulator_timings['episode_step']
+    print("{}, {} simulator, service latency {:.1f} ms +/- {:.1f} ms".format(
+        mode, args.simulator, args.latency * 1000, args.jitter * 1000))
+    print("{} episodes, {} steps in {:.2f}s: {:.1f} steps/s".format(
+        service.episodes_finished, len(step_turnarounds), elapsed, len(step_turnarounds) / elapsed))
+    print("{:.1f} simulated seconds per second, {:.1f} simulated seconds per advance".format(
+        len(step_turnarounds) * args.action_repeat * args.step_size / elapsed, args.action_repeat * args.step_size))
+    print("{:<28} {:>9} {:>9}".format("", "p50 ms", "p99 ms"))
+    print("{:<28} {}".format("step turnaround", percentiles_ms(step_turnarounds)))
+    print("{:<28} {}".format("simulator step", percentiles_ms(step_times)))
+    print("{:<28} {}".format("reset (episode start)", percentiles_ms(simulator_timings['episode_start'])))
+    print("{:<28} {}".format("reset turnaround", percentiles_ms(service.turnarounds['EpisodeStart'])))
+    if step_times and step_turnarounds:
+        # Simulator timings are only collected in process, so not with --workers
+        overhead = 1.0 - sum(step_times) / sum(step_turnarounds)
+        print("share of step turnaround outside the simulator step (client, network, Python): {:.1%}".format(
+            overhead))
+    print("service requests: {}".format(service.requests))
+    if recorder is not None:
+        print("recorded episodes: {}".format(recorder.stats))
+
+
+if __name__ == '__main__':
+    main()
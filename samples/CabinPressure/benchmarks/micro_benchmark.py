@@ -0,0 +1,273 @@
+"""
+Measures the per-call cost of each layer of the twin runtime wrapper against the bundled twin model, writes the
+results with machine metadata as JSON and flags regressions against a stored baseline.
+Copyright 2021, Microsoft Corp.
+"""
+
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+from collections import OrderedDict
+
+CUR_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Add CabinPressureTwin directory containing twin_runtime to the path.
+sys.path.append(os.path.join(CUR_DIR, "CabinPressureTwin"))
+
+import numpy as np
+import pandas as pd
+
+from twin_runtime.twin_runtime_core import TwinRuntime, LogLevel, build_ctype_2d_array, build_row_pointer_table
+from twin_runtime.twin_metadata_cache import twin_content_hash
+
+RESULTS_FORMAT_VERSION = 1
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "micro_benchmark.json")
+
+
+def time_per_call(function, min_time, repeat):
+    """ Seconds per call of function: calls are batched so that each of the repeat rounds lasts at least min_time """
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number = max(number * 2, int(number * min_time / max(elapsed, 1e-9) * 1.2))
+
+    rounds = [elapsed / number]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        rounds.append((time.perf_counter() - start) / number)
+    return {'min': min(rounds), 'median': float(np.median(rounds)), 'calls_per_round': number, 'rounds': repeat}
+
+
+def open_twin(twin_model_file, log_file, use_metadata_cache=True):
+    twin_runtime = TwinRuntime(twin_model_file, log_file, log_level=LogLevel.TWIN_LOG_WARNING,
+                               use_metadata_cache=use_metadata_cache)
+    twin_runtime.twin_instantiate()
+    twin_runtime.twin_initialize()
+    return twin_runtime
+
+
+def build_cases(twin_model_file, log_file, sizes, step_size):
+    """ Benchmark name -> (setup, function), the setup returning the state the function needs """
+    cases = OrderedDict()
+
+    def initialized_twin():
+        return open_twin(twin_model_file, log_file)
+
+    def simulate_case(twin_runtime):
+        time_stop = [twin_runtime.last_time_stop]
+
+        def simulate():
+            time_stop[0] += step_size
+            twin_runtime.twin_simulate(time_stop[0])
+        return simulate
+    cases['twin_simulate'] = (initialized_twin, simulate_case)
+
+    def set_input_by_name(twin_runtime):
+        name = twin_runtime.input_names[0]
+        return lambda: twin_runtime.twin_set_input_by_name(name, 1.0)
+    cases['twin_set_input_by_name'] = (initialized_twin, set_input_by_name)
+    cases['twin_set_input_by_index'] = (initialized_twin, lambda twin: lambda: twin.twin_set_input_by_index(0, 1.0))
+
+    def get_output_by_name(twin_runtime):
+        name = twin_runtime.output_names[0]
+        return lambda: twin_runtime.twin_get_output_by_name(name)
+    cases['twin_get_output_by_name'] = (initialized_twin, get_output_by_name)
+    cases['twin_get_output_by_index'] = (initialized_twin, lambda twin: lambda: twin.twin_get_output_by_index(0))
+
+    def set_inputs(twin_runtime):
+        values = [1.0] * twin_runtime.number_inputs
+        return lambda: twin_runtime.twin_set_inputs(values)
+    cases['twin_set_inputs'] = (initialized_twin, set_inputs)
+    cases['twin_get_outputs'] = (initialized_twin, lambda twin: twin.twin_get_outputs)
+
+    def io_plan_set_inputs(twin_runtime):
+        io_plan = twin_runtime.twin_build_io_plan(twin_runtime.input_names, twin_runtime.output_names)
+        values = [1.0] * twin_runtime.number_inputs
+        return lambda: io_plan.set_inputs_from(values)
+    cases['io_plan.set_inputs_from'] = (initialized_twin, io_plan_set_inputs)
+
+    def io_plan_read_outputs(twin_runtime):
+        io_plan = twin_runtime.twin_build_io_plan(twin_runtime.input_names, twin_runtime.output_names)
+        values = np.empty(twin_runtime.number_outputs)
+        return lambda: io_plan.read_outputs_into(values)
+    cases['io_plan.read_outputs_into'] = (initialized_twin, io_plan_read_outputs)
+
+    def load_case(use_metadata_cache):
+        def setup():
+            twin_runtime = TwinRuntime(twin_model_file, log_file, use_metadata_cache=use_metadata_cache)
+            twin_runtime.twin_close()
+            return twin_runtime
+
+        def load(twin_runtime):
+            def load_and_close():
+                twin_runtime.has_default_settings = False
+                twin_runtime.twin_load(twin_runtime.log_level)
+                twin_runtime.twin_close()
+            return load_and_close
+        return setup, load
+    cases['twin_load+twin_close'] = load_case(True)
+    cases['twin_load+twin_close (no metadata cache)'] = load_case(False)
+
+    def prop_info(twin_runtime):
+        var_names = list(twin_runtime.input_names) + list(twin_runtime.output_names) + \
+            list(twin_runtime.parameter_names)
+        twin_runtime.build_prop_info_df(var_names)
+        return lambda: twin_runtime.build_prop_info_df(var_names)
+    cases['build_prop_info_df'] = (initialized_twin, prop_info)
+
+    def prop_info_uncached(twin_runtime):
+        var_names = list(twin_runtime.input_names) + list(twin_runtime.output_names) + \
+            list(twin_runtime.parameter_names)
+
+        def build():
+            # Forget the properties queried by the previous call
+            twin_runtime._metadata = None
+            twin_runtime.build_prop_info_df(var_names)
+        return build
+    cases['build_prop_info_df (no metadata cache)'] = (
+        lambda: open_twin(twin_model_file, log_file, use_metadata_cache=False), prop_info_uncached)
+
+    columns = 3
+    for rows in sizes:
+        def input_frame(rows=rows):
+            return pd.DataFrame(np.random.default_rng(0).uniform(0.0, 1.0, (rows, columns)))
+        cases['build_ctype_2d_array[{}]'.format(rows)] = (
+            input_frame, lambda frame: lambda: build_ctype_2d_array(frame.shape[0], frame))
+
+        def output_array(rows=rows):
+            return np.random.default_rng(0).uniform(0.0, 1.0, (rows, columns))
+        cases['build_row_pointer_table[{}]'.format(rows)] = (
+            output_array, lambda array: lambda: build_row_pointer_table(array))
+
+        def output_frame(array):
+            names = ['Time'] + ['out{}'.format(column) for column in range(1, columns)]
+            return lambda: pd.DataFrame(data=array, index=np.arange(0, array.shape[0]), columns=names, copy=False)
+        cases['output DataFrame[{}]'.format(rows)] = (output_array, output_frame)
+
+    return cases
+
+
+def machine_metadata(twin_model_file, twin_api_version):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=CUR_DIR, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    return {
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'available_cpus': cpus,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'twin_runtime_api': twin_api_version,
+        'model_sha256': twin_content_hash(twin_model_file),
+        'git_commit': commit,
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def compare(results, baseline, threshold):
+    """ Prints each benchmark against the baseline and returns the names that are slower by more than threshold """
+    regressions = []
+    changed = [key for key in ('machine', 'processor', 'python', 'numpy', 'pandas', 'twin_runtime_api', 'model_sha256')
+               if results['machine'].get(key) != baseline['machine'].get(key)]
+    if changed:
+        print("Baseline was recorded with a different {}, the comparison may not be meaningful".format(
+            ', '.join(changed)))
+
+    print("{:<42} {:>12} {:>12} {:>8}".format("benchmark", "baseline us", "current us", "ratio"))
+    for name, result in results['benchmarks'].items():
+        reference = baseline['benchmarks'].get(name)
+        if reference is None:
+            print("{:<42} {:>12} {:>12.3f} {:>8}".format(name, "-", result['min'] * 1e6, "new"))
+            continue
+        ratio = result['min'] / reference['min']
+        flag = ''
+        if ratio > 1.0 + threshold:
+            flag = ' REGRESSION'
+            regressions.append(name)
+        elif ratio < 1.0 / (1.0 + threshold):
+            flag = ' faster'
+        print("{:<42} {:>12.3f} {:>12.3f} {:>7.2f}x{}".format(name, reference['min'] * 1e6, result['min'] * 1e6,
+                                                             ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 100000],
+                        help="row counts of the array and DataFrame benchmarks")
+    parser.add_argument("--filter", nargs="+", default=None, help="only run benchmarks whose name contains one of these")
+    parser.add_argument("--min-time", type=float, default=0.2, help="minimum duration of a timing round in seconds")
+    parser.add_argument("--repeat", type=int, default=5, help="timing rounds per benchmark, the fastest is compared")
+    parser.add_argument("--step-size", type=float, default=0.5)
+    parser.add_argument("--output", default=None, help="write the results to this JSON file")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="flag benchmarks slower than the baseline by more than this fraction")
+    parser.add_argument("--update-baseline", action="store_true", help="store the results as the new baseline")
+    args = parser.parse_args()
+
+    twin_model_file = os.path.join(CUR_DIR, "CabinPressureTwin", "TwinModel.twin")
+    log_file = os.path.join(tempfile.gettempdir(), "micro_benchmark.log")
+
+    # Runs the benchmarks in a fixed order, each on its own twin
+    benchmarks = OrderedDict()
+    for name, (setup, function) in build_cases(twin_model_file, log_file, args.sizes, args.step_size).items():
+        if args.filter and not any(part in name for part in args.filter):
+            continue
+        state = setup()
+        benchmarks[name] = time_per_call(function(state), args.min_time, args.repeat)
+        if isinstance(state, TwinRuntime) and state.is_model_opened:
+            state.twin_close()
+        print("{:<42} {:>12.3f} us".format(name, benchmarks[name]['min'] * 1e6))
+
+    twin_runtime = TwinRuntime(twin_model_file, log_file)
+    results = {'format_version': RESULTS_FORMAT_VERSION,
+               'machine': machine_metadata(twin_model_file, twin_runtime.twin_get_api_version()),
+               'settings': {'min_time': args.min_time, 'repeat': args.repeat, 'step_size': args.step_size},
+               'benchmarks': benchmarks}
+    twin_runtime.twin_close()
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+        print("Results written to {}".format(args.output))
+
+    if args.update_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print("Baseline written to {}".format(args.baseline))
+        return
+
+    if not os.path.isfile(args.baseline):
+        print("No baseline at {}, run with --update-baseline to record one".format(args.baseline))
+        return
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    print()
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print("{} benchmark(s) slower than the baseline by more than {:.0%}".format(len(regressions), args.threshold))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
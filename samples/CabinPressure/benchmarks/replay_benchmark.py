@@ -0,0 +1,98 @@
+"""
+Replays recorded episodes in one batch mode call each, on a pool of worker threads or processes, and compares the
+replay time and the replayed states with a stepwise replay through step_values. Without --record-dir, episodes of
+random actions are first recorded to a temporary folder.
+Copyright 2021, Microsoft Corp.
+"""
+
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+CUR_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Add parent directory containing the TwinBuilderConnector folder to path.
+sys.path.append(os.path.dirname(os.path.dirname(CUR_DIR)))
+# Add CabinPressureTwin directory containing twin_runtime to the path.
+sys.path.append(os.path.join(CUR_DIR, "CabinPressureTwin"))
+
+import numpy as np
+
+from TwinBuilderConnector.ConnectorLogging import configure_logging
+from TwinBuilderConnector.TrajectoryRecorder import TrajectoryRecorder, episode_paths
+from TwinBuilderConnector.TrajectoryReplay import replay_episodes
+from TwinBuilderConnector.TwinBuilderSimulator import TwinBuilderSimulator
+
+
+def record_random_episodes(record_dir, session_args, episodes, steps, step_size, seed):
+    """ Records episodes of uniformly random actions, as the connector would during training """
+    recorder = TrajectoryRecorder(record_dir, session_args[2], session_args[1])
+    simulator = TwinBuilderSimulator(*session_args, recorder=recorder)
+    rng = np.random.default_rng(seed)
+    for _ in range(episodes):
+        simulator.episode_start({'step_size': step_size})
+        for controlFlow, outflow in rng.uniform([0.0, 0.0], [6.0, 350.0], (steps, 2)):
+            simulator.episode_step({'controlFlow': controlFlow, 'outflow': outflow})
+        simulator.episode_finish()
+    simulator.close()
+    recorder.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--record-dir", default=None, help="replay the episodes recorded under this folder")
+    parser.add_argument("--episodes", type=int, default=8, help="random episodes to record without --record-dir")
+    parser.add_argument("--steps", type=int, default=200, help="steps per random episode")
+    parser.add_argument("--step-size", type=float, default=0.5)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--processes", action="store_true", help="replay on worker processes instead of threads")
+    parser.add_argument("--rtol", type=float, default=1e-6)
+    parser.add_argument("--atol", type=float, default=1e-8)
+    args = parser.parse_args()
+    configure_logging("WARNING")
+
+    twin_model_file = os.path.join(CUR_DIR, "CabinPressureTwin", "TwinModel.twin")
+    session_args = [twin_model_file, ['PC', 'PCabin', 'ceiling_t', 'altitude_out', 'velocity_out'],
+                    ['controlFlow', 'outflow'], 5, [3.0, 175.0]]
+
+    record_dir = args.record_dir
+    if record_dir is None:
+        record_dir = tempfile.mkdtemp(prefix='replay_benchmark_')
+        record_random_episodes(record_dir, session_args, args.episodes, args.steps, args.step_size, 0)
+    paths = episode_paths(record_dir)
+    if not paths:
+        print("No recorded episodes under {}".format(record_dir))
+        sys.exit(1)
+
+    start = time.perf_counter()
+    results = replay_episodes(paths, session_args, workers=args.workers, processes=args.processes, verify=True,
+                              rtol=args.rtol, atol=args.atol)
+    elapsed = time.perf_counter() - start
+
+    steps = sum(result['steps'] for result in results)
+    batch_seconds = sum(result['seconds'] for result in results)
+    stepwise_seconds = sum(result['stepwise_seconds'] for result in results)
+    print("{} episodes, {} steps, {} {} workers, {:.2f}s wall time with the stepwise check".format(
+        len(results), steps, args.workers, "process" if args.processes else "thread", elapsed))
+    print("{:>10} {:>12} {:>12}".format("replay", "seconds", "steps/s"))
+    print("{:>10} {:>12.3f} {:>12.0f}".format("batch", batch_seconds, steps / batch_seconds))
+    print("{:>10} {:>12.3f} {:>12.0f}".format("stepwise", stepwise_seconds, steps / stepwise_seconds))
+
+    stepwise_error = max(result['stepwise']['max_rel_error'] for result in results)
+    recorded = [result['recorded'] for result in results if 'recorded' in result]
+    print("max relative error against the stepwise replay {:.3g}".format(stepwise_error))
+    if recorded:
+        print("max relative error against the recorded states {:.3g}".format(
+            max(comparison['max_rel_error'] for comparison in recorded)))
+
+    mismatches = [result['path'] for result in results if not result['stepwise']['matches']]
+    if mismatches:
+        print("{} episodes differ from their stepwise replay beyond rtol={} atol={}: {}".format(
+            len(mismatches), args.rtol, args.atol, ", ".join(mismatches)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
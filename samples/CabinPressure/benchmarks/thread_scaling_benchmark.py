@@ -0,0 +1,103 @@
+"""
+Measures steps per second of independent twin instances stepped concurrently on a thread pool, against thread count.
+Every threaded trajectory is checked against the same trajectory simulated on its own.
+Copyright 2021, Microsoft Corp.
+"""
+
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+# Add CabinPressureTwin directory containing twin_runtime to the path.
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "CabinPressureTwin"))
+
+import numpy as np
+
+from twin_runtime.twin_runtime_core import TwinRuntime
+
+
+def open_twin(twin_model_file, log_file):
+    twin_runtime = TwinRuntime(twin_model_file, log_file)
+    twin_runtime.twin_instantiate()
+    twin_runtime.twin_initialize()
+    return twin_runtime
+
+
+def build_actions(twin_runtime, steps, seed):
+    rng = np.random.default_rng(seed)
+    return rng.uniform(0.0, 1.0, (steps, twin_runtime.number_inputs))
+
+
+def run_episode(twin_runtime, actions, step_size):
+    """ Steps the twin through the actions and returns the outputs after each step """
+    io_plan = twin_runtime.twin_build_io_plan(twin_runtime.input_names, twin_runtime.output_names)
+    trajectory = np.empty((actions.shape[0], twin_runtime.number_outputs))
+    for index, action in enumerate(actions):
+        io_plan.set_inputs_from(action)
+        twin_runtime.twin_simulate((index + 1) * step_size)
+        io_plan.read_outputs_into(trajectory[index])
+    return trajectory
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--steps", type=int, default=500)
+    parser.add_argument("--step-size", type=float, default=0.5)
+    args = parser.parse_args()
+
+    cur_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    twin_model_file = os.path.join(cur_dir, "CabinPressureTwin", "TwinModel.twin")
+    log_dir = tempfile.gettempdir()
+
+    # One twin per worker, each with its own log and actions, opened before timing
+    max_threads = max(args.threads)
+    twins = [open_twin(twin_model_file, os.path.join(log_dir, "thread_scaling_benchmark_{}.log".format(worker)))
+             for worker in range(max_threads)]
+    actions = [build_actions(twins[worker], args.steps, worker) for worker in range(max_threads)]
+
+    reference = []
+    for worker in range(max_threads):
+        reference.append(run_episode(twins[worker], actions[worker], args.step_size))
+
+    print("{:>8} {:>12} {:>12} {:>10}".format("threads", "steps/s", "scaling", "results"))
+    single_thread_rate = None
+    mismatches = []
+    for threads in args.threads:
+        for twin_runtime in twins[:threads]:
+            twin_runtime.twin_close()
+            twin_runtime.twin_load(twin_runtime.log_level)
+            twin_runtime.twin_instantiate()
+            twin_runtime.twin_initialize()
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            start = time.perf_counter()
+            futures = [executor.submit(run_episode, twins[worker], actions[worker], args.step_size)
+                       for worker in range(threads)]
+            trajectories = [future.result() for future in futures]
+            elapsed = time.perf_counter() - start
+
+        rate = threads * args.steps / elapsed
+        single_thread_rate = single_thread_rate or rate
+        identical = all(np.array_equal(trajectories[worker], reference[worker]) for worker in range(threads))
+        print("{:>8} {:>12.1f} {:>11.2f}x {:>10}".format(threads, rate, rate / single_thread_rate,
+                                                        "identical" if identical else "MISMATCH"))
+        if not identical:
+            mismatches.append(threads)
+
+    for twin_runtime in twins:
+        twin_runtime.twin_close()
+    print("{} CPUs available".format(os.cpu_count()))
+
+    if mismatches:
+        print("Threaded trajectories differ from their sequential runs with {} threads".format(
+            ", ".join(map(str, mismatches))))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+Measures the round trip of one step between the session process and a worker process, without a twin: a dictionary
+of actions pickled across a pipe and a dictionary of states pickled back, against a request and a response slot of
+the shared memory rings laid out from interface.json, lock-free and with the locks taken on CPUs without ordered
+stores.
+Copyright 2021, Microsoft Corp.
+"""
+
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+
+CUR_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Add parent directory containing the TwinBuilderConnector folder to path.
+sys.path.append(os.path.dirname(os.path.dirname(CUR_DIR)))
+# Add CabinPressureTwin directory containing twin_runtime to the path.
+sys.path.append(os.path.join(CUR_DIR, "CabinPressureTwin"))
+
+import numpy as np
+
+from TwinBuilderConnector.SharedMemoryTransport import InterfaceLayout, SharedMemoryChannel, STOP_WORKER
+
+
+def echo_pipe(connection, state):
+    while True:
+        action = connection.recv()
+        if action is None:
+            return
+        connection.send(state)
+
+
+def echo_rings(channel, response):
+    request = np.empty(channel.layout.request_size)
+    while True:
+        channel.requests.get(request)
+        if request[0] == STOP_WORKER:
+            return
+        channel.responses.put(response)
+
+
+def time_pipe(context, layout, steps):
+    action = {name: 1.0 for name in layout.action_names}
+    state = {name: 1.0 for name in layout.state_names + ['time_index']}
+    parent_connection, child_connection = context.Pipe()
+    process = context.Process(target=echo_pipe, args=(child_connection, state))
+    process.start()
+    timings = np.empty(steps)
+    for step in range(steps):
+        start = time.perf_counter()
+        parent_connection.send(action)
+        parent_connection.recv()
+        timings[step] = time.perf_counter() - start
+    parent_connection.send(None)
+    process.join()
+    return timings
+
+
+def time_rings(context, layout, steps, locked=False):
+    channel = SharedMemoryChannel(layout, locked=locked)
+    response = np.ones(layout.response_size)
+    process = context.Process(target=echo_rings, args=(channel, response))
+    process.start()
+    action = {name: 1.0 for name in layout.action_names}
+    request = np.zeros(layout.request_size)
+    received = np.empty(layout.response_size)
+    timings = np.empty(steps)
+    for step in range(steps):
+        start = time.perf_counter()
+        # Both sides of a step, as SharedMemoryTwinBuilderSimulator does: actions into the slot, state dictionary out
+        for index, name in enumerate(layout.action_names, 1):
+            request[index] = action[name]
+        channel.requests.put(request)
+        channel.responses.get(received)
+        dict(zip(layout.state_names + ['time_index'], received[2:].tolist()))
+        timings[step] = time.perf_counter() - start
+    request[0] = STOP_WORKER
+    channel.requests.put(request)
+    process.join()
+    channel.close()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--steps", type=int, default=20000)
+    parser.add_argument("--interface", default=os.path.join(CUR_DIR, "interface.json"))
+    args = parser.parse_args()
+
+    layout = InterfaceLayout.from_interface(args.interface)
+    start_methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in start_methods else 'spawn')
+    print("{} actions, {} states, {} round trips, {} CPUs".format(
+        len(layout.action_names), len(layout.state_names), args.steps, os.cpu_count()))
+    print("{:<28} {:>9} {:>9} {:>9}".format("", "p50 us", "p99 us", "mean us"))
+    timers = (("pickled dicts over a pipe", time_pipe), ("shared memory rings", time_rings),
+              ("locked shared memory rings", lambda *timer_args: time_rings(*timer_args, locked=True)))
+    for name, timer in timers:
+        timings = timer(context, layout, args.steps) * 1e6
+        p50, p99 = np.percentile(timings, [50, 99])
+        print("{:<28} {:>9.1f} {:>9.1f} {:>9.1f}".format(name, p50, p99, timings.mean()))
+
+
+if __name__ == '__main__':
+    main()
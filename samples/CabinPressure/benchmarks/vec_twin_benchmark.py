@@ -0,0 +1,73 @@
+"""
+Measures the steps per second of a VecTwin of --instances twins against the number of workers, on threads or
+processes, checking every run against the states of a single worker.
+Copyright 2021, Microsoft Corp.
+"""
+
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import argparse
+
+CUR_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Add parent directory containing the TwinBuilderConnector folder to path.
+sys.path.append(os.path.dirname(os.path.dirname(CUR_DIR)))
+# Add CabinPressureTwin directory containing twin_runtime to the path.
+sys.path.append(os.path.join(CUR_DIR, "CabinPressureTwin"))
+
+import numpy as np
+
+from TwinBuilderConnector.ConnectorLogging import configure_logging
+from TwinBuilderConnector.VecTwin import VecTwin
+
+
+def run(session_args, instances, workers, processes, actions, step_size):
+    """ Returns the states after every step and the seconds spent stepping """
+    with VecTwin(instances, session_args, {'reuse_twin': False}, {'step_size': step_size}, workers=workers,
+                 processes=processes) as vec_twin:
+        vec_twin.reset()
+        trajectory = np.empty(actions.shape[:2] + (len(session_args[1]),))
+        start = time.perf_counter()
+        for step, step_actions in enumerate(actions):
+            states, _ = vec_twin.step(step_actions)
+            trajectory[step] = states
+        return trajectory, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--instances", type=int, default=8)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--steps", type=int, default=100)
+    parser.add_argument("--step-size", type=float, default=0.5)
+    parser.add_argument("--threads", action="store_true", help="run the workers on threads instead of processes")
+    args = parser.parse_args()
+    configure_logging("WARNING")
+
+    twin_model_file = os.path.join(CUR_DIR, "CabinPressureTwin", "TwinModel.twin")
+    session_args = [twin_model_file, ['PC', 'PCabin', 'ceiling_t', 'altitude_out', 'velocity_out'],
+                    ['controlFlow', 'outflow'], 5, [3.0, 175.0]]
+    rng = np.random.default_rng(0)
+    actions = rng.uniform([0.0, 0.0], [6.0, 350.0], (args.steps, args.instances, 2))
+
+    print("{} instances on {}, {} CPUs".format(args.instances, "threads" if args.threads else "processes",
+                                              len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity')
+                                              else os.cpu_count()))
+    print("{:>8} {:>12} {:>12} {:>10}".format("workers", "steps/s", "scaling", "results"))
+    reference = None
+    single_worker_rate = None
+    for workers in args.workers:
+        trajectory, seconds = run(session_args, args.instances, workers, not args.threads, actions, args.step_size)
+        rate = args.steps * args.instances / seconds
+        if reference is None:
+            reference = trajectory
+        if single_worker_rate is None:
+            single_worker_rate = rate / min(workers, args.instances)
+        print("{:>8} {:>12.0f} {:>11.2f}x {:>10}".format(
+            workers, rate, rate / single_worker_rate,
+            "same" if np.array_equal(trajectory, reference) else "DIFFERENT"))
+
+
+if __name__ == '__main__':
+    main()
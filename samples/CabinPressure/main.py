@@ -6,6 +6,7 @@ Copyright 2021, Microsoft Corp.
 #!/usr/bin/env python3
 import os
 import sys
+import argparse
 
 # Add parent directory containing the TwinBuilderConnector folder to path.
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
@@ -14,9 +15,77 @@ sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "CabinP
 
 print(f"path is {sys.path}")
 
-from TwinBuilderConnector.RunSession import RunSession
+# Imported first, the start-up timeline starts here
+from TwinBuilderConnector.StartupTimeline import startup
+# The session and simulator modules of the selected mode are imported once the arguments are parsed
+from TwinBuilderConnector.Metrics import start_metrics_exporter
+from TwinBuilderConnector.ConnectorLogging import configure_logging
+from TwinBuilderConnector.Profiling import install_profiling_signal
+from TwinBuilderConnector.TrajectoryRecorder import TrajectoryRecorder
+from twin_runtime.log_level import LogLevel
+from twin_runtime.twin_log_router import TwinLogRouter
 
 if __name__ == '__main__':
+    # Unknown arguments (access key, workspace...) are left to the Bonsai client configuration.
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--zygotes", type=int, default=0,
+                        help="fork episodes from up to this many cached warmed-up twins (Linux only), 0 to disable")
+    parser.add_argument("--pool-size", type=int, default=0,
+                        help="number of twins prepared in the background between episodes, 0 to disable")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="run this many simulator sessions as supervised worker processes, 0 to run one in process")
+    parser.add_argument("--sessions", type=int, default=0,
+                        help="run this many simulator sessions concurrently in this process with asyncio, 0 to run one")
+    parser.add_argument("--recycle-episodes", type=int, default=0,
+                        help="restart a worker after this many episodes, 0 to disable")
+    parser.add_argument("--max-rss-mb", type=float, default=0,
+                        help="restart a worker at the end of an episode once its resident memory exceeds this, 0 to disable")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve Prometheus metrics on this port (worker i uses port + i), disabled by default")
+    parser.add_argument("--metrics-file", default=None,
+                        help="periodically rewrite Prometheus metrics to this file (one file per worker)")
+    parser.add_argument("--metrics-interval", type=float, default=15.0,
+                        help="seconds between rewrites of the metrics file")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="level of the connector logs, INFO logs session events and one summary per episode")
+    parser.add_argument("--log-steps-every", type=int, default=0,
+                        help="log one in every N per-step records (events, actions, states), 0 to disable")
+    parser.add_argument("--log-steps-per-second", type=float, default=None,
+                        help="log at most this many per-step records per second")
+    parser.add_argument("--log-json", action="store_true", help="write the logs as one JSON object per line")
+    parser.add_argument("--twin-log-level", default="WARNING", choices=["ALL", "WARNING", "ERROR", "FATAL", "NONE"],
+                        help="level of the twin runtime logs, ALL is only meant for debugging the model")
+    parser.add_argument("--twin-log-dir", default=None,
+                        help="folder of the twin runtime logs (default: $TWIN_LOG_DIR or <temp>/twin_logs)")
+    parser.add_argument("--twin-log-tmpfs", action="store_true",
+                        help="write the twin runtime logs to /dev/shm when no folder is given")
+    parser.add_argument("--twin-log-per-episode", action="store_true",
+                        help="one log file per twin load instead of one per twin instance")
+    parser.add_argument("--twin-log-max-mb", type=float, default=10,
+                        help="keep the last this many MB of each finished twin log, reopening a twin kept open "
+                             "between episodes once its log passes it")
+    parser.add_argument("--twin-log-backups", type=int, default=3,
+                        help="compressed logs kept per twin instance")
+    parser.add_argument("--record-dir", default=None,
+                        help="record every episode (config, actions, states, step times) under this folder")
+    parser.add_argument("--record-format", default="npz", choices=["npz", "parquet", "arrow"],
+                        help="file format of the recorded episodes, parquet and arrow require pyarrow")
+    parser.add_argument("--record-float32", action="store_true", help="record actions and states as float32")
+    parser.add_argument("--record-compress", action="store_true",
+                        help="compress the recorded episodes, which can then no longer be memory mapped")
+    parser.add_argument("--shared-memory-worker", action="store_true",
+                        help="run the twin of each session in a worker process fed through shared memory rings")
+    parser.add_argument("--action-repeat", type=int, default=1,
+                        help="hold each action for this many twin steps, unless the episode config sets action_repeat")
+    parser.add_argument("--state-aggregation", default="last", choices=["last", "mean", "min", "max"],
+                        help="aggregation of the states over the repeated steps, unless set by the episode config")
+    parser.add_argument("--sub-step-method", default="batch", choices=["batch", "loop"],
+                        help="run the repeated steps in one batch mode call or in a loop of twin_simulate calls")
+    args, _ = parser.parse_known_args()
+
+    configure_logging(args.log_level, step_every=args.log_steps_every, steps_per_second=args.log_steps_per_second,
+                      json_format=args.log_json)
+
     twin_model_file = "./CabinPressureTwin/TwinModel.twin"
 
     # Locate twin_model_file if it is relative path from this file.
@@ -31,4 +100,59 @@ if __name__ == '__main__':
     state_variable_names = ['PC', 'PCabin', 'ceiling_t', 'altitude_out', 'velocity_out']
     action_variable_names = ['controlFlow', 'outflow']
     action_variable_values = [(6.0-0.0)/2.0, (350.0-0.0)/2.0] # start at average action values
-    RunSession(twin_model_file, state_variable_names, action_variable_names, 5, action_variable_values)
+    simulator_options = {}
+    if args.zygotes > 0:
+        from TwinBuilderConnector.ZygoteTwinBuilderSimulator import ZygoteTwinBuilderSimulator
+        simulator_options = {'simulator_class': ZygoteTwinBuilderSimulator, 'max_zygotes': args.zygotes}
+    elif args.pool_size > 0:
+        from TwinBuilderConnector.PooledTwinBuilderSimulator import PooledTwinBuilderSimulator
+        simulator_options = {'simulator_class': PooledTwinBuilderSimulator, 'pool_size': args.pool_size}
+    if args.shared_memory_worker:
+        from TwinBuilderConnector.SharedMemoryTransport import SharedMemoryTwinBuilderSimulator
+        if 'simulator_class' in simulator_options:
+            simulator_options['worker_simulator_class'] = simulator_options.pop('simulator_class')
+        simulator_options['simulator_class'] = SharedMemoryTwinBuilderSimulator
+    twin_log_level = LogLevel.TWIN_NO_LOG if args.twin_log_level == "NONE" else LogLevel["TWIN_LOG_" + args.twin_log_level]
+    simulator_options['twin_log_level'] = twin_log_level
+    simulator_options.update(action_repeat=args.action_repeat, state_aggregation=args.state_aggregation,
+                             sub_step_method=args.sub_step_method)
+    simulator_options['log_router'] = TwinLogRouter(args.twin_log_dir, use_tmpfs=args.twin_log_tmpfs,
+                                                    max_bytes=int(args.twin_log_max_mb * 2 ** 20),
+                                                    backup_count=args.twin_log_backups,
+                                                    per_open=args.twin_log_per_episode)
+    recorder = None
+    if args.record_dir:
+        recorder = TrajectoryRecorder(args.record_dir, action_variable_names, state_variable_names,
+                                      file_format=args.record_format, float32=args.record_float32,
+                                      compress=args.record_compress)
+        simulator_options['recorder'] = recorder
+    session_args = [twin_model_file, state_variable_names, action_variable_names, 5, action_variable_values]
+    metrics_options = None
+    if args.metrics_port is not None or args.metrics_file is not None:
+        metrics_options = {'port': args.metrics_port, 'path': args.metrics_file, 'interval': args.metrics_interval}
+    if args.workers > 0:
+        from TwinBuilderConnector.SessionSupervisor import SessionSupervisor
+    elif args.sessions > 0:
+        from TwinBuilderConnector.AsyncRunSession import AsyncRunSession
+    else:
+        from TwinBuilderConnector.RunSession import RunSession
+    startup.mark('imports')
+
+    if args.workers > 0:
+        supervisor = SessionSupervisor(session_args, simulator_options, args.workers,
+                                       max_episodes_per_worker=args.recycle_episodes or None,
+                                       max_rss_mb=args.max_rss_mb or None, metrics_options=metrics_options)
+        supervisor.run()
+    else:
+        exporter = start_metrics_exporter(**metrics_options) if metrics_options else None
+        install_profiling_signal()
+        try:
+            if args.sessions > 0:
+                AsyncRunSession(*session_args, number_of_sessions=args.sessions, **simulator_options)
+            else:
+                RunSession(*session_args, **simulator_options)
+        finally:
+            if exporter is not None:
+                exporter.stop()
+            if recorder is not None:
+                recorder.close()